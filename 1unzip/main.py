@@ -1,45 +1,361 @@
 import functions_framework
-from google.cloud import storage
 import os
 import shutil
 import zipfile
-import tempfile
-from pdf2image import convert_from_path
-from google.cloud import pubsub_v1
+import tarfile
+import gzip
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pdf2image import pdfinfo_from_path
 import re
 
-def pdf_to_jpeg(pdf_path, output_folder, dpi=200):
+from common import clients, job_state, rasterize, scratch, tracing, work_queue
+from common.gcs_transfer import BulkTransfer
+from common.job_manifest import write_manifest
+from common.rasterize import PAGE_MEMORY_BUDGET_MB
+
+# Rasterization settings (page memory budget, JPEG quality and output size: common/rasterize.py)
+RASTER_WORKERS = int(os.getenv('RASTER_WORKERS', str(os.cpu_count() or 1)))  # 1 = render in-process
+RASTER_PAGES_PER_TASK = int(os.getenv('RASTER_PAGES_PER_TASK', '20'))  # Page range size handed to each worker
+
+# Pub/Sub settings
+WORK_TOPIC = os.getenv('WORK_TOPIC', 'file-uploaded')  # Empty to not announce unpacked jobs
+PUBLISH_TIMEOUT_SECONDS = 30
+
+# Archive settings
+ARCHIVE_EXTENSIONS = ['.zip', '.7z', '.gzip', '.gz', '.tgz', '.tar']
+ARCHIVE_READ_CHUNK_BYTES = 8 * 1024 * 1024
+MAX_ARCHIVE_MEMBERS = int(os.getenv('MAX_ARCHIVE_MEMBERS', '500'))
+MAX_MEMBER_BYTES = int(os.getenv('MAX_MEMBER_MB', '200')) * 1024 * 1024
+MAX_ARCHIVE_TOTAL_BYTES = int(os.getenv('MAX_ARCHIVE_TOTAL_MB', '2048')) * 1024 * 1024
+SEVEN_ZIP_BUFFERED_CHUNKS = 4  # Decompressed 7z chunks held between the reader thread and the extraction
+
+def pdf_to_jpeg(pdf_path, output_folder, dpi=200, memory_budget_mb=PAGE_MEMORY_BUDGET_MB, on_page=None, pages=None):
     """
-    Converts a PDF to JPEG, puts them in subfolders.
+    Converts a PDF to JPEG, in subfolders of output_folder/<pdf name>/.
+    on_page(image_path) is called as soon as each JPEG is written.
     """
-    images = convert_from_path(pdf_path, dpi=dpi)
     pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]  # Get the PDF filename without extension
+    return rasterize.pdf_to_jpeg(pdf_path, os.path.join(output_folder, pdf_name), dpi=dpi, memory_budget_mb=memory_budget_mb, on_page=on_page, pages=pages)
 
-    subfolder_count = 0
-    image_count = 0
-    for i, image in enumerate(images):
-        if image_count % 10 == 0:  # Create new subfolder every 10 images
-            subfolder_count += 1
-            current_output_folder = os.path.join(output_folder, pdf_name, f"subfolder_{subfolder_count:02d}")
-            os.makedirs(current_output_folder, exist_ok=True)
-
-        image_filename = f"image_{i+1:02d}.jpeg"  # Format filename with leading zeros
-        image_path = os.path.join(current_output_folder, image_filename)
-        image.save(image_path, "JPEG")
-        image_count += 1
+def render_page_range(pdf_path, output_folder, first_page, last_page, dpi=200, memory_budget_mb=PAGE_MEMORY_BUDGET_MB):
+    """
+    Process pool worker: renders one page range of a PDF and returns the JPEG paths in page order.
+    The paths depend only on the page number, so ranges rendered by different processes still
+    land in the same place.
+    """
+    return pdf_to_jpeg(pdf_path, output_folder, dpi=dpi, memory_budget_mb=memory_budget_mb, pages=range(first_page, last_page + 1))
 
-def process_directory(directory):
+def find_pdfs(directory):
     """
-    Process all PDF files in the given directory and its subdirectories.
+    Yields (pdf_path, output_dir) for every PDF under directory, in a stable order.
     """
-    for root, _, files in os.walk(directory):
-        pdf_files = [f for f in files if f.lower().endswith('.pdf')]
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        pdf_files = sorted(f for f in files if f.lower().endswith('.pdf'))
         for pdf_file in pdf_files:
-            pdf_path = os.path.join(root, pdf_file)
             output_dir = os.path.join(root, "image")
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-            pdf_to_jpeg(pdf_path, output_dir)
+            os.makedirs(output_dir, exist_ok=True)
+            yield os.path.join(root, pdf_file), output_dir
+
+def plan_render_tasks(pdf_path, output_dir, pages_per_task=RASTER_PAGES_PER_TASK):
+    """
+    Splits a PDF into (pdf_path, output_dir, first_page, last_page) tasks.
+    Small PDFs become a single task; large ones are cut into page ranges.
+    """
+    page_count = int(pdfinfo_from_path(pdf_path)["Pages"])
+    return [
+        (pdf_path, output_dir, first_page, min(first_page + pages_per_task - 1, page_count))
+        for first_page in range(1, page_count + 1, pages_per_task)
+    ]
+
+def process_pdfs(pdfs, on_page=None, workers=None, remove_after=False, on_pdf_done=None, on_start=None):
+    """
+    Renders every (pdf_path, output_dir) produced by the pdfs iterable.
+    With more than one worker (RASTER_WORKERS by default), whole PDFs and page ranges of large
+    PDFs are rendered in a process pool; on_page is then called in the parent as each range finishes.
+    With remove_after, each PDF is deleted as soon as all of its pages are rendered.
+    on_pdf_done(pdf_path) is called once on_page has been called for every page of a PDF.
+    on_start(settle) is called before the first PDF is pulled. settle(block=False) hands over the
+    ranges that have finished rendering, with block waiting for at least one, and returns whether
+    any are still rendering: a source that has to wait before producing its next PDF (for scratch
+    space its earlier PDFs hold) calls it so those PDFs can finish meanwhile.
+    """
+    workers = RASTER_WORKERS if workers is None else workers
+    if workers <= 1:
+        if on_start:
+            on_start(lambda block=False: False)  # Each PDF is finished before the next is pulled
+        for pdf_path, output_dir in pdfs:
+            pdf_to_jpeg(pdf_path, output_dir, on_page=on_page)
+            if remove_after:
+                os.remove(pdf_path)
+            if on_pdf_done:
+                on_pdf_done(pdf_path)
+        return
+
+    # Split the memory budget so all workers together stay within it
+    worker_budget_mb = max(1, PAGE_MEMORY_BUDGET_MB // workers)
+    pending = {}  # future -> pdf_path
+    remaining = {}  # pdf_path -> number of unfinished ranges
+
+    def drain(return_when, timeout=None):
+        done, _ = wait(list(pending), timeout=timeout, return_when=return_when)
+        for future in done:
+            pdf_path = pending.pop(future)
+            for image_path in future.result():
+                if on_page:
+                    on_page(image_path)
+            remaining[pdf_path] -= 1
+            if remaining[pdf_path] == 0:
+                del remaining[pdf_path]
+                if remove_after:
+                    os.remove(pdf_path)
+                if on_pdf_done:
+                    on_pdf_done(pdf_path)
+
+    def settle(block=False):
+        if pending:
+            drain(FIRST_COMPLETED, timeout=None if block else 0)
+        return bool(pending)
+
+    if on_start:
+        on_start(settle)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for pdf_path, output_dir in pdfs:
+            tasks = plan_render_tasks(pdf_path, output_dir)
+            remaining[pdf_path] = len(tasks)
+            for task_pdf, task_output, first_page, last_page in tasks:
+                future = executor.submit(render_page_range, task_pdf, task_output, first_page, last_page, memory_budget_mb=worker_budget_mb)
+                pending[future] = pdf_path
+
+            # Backpressure: don't pull more PDFs from the source while the pool is saturated
+            while len(pending) > 2 * workers:
+                drain(FIRST_COMPLETED)
+
+        while pending:
+            drain(FIRST_COMPLETED)
+
+def process_directory(directory, on_page=None, workers=RASTER_WORKERS):
+    """
+    Process all PDF files in the given directory and its subdirectories.
+    """
+    process_pdfs(find_pdfs(directory), on_page=on_page, workers=workers)
+
+class ArchiveLimitError(Exception):
+    """Raised when an archive exceeds the member-count or size limits while it is being read."""
+
+def safe_member_path(work_dir, member_name):
+    """
+    Maps an archive member name onto work_dir, rejecting absolute paths and '..' traversal.
+    Returns None for members that must not be extracted.
+    """
+    normalized = os.path.normpath(member_name.replace("\\", "/")).lstrip("/")
+    if normalized.startswith("..") or os.path.isabs(normalized):
+        return None
+    return os.path.join(work_dir, normalized)
+
+def iter_7z_members(archive, names):
+    """
+    Decompresses the named members of an open py7zr archive in a single forward pass, so a solid
+    block is decompressed once however many members it holds, and yields (name, source) as each
+    member starts. source.read() returns the member's bytes a chunk at a time, then b"", and must
+    be read to the end before the next member is taken. The pass runs on a thread that waits
+    while SEVEN_ZIP_BUFFERED_CHUNKS chunks are unread, and is abandoned when the generator closes.
+    """
+    import py7zr.io
+
+    chunks = queue.Queue(maxsize=SEVEN_ZIP_BUFFERED_CHUNKS)
+    cancelled = threading.Event()
+    by_path = {os.path.normpath(name.replace("\\", "/")): name for name in names}
+
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise RuntimeError("7z extraction abandoned")
+
+    class MemberWriter(py7zr.io.Py7zIO):
+        def __init__(self, name):
+            self.written = 0
+            put(("member", name))
+
+        def write(self, data):
+            put(("chunk", bytes(data)))
+            self.written += len(data)
+            return len(data)
+
+        def read(self, size=None):
+            return b""
+
+        def seek(self, offset, whence=0):
+            return 0
+
+        def seekable(self):
+            return False
+
+        def flush(self):
+            pass
+
+        def size(self):
+            return self.written
+
+        def close(self):
+            put(("end", None))
+
+    class MemberWriters(py7zr.io.WriterFactory):
+        def create(self, filename):
+            return MemberWriter(by_path.get(os.path.normpath(filename), filename))
+
+    class MemberSource:
+        def read(self, size=-1):
+            kind, value = chunks.get()
+            if kind == "error":
+                raise value
+            return value if kind == "chunk" else b""
+
+    def extract():
+        try:
+            archive.extract(targets=list(names), factory=MemberWriters())
+            put(("done", None))
+        except Exception as e:
+            if not cancelled.is_set():
+                put(("error", e))
+
+    reader = threading.Thread(target=extract, name="7z-extract", daemon=True)
+    reader.start()
+    try:
+        while True:
+            kind, value = chunks.get()
+            if kind == "error":
+                raise value
+            if kind == "done":
+                return
+            yield value, MemberSource()
+    finally:
+        cancelled.set()
+        reader.join()
+
+def iter_archive_pdfs(stream, file_name, work_dir, skip=None, reserve=None):
+    """
+    Reads an archive from a (seekable) stream and yields (pdf_path, output_dir) one PDF member
+    at a time. Only PDF members are extracted, and the member-count, per-member and total size
+    limits are enforced on the bytes actually written, not on what the archive headers claim.
+    The caller owns the extracted file and is expected to delete it once processed.
+    Members for which skip(member_path) is true (already processed) are not extracted.
+    reserve(member_path, nbytes) is called before a member's bytes are written: with the size
+    the archive declares, then for any bytes written past it.
+    """
+    skip = skip or (lambda member_path: False)
+    reserve = reserve or (lambda member_path, nbytes: None)
+    limits = {"members": 0, "total_bytes": 0}
+
+    def check_member():
+        limits["members"] += 1
+        if limits["members"] > MAX_ARCHIVE_MEMBERS:
+            raise ArchiveLimitError(f"{file_name}: more than {MAX_ARCHIVE_MEMBERS} PDF members")
+
+    def extract_to(source, member_path, declared_bytes=0):
+        # Copy in chunks so a decompression bomb is caught before it fills /tmp
+        os.makedirs(os.path.dirname(member_path), exist_ok=True)
+        reserve(member_path, declared_bytes)
+        reserved, written = declared_bytes, 0
+        with tracing.span("extract", member=os.path.basename(member_path)) as span, open(member_path, "wb") as out:
+            while True:
+                chunk = source.read(ARCHIVE_READ_CHUNK_BYTES)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > MAX_MEMBER_BYTES or limits["total_bytes"] + written > MAX_ARCHIVE_TOTAL_BYTES:
+                    out.close()
+                    os.remove(member_path)
+                    raise ArchiveLimitError(f"{file_name}: extracted size exceeds limits")
+                if written > reserved:
+                    reserve(member_path, written - reserved)
+                    reserved = written
+                out.write(chunk)
+            span["bytes"] = written
+        limits["total_bytes"] += written
+
+    def member(member_path):
+        return member_path, os.path.join(os.path.dirname(member_path), "image")
+
+    if file_name.endswith('.zip'):
+        # ZipFile only needs ranged reads of the central directory and each member
+        with zipfile.ZipFile(stream) as archive:
+            for info in archive.infolist():
+                member_path = safe_member_path(work_dir, info.filename)
+                if info.is_dir() or not info.filename.lower().endswith('.pdf') or member_path is None:
+                    continue
+                check_member()
+                if skip(member_path):
+                    continue
+                with archive.open(info) as source:
+                    extract_to(source, member_path, info.file_size)
+                yield member(member_path)
+
+    elif file_name.endswith('.7z'):
+        import py7zr
+
+        with py7zr.SevenZipFile(stream, mode='r') as archive:
+            entries = [e for e in archive.list() if not e.is_directory and e.filename.lower().endswith('.pdf')]
+            # 7z headers carry the uncompressed sizes, so the limits can be checked up front
+            for entry in entries:
+                check_member()
+                if entry.uncompressed > MAX_MEMBER_BYTES:
+                    raise ArchiveLimitError(f"{file_name}: {entry.filename} exceeds the member size limit")
+            if sum(e.uncompressed for e in entries) > MAX_ARCHIVE_TOTAL_BYTES:
+                raise ArchiveLimitError(f"{file_name}: extracted size exceeds limits")
+
+            targets = {}  # name -> (member path, declared size)
+            for entry in entries:
+                member_path = safe_member_path(work_dir, entry.filename)
+                if member_path is not None and not skip(member_path):
+                    targets[entry.filename] = (member_path, entry.uncompressed)
+            if not targets:
+                return
+            # Still enforced on the bytes written: the headers are only what the archive claims
+            for name, source in iter_7z_members(archive, targets):
+                member_path, declared_bytes = targets[name]
+                extract_to(source, member_path, declared_bytes)
+                yield member(member_path)
+
+    else:  # .gzip / .gz / .tgz / .tar
+        inner_name = re.sub(r"\.(gzip|gz)$", "", os.path.basename(file_name))
+        read_any = False
+        try:
+            # Streaming mode: members are read strictly front to back, no seeking
+            with tarfile.open(fileobj=stream, mode='r|*') as archive:
+                for info in archive:
+                    read_any = True
+                    member_path = safe_member_path(work_dir, info.name)
+                    if not info.isfile() or not info.name.lower().endswith('.pdf') or member_path is None:
+                        continue
+                    check_member()
+                    if skip(member_path):
+                        continue
+                    extract_to(archive.extractfile(info), member_path, info.size)
+                    yield member(member_path)
+            return
+        except tarfile.ReadError:
+            # A tarball that breaks off part way is an error, not a job with the members read so far
+            if read_any:
+                raise
+            stream.seek(0)
+
+        # A single gzipped file rather than a tarball
+        if inner_name.lower().endswith('.pdf'):
+            check_member()
+            member_path = os.path.join(work_dir, inner_name)
+            if skip(member_path):
+                return
+            with gzip.GzipFile(fileobj=stream) as source:
+                extract_to(source, member_path)
+            yield member(member_path)
 
 # Triggered by a change in a storage bucket
 @functions_framework.cloud_event
@@ -58,55 +374,133 @@ def process_archive(cloud_event):
     print(f"File: {file_name}")
 
     # Check if the file is an archive
-    if not any(file_name.endswith(ext) for ext in ['.zip', '.7z', '.gzip']):
+    if not any(file_name.endswith(ext) for ext in ARCHIVE_EXTENSIONS):
         print(f"Skipping non-archive file: {file_name}")
         return
 
     # Extract the folder name from the file name (improved)
-    folder_name = re.match(r"^(.*?)_.*\.(zip|7z|gzip)$", file_name)
+    folder_name = re.match(r"^(.*?)_.*\.(zip|7z|gzip|gz|tgz|tar)$", file_name)
     if folder_name:
         folder_name = folder_name.group(1)  # Extract the first capture group
     else:
         print(f"Error: Invalid archive filename format: {file_name}")
         return  # Or handle the error differently, depending on your needs
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        # Download the file from the bucket
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(file_name)
-        blob.download_to_filename(os.path.join(temp_dir, file_name))
+    # Jobs enter the pipeline here: every object written from now on carries this trace ID
+    trace = tracing.start_trace("unzip", data, job=folder_name)
+    print(f"Trace ID: {trace.trace_id}")
+
+    storage_client = clients.storage_client()
+    bucket = storage_client.bucket(bucket_name)
+
+    # A duplicate delivery is a no-op; a retry skips the PDF members an earlier attempt uploaded
+    with job_state.once(bucket, "unzip", cloud_event) as first:
+        if not first:
+            return
+        state = job_state.JobState(bucket, "unzip", folder_name, source=job_state.source_generation(data))
+        unpack_archive(bucket, file_name, folder_name, state)
+
+def unpack_archive(bucket, file_name, folder_name, state):
+    """
+    Renders every PDF in the archive into <folder_name>_images/ and writes the job manifest.
+    Each PDF member is recorded in state, with its pages, once all of its pages are uploaded.
+    """
+    # Members are extracted one at a time and pages deleted once uploaded; MAX_MEMBER_MB bounds what is on disk.
+    # Each member's size is reserved against the scratch budget until the last of its pages is uploaded.
+    with scratch.workspace("unzip", folder_name) as workspace:
+        temp_dir = workspace.path
+        reserved = {}  # member path -> bytes reserved for it
+        render = {"settle": None}
 
-        # Extract the archive
-        if file_name.endswith('.zip'):
-            with zipfile.ZipFile(os.path.join(temp_dir, file_name), 'r') as zip_ref:
-                zip_ref.extractall(temp_dir)
+        def reserve(member_path, nbytes):
+            # The space comes back as earlier members' pages are uploaded, and rendered ranges are only
+            # handed to the uploads from here while the pool is waiting on this member
+            while workspace.available() < nbytes and render["settle"](block=True):
+                pass
+            workspace.reserve(nbytes)
+            reserved[member_path] = reserved.get(member_path, 0) + nbytes
 
-        # Process the extracted files using the pdf_to_jpeg function
-        process_directory(temp_dir)
+        blob = bucket.blob(file_name)
 
         # Create the destination folder in the bucket, named after the archive
         destination_folder = f"{folder_name}_images/" 
 
-        # Upload the processed files (JPEGs) to the destination folder
-        for root, _, files in os.walk(temp_dir):
-            for file in files:
-                if file.lower().endswith('.jpeg'):  # Only upload JPEGs
-                    file_path = os.path.join(root, file)
-                    blob_path = os.path.relpath(file_path, temp_dir)
-                    blob_destination = bucket.blob(os.path.join(destination_folder, blob_path))
-                    blob_destination.upload_from_filename(file_path)
+        # Read the archive straight from the bucket and render each PDF member as it is extracted,
+        # so only the members currently being rendered are ever on local disk. JPEGs are uploaded
+        # concurrently and removed once they land.
+        try:
+            with BulkTransfer(bucket) as transfer, blob.open("rb", chunk_size=ARCHIVE_READ_CHUNK_BYTES) as stream:
+                page_paths = []
+                member_uploads = {}  # <member dir>/image/<pdf name> -> [(relative path, future)]
+
+                def upload_page(file_path):
+                    relative_path = os.path.relpath(file_path, temp_dir)
+                    future = transfer.upload_file(file_path, os.path.join(destination_folder, relative_path), content_type="image/jpeg", remove=True)
+                    member_uploads.setdefault(os.path.dirname(os.path.dirname(relative_path)), []).append((relative_path, future))
+                    page_paths.append(relative_path)
+
+                def member_done(pdf_path):
+                    # Checkpoint the member once the last of its uploads lands
+                    member = os.path.relpath(pdf_path, temp_dir)
+                    pdf_folder = os.path.join(os.path.dirname(member), "image", os.path.splitext(os.path.basename(member))[0])
+                    uploads = member_uploads.pop(pdf_folder, [])
+                    pending = {"count": len(uploads)}
+                    lock = threading.Lock()
+
+                    def record(done):
+                        if done.exception() is not None:
+                            return
+                        with lock:
+                            pending["count"] -= 1
+                            last = pending["count"] == 0
+                        if last:
+                            state.complete(f"member:{member}", [path for path, _ in uploads])
+                            workspace.release(reserved.pop(pdf_path, 0))
+
+                    if not uploads:
+                        state.complete(f"member:{member}", [])
+                        workspace.release(reserved.pop(pdf_path, 0))
+                    for _, future in uploads:
+                        future.add_done_callback(record)
 
-        print(f"Processed images uploaded to: {destination_folder} in bucket {bucket_name}")
+                def already_done(member_path):
+                    member = os.path.relpath(member_path, temp_dir)
+                    if not state.done(f"member:{member}"):
+                        return False
+                    page_paths.extend(state.get(f"member:{member}"))
+                    return True
 
-def publish_message(project_id, topic_id, message):
-    publisher = pubsub_v1.PublisherClient()
-    topic_path = publisher.topic_path(project_id, topic_id)  
+                pdfs = iter_archive_pdfs(stream, file_name, temp_dir, skip=already_done, reserve=reserve)
+                process_pdfs(pdfs, on_page=upload_page, remove_after=True, on_pdf_done=member_done,
+                             on_start=lambda settle: render.update(settle=settle))
 
-    data = message.encode("utf-8")
-    future = publisher.publish(topic_path, data)
-    print(future.result())
+                # The manifest goes last: it marks every page of the archive as uploaded
+                transfer.wait()
+                state.flush()
+                write_manifest(transfer, destination_folder, folder_name, page_paths)
+        except ArchiveLimitError as e:
+            print(f"Error: {e}")
+            return
 
-# After file upload and cleanup
-if re.match(r"^\w+_images/$", destination_folder):  # Check if it matches the pattern
-    publish_message(project_id='alligator-snapper', topic_id='file-uploaded', message=destination_folder)
\ No newline at end of file
+        print(f"Processed images uploaded to: {destination_folder} in bucket {bucket.name}")
+        publish_job(folder_name, destination_folder, len(page_paths))
+
+def publish_job(folder_name, destination_folder, page_count):
+    """
+    Announces the unpacked job on WORK_TOPIC (the folder name, as before) to whatever subscribes
+    to it, with its tenant and cost as attributes. This isn't how the stages are scheduled: the
+    OCR stage queues its jobs itself (OCR_WORK_TOPIC in 4jpeg_to_text_claude). A failed publish
+    is logged and the job goes on through its storage events.
+    """
+    if not WORK_TOPIC or not re.match(r"^\w+_images/$", destination_folder):
+        return
+    trace = tracing.current_trace()
+    try:
+        future = work_queue.publish(
+            WORK_TOPIC, destination_folder,
+            job=folder_name, tenant=(trace and trace.tenant) or folder_name,
+            pages=page_count, cost=work_queue.page_batches(page_count),
+        )
+        print(f"Published {destination_folder} to {WORK_TOPIC}: message {future.result(timeout=PUBLISH_TIMEOUT_SECONDS)}")
+    except Exception as e:
+        print(f"Error publishing {destination_folder} to {WORK_TOPIC}: {e}")
@@ -1,54 +1,90 @@
 import os
 import logging
-import subprocess
 
-from google.cloud import storage
-from google.cloud import documentai_v1 as documentai
-from google.oauth2 import service_account
+from common import clients, job_state, runtime, scratch, tracing
+from common.gcs_transfer import BulkTransfer
+from common.job_manifest import page_relative_path, text_page_path, write_manifest, write_responses_manifest
+from common.office_convert import OFFICE_SUFFIXES, convert_documents, is_office_document
+from common.office_text import extract_document, image_to_jpeg, is_extractable
 
-from dotenv import load_dotenv
-from docx import Document
+# Logging and .env only; credentials and SDK clients are created on first use (common/runtime.py)
+runtime.setup()
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-
-# Load environment variables from .env file
-logging.debug("Loading environment variables from .env file")
-load_dotenv()
-
-# Load credentials from the JSON key file
-SERVICE_ACCOUNT_FILE = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
 SCOPES = ['https://www.googleapis.com/auth/cloud-platform']  # Adjust scopes if needed
 
-logging.debug(f"Service Account File: {SERVICE_ACCOUNT_FILE}")
-logging.debug(f"Scopes: {SCOPES}")
-
-try:
-    credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    logging.debug("Service account credentials loaded successfully")
-except Exception as e:
-    logging.error(f"Error loading service account credentials: {e}")
-    raise
-
 # Cloud Storage settings
 BUCKET_NAME = os.getenv('CLOUD_STORAGE_BUCKET')
 ATTACHMENT_FOLDER = "attachments"  # Make sure this matches the first script
 
-logging.debug(f"Cloud Storage Bucket: {BUCKET_NAME}")
+# Batching settings
+BATCH_MAX_DOCUMENTS = int(os.getenv('OFFICE_BATCH_MAX_DOCUMENTS', '20'))  # Documents converted per event
+CLAIM_SUFFIX = ".claim"  # Marker object that reserves a document for the event converting it
+CLAIM_STALE_SECONDS = int(os.getenv('OFFICE_CLAIM_STALE_SECONDS', '900'))  # A claim this old belongs to a dead instance
 
-def sanitize_text(text):
-    # Replace Unicode characters that LaTeX cannot parse with '.'
-    return ''.join(char if ord(char) < 128 else '.' for char in text)
+logging.debug(f"Cloud Storage Bucket: {BUCKET_NAME}")
 
-def sanitize_docx(input_path, sanitized_path):
-    doc = Document(input_path)
-    sanitized_doc = Document()
+def claim(bucket, name):
+    """
+    Reserves a document for this event through its <name>.claim marker. Every document in a
+    folder fires its own event, and whichever event gets to a document first converts it; the
+    others skip it. A claim left behind by a crashed instance expires.
+    """
+    return job_state.claim(bucket, name + CLAIM_SUFFIX, CLAIM_STALE_SECONDS)
 
-    for para in doc.paragraphs:
-        sanitized_paragraph = sanitize_text(para.text)
-        sanitized_doc.add_paragraph(sanitized_paragraph)
+def release(bucket, name):
+    job_state.release(bucket, name + CLAIM_SUFFIX)
 
-    sanitized_doc.save(sanitized_path)
+def batch_documents(bucket, file_name, size=0):
+    """
+    (name, size) of the triggering document first, then of the other unconverted documents
+    in its folder.
+    """
+    folder = os.path.dirname(file_name) + "/"
+    batch = [(file_name, size)]
+    for blob in bucket.list_blobs(prefix=folder):
+        if len(batch) >= BATCH_MAX_DOCUMENTS:
+            break
+        if "/" in blob.name[len(folder):] or blob.name == file_name:
+            continue  # Only documents directly in the folder, not images/ and the like
+        if is_office_document(blob.name):
+            batch.append((blob.name, blob.size or 0))
+    return batch
+
+def job_prefix_for(file_name):
+    # Same layout as a PDF's pages (3pdf_to_jpeg): attachments/images/<document name>/
+    return os.path.join(ATTACHMENT_FOLDER, "images", os.path.splitext(os.path.basename(file_name))[0]) + "/"
+
+def write_extracted_job(transfer, file_name, items):
+    """
+    Writes an extracted document as a job: each run of text is a text page and each embedded
+    image an image page. With no images, the job's text is final and goes straight to the
+    concatenation stage (responses.json); otherwise the manifest sends the images to OCR.
+    Returns the number of image pages, or None if the document had nothing usable.
+    """
+    job_prefix = job_prefix_for(file_name)
+    job_id = os.path.splitext(os.path.basename(file_name))[0]
+
+    page_paths, text_pages, uploads = [], {}, []
+    for kind, value in items:
+        page_number = len(page_paths) + len(text_pages) + 1
+        if kind == "text":
+            text_pages[page_number] = text_page_path(page_number)
+            uploads.append(transfer.upload_bytes(value.encode("utf-8"), job_prefix + text_pages[page_number], content_type="text/plain"))
+            continue
+        jpeg = image_to_jpeg(value)
+        if jpeg is not None:
+            page_paths.append(page_relative_path(page_number))
+            uploads.append(transfer.upload_bytes(jpeg, job_prefix + page_paths[-1], content_type="image/jpeg"))
+    if not page_paths and not text_pages:
+        return None
+    transfer.wait(uploads)  # Only this document's pages: the batch's other transfers are handled separately
+
+    # Written last, once every page is in place
+    if page_paths:
+        write_manifest(transfer, job_prefix, job_id, page_paths, text_pages)
+    else:
+        write_responses_manifest(transfer, job_prefix, job_id, [text_pages[number] for number in sorted(text_pages)])
+    return len(page_paths)
 
 def process_attachments(event, context):
     """Triggered by a change to a Cloud Storage bucket.
@@ -63,66 +99,101 @@ def process_attachments(event, context):
     logging.debug(f"Processing file: {file_name}")
 
     # Check if file is in the attachments folder and has a supported extension
-    if not file_name.startswith(ATTACHMENT_FOLDER + "/") or not any(file_name.endswith(ext) for ext in ['.doc', '.docx', '.xls']):
-        logging.info(f"Skipping file: {file_name} (not in attachments folder or unsupported extension)")
+    if not file_name.startswith(ATTACHMENT_FOLDER + "/") or file_name.startswith(ATTACHMENT_FOLDER + "/images/") or not is_office_document(file_name):
+        logging.info(f"Skipping file: {file_name} (not in attachments folder or not one of {', '.join(OFFICE_SUFFIXES)})")
         return
 
-    # Initialize clients
-    storage_client = storage.Client(credentials=credentials)
-    documentai_client = documentai.DocumentProcessorServiceClient(credentials=credentials)
+    tracing.start_trace("docx", event, job=os.path.splitext(os.path.basename(file_name))[0])
 
-    # Get file from bucket
+    # Clients are created once per instance and reused across events
+    storage_client = clients.storage_client(runtime.credentials(SCOPES))
     bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(file_name)
-
-    # Download file to temporary location
-    temp_file_path = f"/tmp/{file_name.split('/')[-1]}"
-    blob.download_to_filename(temp_file_path)
 
-    if file_name.endswith(".docx"):
-        # Sanitize and convert .docx to PDF using Pandoc
-        sanitized_path = os.path.join("/tmp", "sanitized_" + file_name.split('/')[-1])
-        output_path = os.path.join("/tmp", os.path.splitext(file_name.split('/')[-1])[0] + ".pdf")
-
-        logging.debug(f"Sanitizing {temp_file_path}...")
-        try:
-            sanitize_docx(temp_file_path, sanitized_path)
-
-            logging.debug(f"Converting {sanitized_path} to PDF...")
-            subprocess.run(['pandoc', sanitized_path, '-o', output_path], check=True)
-            logging.debug(f"Converted: {output_path}")
-
-            # Upload the PDF to Cloud Storage
-            pdf_file_name = f"{ATTACHMENT_FOLDER}/{os.path.splitext(file_name.split('/')[-1])[0]}.pdf"
-            pdf_blob = bucket.blob(pdf_file_name)
-            with open(output_path, "rb") as f:
-                pdf_blob.upload_from_file(f, content_type="application/pdf")
-
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Error converting {temp_file_path}: {str(e)}")
-
-        finally:
-            # Clean up temporary files
-            os.remove(sanitized_path)
-            os.remove(output_path)
-
-    else:  # .doc or .xls
-        # Process with Document AI
-        with open(temp_file_path, "rb") as f:
-            raw_document = documentai.types.RawDocument(content=f.read(), mime_type="application/octet-stream")
-
-        name = f"projects/{os.getenv('PROJECT_ID')}/locations/us/processors/my-doc-processor"
-        logging.debug(f"Using Document AI processor: {name}")
-
-        result = documentai_client.process_document(name=name, raw_document=raw_document)
-        pdf_bytes = result.document.content
-
-        # Upload PDF back to bucket
-        pdf_file_name = f"{ATTACHMENT_FOLDER}/{os.path.splitext(file_name.split('/')[-1])[0]}.pdf"
-        pdf_blob = bucket.blob(pdf_file_name)
-        pdf_blob.upload_from_string(pdf_bytes, content_type="application/pdf")
-
-    # Delete the original file
-    blob.delete()
-
-    logging.info(f"Processed {file_name} into {pdf_file_name}")
\ No newline at end of file
+    # An earlier event may already have converted this document as part of its batch
+    if not bucket.blob(file_name).exists() or not claim(bucket, file_name):
+        logging.info(f"Skipping file: {file_name} (already converted or being converted)")
+        return
+    sizes = dict(batch_documents(bucket, file_name, int(event.get('size') or 0)))
+    documents = [file_name] + [name for name in list(sizes)[1:] if claim(bucket, name)]
+    logging.info(f"Converting {len(documents)} document(s): {documents}")
+
+    # Documents and their PDFs stay on local disk only for this batch
+    with scratch.workspace("docx", os.path.splitext(os.path.basename(file_name))[0]) as workspace:
+        work_dir = workspace.path
+
+        def done_with(name, local_path):
+            # Frees the document's share of the scratch budget once its output has landed
+            if os.path.exists(local_path):
+                os.remove(local_path)
+            workspace.release(sizes[name])
+
+        with BulkTransfer(bucket) as transfer:
+            # Download the batch, each document's size reserved first; a document deleted since it was listed just drops out
+            downloads = {}
+            for name in documents:
+                local_path = os.path.join(work_dir, "in", os.path.basename(name))
+                workspace.reserve(sizes[name])
+                downloads[name] = (local_path, transfer.download_file(name, local_path))
+            inputs = []
+            for name, (local_path, future) in downloads.items():
+                try:
+                    transfer.wait([future])
+                    inputs.append((name, local_path))
+                except Exception as e:
+                    logging.error(f"Error downloading {name}: {e}")
+                    done_with(name, local_path)
+                    release(bucket, name)
+
+            # Born-digital documents: their text is read directly and only embedded images go to OCR
+            to_convert = []
+            for name, local_path in inputs:
+                items = None
+                if is_extractable(name):
+                    with tracing.span("extract_text", document=os.path.basename(name)) as span:
+                        items = extract_document(local_path)
+                        span["items"] = len(items or [])
+                if items is None:
+                    to_convert.append((name, local_path))
+                    continue
+                try:
+                    images = write_extracted_job(transfer, name, items)
+                except Exception as e:
+                    logging.error(f"Error writing the extracted text of {name}: {e}")
+                    release(bucket, name)
+                    continue
+                if images is None:
+                    to_convert.append((name, local_path))
+                    continue
+                bucket.blob(name).delete()
+                done_with(name, local_path)
+                release(bucket, name)
+                logging.info(f"Extracted {name} into {job_prefix_for(name)} ({images} image page(s) for OCR)")
+
+            # Everything else is converted to PDF for the rasterizer
+            with tracing.span("office_convert", documents=len(to_convert)):
+                results = convert_documents([local_path for _, local_path in to_convert], os.path.join(work_dir, "out"))
+
+            uploads = []
+            for (name, local_path), result in zip(to_convert, results):
+                if isinstance(result, Exception):
+                    logging.error(f"Error converting {name}: {result}")
+                    done_with(name, local_path)
+                    release(bucket, name)
+                    continue
+                pdf_file_name = f"{os.path.dirname(name)}/{os.path.basename(result)}"
+                uploads.append((name, local_path, pdf_file_name, transfer.upload_file(result, pdf_file_name, content_type="application/pdf", remove=True)))
+
+            for name, local_path, pdf_file_name, future in uploads:
+                try:
+                    transfer.wait([future])
+                except Exception as e:
+                    logging.error(f"Error uploading {pdf_file_name}: {e}")
+                    done_with(name, local_path)
+                    release(bucket, name)
+                    continue
+
+                # Delete the original file; its claim goes with it
+                bucket.blob(name).delete()
+                done_with(name, local_path)
+                release(bucket, name)
+                logging.info(f"Processed {name} into {pdf_file_name}")
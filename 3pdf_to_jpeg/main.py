@@ -1,56 +1,28 @@
 import os
 import logging
-from pdf2image import convert_from_path
-from google.cloud import storage
-from google.oauth2 import service_account
-from dotenv import load_dotenv
+from pdf2image import pdfinfo_from_path
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+from common import clients, job_state, runtime, scratch, tracing
+from common.gcs_transfer import BulkTransfer
+from common.job_manifest import page_relative_path, text_page_path, write_manifest, write_responses_manifest
+from common.rasterize import PAGE_MEMORY_BUDGET_MB, RASTER_OUTPUT_MODE, iter_jpeg_pages
+from common.text_layer import classify_pages
 
-# Load environment variables from .env file
-logging.debug("Loading environment variables from .env file")
-load_dotenv()
+# Logging and .env only; credentials and SDK clients are created on first use (common/runtime.py)
+runtime.setup()
 
-# Load credentials from the JSON key file
-SERVICE_ACCOUNT_FILE = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
 SCOPES = ['https://www.googleapis.com/auth/cloud-platform']  # Adjust scopes if needed
 
-logging.debug(f"Service Account File: {SERVICE_ACCOUNT_FILE}")
-logging.debug(f"Scopes: {SCOPES}")
-
-try:
-    credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    logging.debug("Service account credentials loaded successfully")
-except Exception as e:
-    logging.error(f"Error loading service account credentials: {e}")
-    raise
-
 # Cloud Storage settings
 BUCKET_NAME = os.getenv('CLOUD_STORAGE_BUCKET')
 ATTACHMENT_FOLDER = "attachments"  # Make sure this matches the first and second scripts
 
-logging.debug(f"Cloud Storage Bucket: {BUCKET_NAME}")
+# Pages whose text layer passes common/text_layer.py are extracted instead of rasterized
+TEXT_LAYER_DETECTION = os.getenv('TEXT_LAYER_DETECTION', '1') == '1'
 
-def pdf_to_jpeg(pdf_path, output_folder, dpi=200):
-    """
-    Converts a PDF to JPEG, puts them in subfolders within the output_folder.
-    """
-    images = convert_from_path(pdf_path, dpi=dpi)
-    pdf_name = os.path.splitext(os.path.basename(pdf_path))[0] 
-
-    subfolder_count = 0
-    image_count = 0
-    for i, image in enumerate(images):
-        if image_count % 10 == 0: 
-            subfolder_count += 1
-            current_output_folder = os.path.join(output_folder, f"subfolder_{subfolder_count:02d}")
-            os.makedirs(current_output_folder, exist_ok=True)
-
-        image_filename = f"image_{i+1:02d}.jpeg"
-        image_path = os.path.join(current_output_folder, image_filename)
-        image.save(image_path, "JPEG")
-        image_count += 1
+logging.debug(f"Cloud Storage Bucket: {BUCKET_NAME}")
+logging.debug(f"Page memory budget: {PAGE_MEMORY_BUDGET_MB} MB")
+logging.debug(f"Raster output mode: {RASTER_OUTPUT_MODE}")
 
 def process_pdfs_in_cloud_storage(event, context):
     """Triggered by a change to a Cloud Storage bucket.
@@ -69,37 +41,86 @@ def process_pdfs_in_cloud_storage(event, context):
         logging.info(f"Skipping file: {file_name} (not a PDF in attachments folder)")
         return
 
-    # Initialize Cloud Storage client
-    storage_client = storage.Client(credentials=credentials)
+    # Cloud Storage client, reused across events on a warm instance
+    storage_client = clients.storage_client(runtime.credentials(SCOPES))
 
-    # Get the PDF file from the bucket
     bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(file_name)
-
-    # Download the PDF to a temporary location
-    temp_file_path = f"/tmp/{file_name.split('/')[-1]}"
-    blob.download_to_filename(temp_file_path)
-
-    # Create the output folder in the same directory as the PDF, but within the 'images' subfolder
-    output_dir = os.path.join(os.path.dirname(temp_file_path), "images", os.path.splitext(os.path.basename(temp_file_path))[0])
-    os.makedirs(output_dir, exist_ok=True)
-
-    # Convert the PDF to JPEGs
-    pdf_to_jpeg(temp_file_path, output_dir)
-
-    # Upload the JPEGs to Cloud Storage, maintaining the original folder structure
-    for root, _, files in os.walk(output_dir):
-        for file in files:
-            if file.lower().endswith('.jpeg'):
-                local_file_path = os.path.join(root, file)
-                # Construct the Cloud Storage path, keeping the relative path from the 'images' folder
-                cloud_storage_path = os.path.join(ATTACHMENT_FOLDER, "images", os.path.relpath(local_file_path, output_dir))
-                image_blob = bucket.blob(cloud_storage_path)
-                image_blob.upload_from_filename(local_file_path)
-                logging.info(f"Uploaded JPEG: {cloud_storage_path}")
-
-    # Optionally, delete the temporary PDF file and the local 'images' folder
-    os.remove(temp_file_path)
-    # shutil.rmtree(output_dir)  
-
-    logging.info(f"Processed PDF: {file_name}")
\ No newline at end of file
+
+    # Each PDF is one job: its pages go under attachments/images/<pdf name>/
+    job_id = os.path.splitext(os.path.basename(file_name))[0]
+    job_prefix = os.path.join(ATTACHMENT_FOLDER, "images", job_id) + "/"
+    tracing.start_trace("pdf_to_jpeg", event, job=job_id)
+
+    # A duplicate delivery is a no-op; a retry resumes from the pages already uploaded
+    with job_state.once(bucket, "pdf_to_jpeg", event, context) as first:
+        if not first:
+            return
+        state = job_state.JobState(bucket, "pdf_to_jpeg", job_id, source=job_state.source_generation(event))
+        with scratch.workspace("pdf_to_jpeg", job_id) as workspace:
+            # The PDF is the only file on local disk; pages are encoded and uploaded from memory
+            workspace.reserve(int(event.get("size") or 0))
+            rasterize_job(bucket, file_name, job_id, job_prefix, state, workspace.join(os.path.basename(file_name)))
+
+def rasterize_job(bucket, file_name, job_id, job_prefix, state, temp_file_path):
+    """
+    Turns one PDF into a job: text pages for pages with a usable text layer, JPEGs for the
+    rest, then the manifest. Pages recorded in state were uploaded by an earlier attempt
+    and are not rendered again. The PDF is downloaded to temp_file_path.
+    """
+
+    def checkpoint(future, page_number, relative_path):
+        # Recorded once the upload has landed, from the transfer's worker thread
+        def record(done):
+            if done.exception() is None:
+                state.complete(f"page:{page_number}", relative_path)
+        future.add_done_callback(record)
+
+    with BulkTransfer(bucket) as transfer:
+        transfer.download_file(file_name, temp_file_path).result()
+
+        # Born-digital pages keep their text layer as text pages; only the rest are rasterized
+        pdf_info = pdfinfo_from_path(temp_file_path)
+        if TEXT_LAYER_DETECTION:
+            with tracing.span("classify_pages", pages=int(pdf_info["Pages"])) as span:
+                pages = classify_pages(temp_file_path, pdf_info)
+                span["text_pages"] = sum(page["text"] is not None for page in pages)
+        else:
+            pages = [{"number": number, "text": None, "reason": "disabled"} for number in range(1, int(pdf_info["Pages"]) + 1)]
+
+        text_pages, raster_pages, page_paths = {}, [], []
+        for page in pages:
+            if page["text"] is None:
+                if state.done(f"page:{page['number']}"):
+                    page_paths.append(state.get(f"page:{page['number']}"))
+                    continue
+                logging.debug(f"Rasterizing page {page['number']}: {page['reason']}")
+                raster_pages.append(page["number"])
+                continue
+            text_pages[page["number"]] = text_page_path(page["number"])
+            if not state.done(f"page:{page['number']}"):
+                future = transfer.upload_bytes(page["text"].encode("utf-8"), os.path.join(job_prefix, text_pages[page["number"]]), content_type="text/plain")
+                checkpoint(future, page["number"], text_pages[page["number"]])
+        logging.info(f"{len(text_pages)} of {len(pages)} pages of {file_name} have a usable text layer")
+        if page_paths:
+            logging.info(f"{len(page_paths)} pages were rasterized by an earlier attempt")
+
+        # Convert the remaining pages to JPEGs, uploading each page from memory as soon as it is encoded
+        if raster_pages:
+            numbers = {page_relative_path(number): number for number in raster_pages}
+            for relative_path, data in iter_jpeg_pages(temp_file_path, pages=raster_pages):
+                cloud_storage_path = os.path.join(job_prefix, relative_path)
+                checkpoint(transfer.upload_bytes(data, cloud_storage_path, content_type="image/jpeg"), numbers[relative_path], relative_path)
+                page_paths.append(relative_path)
+                logging.debug(f"Queued JPEG upload: {cloud_storage_path}")
+
+        # The manifest goes last: it tells the OCR stage every page of the job is in place.
+        # A job with nothing to transcribe goes straight to the concatenation stage instead.
+        transfer.wait()
+        state.flush()
+        if page_paths:
+            write_manifest(transfer, job_prefix, job_id, page_paths, text_pages)
+        else:
+            write_responses_manifest(transfer, job_prefix, job_id, [text_pages[number] for number in sorted(text_pages)])
+
+    logging.info(f"Rendered {len(raster_pages)} pages; the job has {len(page_paths)} JPEGs and {len(text_pages)} text pages")
+    logging.info(f"Processed PDF: {file_name}")
@@ -1,127 +1,475 @@
 import os
 import logging
-import anthropic
 import glob
 import base64
 from PIL import Image
 import io
 import time
 import traceback
-from google.cloud import storage
-from google.oauth2 import service_account
-from dotenv import load_dotenv
-from google.cloud import secretmanager
+import shutil
+import re
+from functools import partial
+from types import SimpleNamespace
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+from common import clients, job_state, runtime, scratch, tracing, work_queue
+from common.gcs_transfer import BulkTransfer, open_blob_writer
+from common.job_manifest import image_page_numbers, is_manifest, job_prefix_of, natural_key, read_manifest, write_responses_manifest
+from common.ocr_cache import cache_from_env, cache_key
+from common.secret_cache import get_secret
 
-# Load environment variables from .env file
-logging.debug("Loading environment variables from .env file")
-load_dotenv()
+# Logging and .env only; credentials and SDK clients are created on first use (common/runtime.py)
+runtime.setup()
 
-# Load credentials from the JSON key file
-SERVICE_ACCOUNT_FILE = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
 SCOPES = ['https://www.googleapis.com/auth/cloud-platform'] 
 
-logging.debug(f"Service Account File: {SERVICE_ACCOUNT_FILE}")
-logging.debug(f"Scopes: {SCOPES}")
-
-try:
-    credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    logging.debug("Service account credentials loaded successfully")
-except Exception as e:
-    logging.error(f"Error loading service account credentials: {e}")
-    raise
-
 # Cloud Storage and Secret Manager settings
 BUCKET_NAME = "bonesjustice" 
 ATTACHMENT_FOLDER = "attachments" 
 PROJECT_ID = os.getenv('PROJECT_ID') # Get your project ID from environment variables
 
+# Claude settings
+CLAUDE_MODEL = "claude-3-5-sonnet-20240620"
+CLAUDE_MAX_TOKENS = 8192
+CLAUDE_ASYNC = os.getenv('CLAUDE_ASYNC', '1') == '1'  # Send all of a job's requests concurrently
+CLAUDE_STREAM = os.getenv('CLAUDE_STREAM', '1') == '1'  # Stream responses straight into GCS uploads (with CLAUDE_ASYNC)
+CLAUDE_CONTEXT_WINDOW = 200000
+
+# Request planning
+MAX_IMAGES_PER_REQUEST = int(os.getenv('MAX_IMAGES_PER_REQUEST', '100'))
+MAX_REQUEST_BYTES = 30 * 1024 * 1024  # The API rejects requests over 32 MB
+OUTPUT_TOKENS_PER_PAGE = int(os.getenv('OUTPUT_TOKENS_PER_PAGE', '700'))  # Expected transcript length of one page
+OUTPUT_FILL_RATIO = 0.8  # Plan to fill at most this share of max_tokens
+PAGE_LABEL_TOKENS = 10  # The "Image N:" text after each image
+PAGE_LABEL_INSTRUCTION = 'Start the transcript of each image with its label ("Image 1:", "Image 2:", ...) on a line of its own.'
+IMAGE_LABEL = re.compile(r"^[#*\s]*Image (\d+):\**", re.MULTILINE)  # A page's label at the start of a line of the response
+PAGE_SCRATCH_BYTES = int(os.getenv('PAGE_SCRATCH_KB', '600')) * 1024  # A downloaded model-resolution page, for the scratch budget
+
+# Work queue settings
+OCR_WORK_TOPIC = os.getenv('OCR_WORK_TOPIC', '')  # Set to queue jobs for the OCR worker instead of transcribing in the trigger
+OCR_WORK_SUBSCRIPTION = os.getenv('OCR_WORK_SUBSCRIPTION', 'ocr-work')
+OCR_WORKERS = int(os.getenv('OCR_WORKERS', '4'))  # Jobs the worker transcribes at once, within the queue's in-flight cap
+PUBLISH_TIMEOUT_SECONDS = 30
+
 logging.debug(f"Cloud Storage Bucket: {BUCKET_NAME}")
 
+def is_model_ready(img, max_size):
+    """
+    True for JPEGs the rasterizer already rendered inside the model's pixel box.
+    Image.open only parses the header, so this check doesn't decode the image.
+    """
+    return img.format == "JPEG" and img.width <= max_size[0] and img.height <= max_size[1]
+
 def read_and_resize_image(file_path, max_size=(1568, 1568)):
     try:
-        with Image.open(file_path) as img:
-            img.thumbnail(max_size)
-            buffered = io.BytesIO()
-            img.save(buffered, format="JPEG")
-            encoded = base64.b64encode(buffered.getvalue()).decode('utf-8')
-            logging.debug(f"Encoded image from {file_path}. First 20 characters: {encoded[:20]}")
+        with tracing.span("read_and_resize_image", path=os.path.basename(file_path)) as span, Image.open(file_path) as img:
+            span["resized"] = not is_model_ready(img, max_size)
+            if not span["resized"]:
+                # Send the encoded bytes as they are: no decode, resize or second lossy encode
+                with open(file_path, "rb") as f:
+                    encoded = base64.b64encode(f.read()).decode('utf-8')
+            else:
+                img.thumbnail(max_size)
+                buffered = io.BytesIO()
+                img.save(buffered, format="JPEG")
+                encoded = base64.b64encode(buffered.getvalue()).decode('utf-8')
+            span["bytes"] = len(encoded)
             return encoded
     except IOError:
         logging.error(f"Error: Unable to open or process image: {file_path}")
         raise
 
-def process_images_in_folder(folder_path, client, system_prompt, user_prompt):
-    try:
-        jpeg_files = glob.glob(os.path.join(folder_path, "*.jpg")) + glob.glob(os.path.join(folder_path, "*.jpeg"))
-        if not jpeg_files:
-            logging.info(f"No JPEG files found in {folder_path}. Skipping.")
-            return
+def estimate_image_tokens(width, height, max_edge=1568):
+    """
+    Input tokens for one image, using Anthropic's estimate of width * height / 750
+    on the image as the API will see it (scaled down to max_edge).
+    """
+    scale = min(1.0, max_edge / max(width, height))
+    return int((width * scale) * (height * scale) / 750) + 1
 
-        content = []
-        for i, file in enumerate(jpeg_files, 1):
-            encoded_image = read_and_resize_image(file)
-            content.append({
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": "image/jpeg",
-                    "data": encoded_image
-                }
-            })
+def estimate_text_tokens(text):
+    return len(text) // 4 + 1
+
+def load_pages(image_paths, page_numbers=None):
+    """
+    Page records for the planner. "skip" is None for pages that are sent, "blank", or the
+    number of the earlier page a near-duplicate repeats; skipped pages carry no image cost.
+    page_numbers are the pages' numbers in the document when it also has text pages.
+    """
+    from common.page_filter import filter_pages  # numpy
+
+    page_numbers = page_numbers or list(range(1, len(image_paths) + 1))
+    with tracing.span("filter_pages", pages=len(image_paths)):
+        decisions = filter_pages(image_paths)
+    pages = []
+    for page_number, path, decision in zip(page_numbers, image_paths, decisions):
+        with Image.open(path) as img:
+            width, height = img.size
+        skip = page_numbers[decision] if isinstance(decision, int) else decision
+        pages.append({
+            "number": page_number,
+            "path": path,
+            "skip": skip,
+            "tokens": 0 if skip else estimate_image_tokens(width, height),
+            "payload_bytes": 0 if skip else os.path.getsize(path) * 4 // 3,  # base64
+        })
+    return pages
+
+def skip_placeholder(page):
+    """Stands in for a skipped page so the pages around it keep their numbering."""
+    if page["skip"] == "blank":
+        return f"[Page {page['number']}: blank page, not transcribed]"
+    return f"[Page {page['number']}: near-duplicate of page {page['skip']}, not transcribed]"
+
+def plan_requests(pages, prompt_tokens, max_tokens=CLAUDE_MAX_TOKENS):
+    """
+    Packs pages, in order, into as few requests as the model's limits allow. A request must keep
+    its input plus max_tokens inside the context window, its expected transcript inside
+    max_tokens (with headroom), and its image count and payload size inside the API limits.
+    A gap in the page numbers (text pages in between) also starts a new request, so every
+    part covers a run of consecutive pages, and so does a change between cached and uncached
+    pages, so cached pages are never sent.
+    """
+    input_budget = CLAUDE_CONTEXT_WINDOW - max_tokens - prompt_tokens
+    output_budget = int(max_tokens * OUTPUT_FILL_RATIO)
+
+    groups = []
+    current, images, input_tokens, output_tokens, payload_bytes = [], 0, 0, 0, 0
+    for page in pages:
+        is_image = not page.get("skip") and page.get("cached") is None
+        page_input = page["tokens"] + PAGE_LABEL_TOKENS
+        page_output = OUTPUT_TOKENS_PER_PAGE if is_image else PAGE_LABEL_TOKENS  # A skipped page is only its placeholder
+        fits = (
+            (not current or page["number"] == current[-1]["number"] + 1)
+            and (not current or (page.get("cached") is None) == (current[-1].get("cached") is None))
+            and images + is_image <= MAX_IMAGES_PER_REQUEST
+            and input_tokens + page_input <= input_budget
+            and output_tokens + page_output <= output_budget
+            and payload_bytes + page["payload_bytes"] <= MAX_REQUEST_BYTES
+        )
+        if current and not fits:
+            groups.append(current)
+            current, images, input_tokens, output_tokens, payload_bytes = [], 0, 0, 0, 0
+        current.append(page)
+        images += is_image
+        input_tokens += page_input
+        output_tokens += page_output
+        payload_bytes += page["payload_bytes"]
+    if current:
+        groups.append(current)
+    return groups
+
+def build_image_content(pages, user_prompt):
+    """
+    Builds the Messages content list for a group of pages: each page image followed by its
+    "Image N:" label, then the user prompt. A skipped page is sent as its placeholder text
+    instead of an image, so the model's image numbering still matches the pages.
+    """
+    content = []
+    for i, page in enumerate(pages, 1):
+        if page.get("skip"):
             content.append({
                 "type": "text",
-                "text": f"Image {i}:"
+                "text": f"Image {i}: {skip_placeholder(page)}"
             })
-
+            continue
+        encoded_image = read_and_resize_image(page["path"])
+        content.append({
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": "image/jpeg",
+                "data": encoded_image
+            }
+        })
         content.append({
             "type": "text",
-            "text": user_prompt
+            "text": f"Image {i}:"
         })
 
-        logging.debug("Number of items in content list: {}".format(len(content)))
-        for i, item in enumerate(content):
-            if item['type'] == 'image':
-                logging.debug(f"Item {i} is an image. First 50 characters of base64 data: {item['source']['data'][:50]}")
-            elif item['type'] == 'text':
-                logging.debug(f"Item {i} is text. Content: {item['text']}")
+    content.append({
+        "type": "text",
+        "text": PAGE_LABEL_INSTRUCTION
+    })
+    content.append({
+        "type": "text",
+        "text": user_prompt
+    })
+
+    logging.debug(f"Built content for {pages_label(pages)}: {len(content)} items")
+    return content
+
+def build_request(content, system_prompt):
+    """Keyword arguments for messages.create, shared by the sync and async paths."""
+    return {
+        "model": CLAUDE_MODEL,
+        "max_tokens": CLAUDE_MAX_TOKENS,
+        "extra_headers": {"anthropic-beta": "max-tokens-3-5-sonnet-2024-07-15"},
+        "system": system_prompt,
+        "messages": [
+            {
+                "role": "user", 
+                "content": content
+            }
+        ]
+    }
+
+def page_cache_key(page, system_prompt, user_prompt):
+    """
+    OCR cache key for one page: its image as sent plus the prompts (the label instruction
+    included) and model. It doesn't depend on the request the page is sent in or its place there.
+    """
+    return cache_key([read_and_resize_image(page["path"])], system_prompt, f"{PAGE_LABEL_INSTRUCTION}\n{user_prompt}", CLAUDE_MODEL)
+
+def look_up_pages(pages, cache, system_prompt, user_prompt):
+    """
+    Sets each page's cache key, and its cached transcript as "cached" on a hit. Cached pages
+    carry no image cost, so the planner leaves them out of the requests.
+    """
+    hits = 0
+    for page in pages:
+        if page["skip"]:
+            continue
+        page["key"] = page_cache_key(page, system_prompt, user_prompt)
+        page["cached"] = cache.get(page["key"])
+        if page["cached"] is not None:
+            page["tokens"] = page["payload_bytes"] = 0
+            hits += 1
+    if hits:
+        logging.info(f"OCR cache hit for {hits} of {len(pages)} pages")
+
+def split_page_texts(group, text):
+    """
+    Each page's transcript in a group's response, by the "Image N:" labels the model starts them
+    with: {position in the group: text}. Empty when the labels are out of order, so nothing is
+    cached; a single page needs no label.
+    """
+    matches = list(IMAGE_LABEL.finditer(text))
+    positions = [int(match.group(1)) for match in matches]
+    if not matches:
+        return {1: text.strip()} if len(group) == 1 else {}
+    if positions != sorted(set(positions)) or positions[0] < 1 or positions[-1] > len(group):
+        return {}
+    ends = [match.start() for match in matches[1:]] + [len(text)]
+    return {position: text[match.end():end].strip() for position, match, end in zip(positions, matches, ends)}
+
+def cache_page_texts(cache, group, text):
+    """Caches the transcript of every sent page of a group that split_page_texts finds in its response."""
+    texts = split_page_texts(group, text)
+    for position, page in enumerate(group, 1):
+        if not page["skip"] and position in texts:
+            cache.put(page["key"], texts[position])
+    if len(texts) < len(group):
+        logging.debug(f"Response for {pages_label(group)} labels {len(texts)} of {len(group)} pages; only those are cached")
+
+def resolved_text(group):
+    """The text of a group with nothing to send: its cached transcripts, labeled for their place in the group, and placeholders."""
+    return "\n\n".join(
+        skip_placeholder(page) if page["skip"] else f"Image {position}:\n{page['cached']}"
+        for position, page in enumerate(group, 1)
+    )
+
+def send_requests(requests, api_key, labels):
+    """
+    Sends requests concurrently (or one by one with CLAUDE_ASYNC=0) and returns a Message
+    or the exception it failed with for each request, in order.
+    """
+    if not requests:
+        return []
+    if CLAUDE_ASYNC:
+        from common.claude_async import run_messages
+        return run_messages(requests, api_key, labels=labels)
 
+    import anthropic
+    client = clients.anthropic_client(api_key)
+    results = []
+    for request, label in zip(requests, labels):
         try:
-            response = client.messages.create(
-                model="claude-3-5-sonnet-20240620",
-                max_tokens=8192,
-                extra_headers={"anthropic-beta": "max-tokens-3-5-sonnet-2024-07-15"},
-                system=system_prompt,
-                messages=[
-                    {
-                        "role": "user", 
-                        "content": content
-                    }
-                ]
-            )
-            assistant_response = response.content[0].text
+            with tracing.span("messages.create", request=label):
+                results.append(client.messages.create(**request))
+        except anthropic.APIError as e:
+            results.append(e)
+    return results
+
+def pages_label(group):
+    return f"pages {group[0]['number']}-{group[-1]['number']}"
+
+def part_name(group):
+    # Zero-padded page ranges keep the parts in page order when listed
+    return f"responses/response_pages_{group[0]['number']:04d}-{group[-1]['number']:04d}.txt"
+
+def part_pages(name):
+    """The first and last page numbers of a part named by part_name."""
+    first_page, last_page = re.search(r"(\d+)-(\d+)\.txt$", name).groups()
+    return int(first_page), int(last_page)
+
+def write_part(bucket, job_prefix, group, text):
+    with tracing.span("upload", object=job_prefix + part_name(group), bytes=len(text.encode("utf-8"))):
+        tracing.tag_blob(bucket.blob(job_prefix + part_name(group))).upload_from_string(text, content_type="text/plain")
+
+def discard_part(bucket, job_prefix, group):
+    """Deletes a streamed part whose response was truncated or failed, if it was written at all."""
+    blob = bucket.blob(job_prefix + part_name(group))
+    if blob.exists():
+        blob.delete()
+
+def is_complete(group, message):
+    """False for a response cut off at max_tokens that ocr_pages will split and resend."""
+    return message.stop_reason != "max_tokens" or len(group) == 1
+
+def stream_requests(requests, groups, api_key, bucket, job_prefix, on_part=None):
+    """
+    Streams each request's text into its part object under job_prefix as it is generated.
+    Returns a Message or exception per request, in order, and the times first tokens arrived.
+    on_part(group), if given, is called as soon as a group's complete part is in the bucket.
+    """
+    open_writers = [partial(open_blob_writer, bucket, job_prefix + part_name(group), "text/plain") for group in groups]
+    from common.claude_async import run_streamed_messages
 
-            # Save the response to a file
-            output_file_name = os.path.join(folder_path, f'response_{int(time.time())}.txt')
+    def on_result(index, result):
+        if on_part is not None and not isinstance(result, Exception) and is_complete(groups[index], result[0]):
+            on_part(groups[index])
+
+    results = run_streamed_messages(requests, open_writers, api_key, labels=[pages_label(group) for group in groups], on_result=on_result)
+    messages, first_tokens = [], []
+    for result in results:
+        if isinstance(result, Exception):
+            messages.append(result)
+            continue
+        message, first_token_at = result
+        messages.append(message)
+        first_tokens.append(first_token_at)
+    return messages, first_tokens
+
+def ocr_pages(image_paths, api_key, system_prompt, user_prompt, cache=None, bucket=None, job_prefix=None, metrics=None, page_numbers=None, on_part=None):
+    """
+    Transcribes pages with as few requests as plan_requests allows. Returns (group, text)
+    for every page group in page order, with text None where the request failed.
+    A response cut off at max_tokens is discarded and its group is split in half and resent,
+    so no text is lost to truncation. Blank and near-duplicate pages are not sent (see
+    common.page_filter); a placeholder keeps their place in the text. Neither are pages whose
+    transcript is in the cache: it is looked up per page, and every page of a response is
+    cached under its own key.
+
+    With a bucket, every group's text is also written to its part object under job_prefix:
+    streamed there as it is generated (CLAUDE_STREAM with CLAUDE_ASYNC), otherwise uploaded at
+    the end. metrics, if given, receives the time to first token and the request count, and
+    on_part(group), if given, is called once each group's part is in the bucket.
+    """
+    started = time.monotonic()
+    streaming = bucket is not None and CLAUDE_STREAM and CLAUDE_ASYNC
+    streamed, first_tokens, request_count = set(), [], 0
+    pages = load_pages(image_paths, page_numbers)
+    caching = cache is not None and cache.store is not None
+    if caching:
+        # Before planning, so only the pages that miss are sent, whatever requests they were in before
+        look_up_pages(pages, cache, system_prompt, user_prompt)
+    prompt_tokens = estimate_text_tokens(system_prompt) + estimate_text_tokens(user_prompt) + estimate_text_tokens(PAGE_LABEL_INSTRUCTION)
+    pending = plan_requests(pages, prompt_tokens)
+    logging.info(f"Planned {len(pending)} requests for {len(pages)} pages")
+
+    done = []
+    while pending:
+        requests, batch = [], []
+        for group in pending:
+            if all(page["skip"] or page.get("cached") is not None for page in group):
+                # Nothing to transcribe: cached pages and placeholders are the whole text
+                done.append((group, resolved_text(group)))
+                continue
+            requests.append(build_request(build_image_content(group, user_prompt), system_prompt))
+            batch.append(group)
+
+        request_count += len(requests)
+        if streaming and requests:
+            results, round_first_tokens = stream_requests(requests, batch, api_key, bucket, job_prefix, on_part=on_part)
+            first_tokens += round_first_tokens
+        else:
+            results = send_requests(requests, api_key, [pages_label(group) for group in batch])
+
+        pending = []
+        for group, result in zip(batch, results):
+            if isinstance(result, Exception):
+                logging.error(f"Anthropic API error for {pages_label(group)}: {str(result)}")
+                if streaming:
+                    discard_part(bucket, job_prefix, group)
+                done.append((group, None))
+                continue
+
+            text = result.content[0].text
+            if result.stop_reason == "max_tokens":
+                if not is_complete(group, result):
+                    middle = len(group) // 2
+                    logging.warning(f"Response for {pages_label(group)} hit max_tokens, splitting and retrying")
+                    if streaming:
+                        discard_part(bucket, job_prefix, group)
+                    pending += [group[:middle], group[middle:]]
+                    continue
+                logging.warning(f"Response for {pages_label(group)} hit max_tokens on a single page")
+            elif caching:
+                cache_page_texts(cache, group, text)
+            if streaming:
+                streamed.add(group[0]["number"])
+            done.append((group, text))
+
+    done.sort(key=lambda item: item[0][0]["number"])
+    if bucket is not None:
+        # Cached and placeholder-only groups and unstreamed responses
+        for group, text in done:
+            if text is not None and group[0]["number"] not in streamed:
+                write_part(bucket, job_prefix, group, text)
+                if on_part is not None:
+                    on_part(group)
+
+    if metrics is not None:
+        metrics["requests"] = request_count
+        if first_tokens:
+            metrics["time_to_first_token"] = round(min(first_tokens) - started, 3)
+    return done
+
+def process_images_in_folder(folder_path, api_key, system_prompt, user_prompt, cache=None, bucket=None, job_prefix=None, metrics=None, page_numbers=None, other_parts=None, on_part=None):
+    """
+    Transcribes every JPEG under folder_path (subfolders included, in page order) and writes
+    one response part per request: into folder_path/responses, or with a bucket straight to
+    the job prefix (see ocr_pages). Returns the part names (relative to folder_path / the job
+    prefix) in page order and the page ranges whose request failed.
+
+    page_numbers are the JPEGs' page numbers when they aren't simply 1..n, and other_parts
+    (first page number -> part name) the parts the job already has: text pages, and parts
+    written by an earlier attempt. Those are listed among the parts as they are.
+    on_part(group) is passed to ocr_pages.
+    """
+    other_parts = other_parts or {}
+    try:
+        jpeg_files = glob.glob(os.path.join(folder_path, "**", "*.jpg"), recursive=True) + glob.glob(os.path.join(folder_path, "**", "*.jpeg"), recursive=True)
+        jpeg_files.sort(key=lambda path: natural_key(os.path.relpath(path, folder_path)))
+        if not jpeg_files:
+            logging.info(f"No JPEG files found in {folder_path}. Skipping.")
+            return [other_parts[number] for number in sorted(other_parts)], []
+
+        numbered_parts, failed = list(other_parts.items()), []
+        for group, text in ocr_pages(jpeg_files, api_key, system_prompt, user_prompt, cache=cache, bucket=bucket, job_prefix=job_prefix, metrics=metrics, page_numbers=page_numbers, on_part=on_part):
+            if text is None:
+                failed.append(f"{group[0]['number']}-{group[-1]['number']}")
+                continue
+            numbered_parts.append((group[0]["number"], part_name(group)))
+            if bucket is not None:
+                continue
+            output_file_name = os.path.join(folder_path, part_name(group))
+            os.makedirs(os.path.dirname(output_file_name), exist_ok=True)
             with open(output_file_name, 'w') as output_file:
-                output_file.write(assistant_response)
+                output_file.write(text)
             logging.info(f"Response has been written to {output_file_name}")
-        except anthropic.APIError as e:
-            logging.error(f"Anthropic API error: {str(e)}")
+        return [name for _, name in sorted(numbered_parts)], failed
 
     except Exception as e:
+        # Raised so the event is retried; the retry resumes from the parts already written
         logging.error(f"An error occurred while processing folder {folder_path}: {str(e)}")
         traceback.print_exc()
+        raise
 
 def access_secret_version(secret_id, version_id="latest"):
-    client = secretmanager.SecretManagerServiceClient(credentials=credentials)
-    name = f"projects/{PROJECT_ID}/secrets/{secret_id}/versions/{version_id}"
+    # Served from the warm-instance secret cache; Secret Manager is only hit on a miss or expiry
     try:
-        response = client.access_secret_version(request={"name": name})
-        payload = response.payload.data.decode("UTF-8")
-        return payload
+        return get_secret(PROJECT_ID, secret_id, version_id, credentials=runtime.credentials(SCOPES))
     except Exception as e:
         logging.error(f"Error accessing secret version: {e}")
         raise
@@ -133,31 +481,146 @@ def process_jpegs_in_cloud_storage(event, context):
     file_name = event['name']
     logging.debug(f"Processing file: {file_name}")
 
-    if not file_name.startswith(os.path.join(ATTACHMENT_FOLDER, "images") + "/") or not file_name.lower().endswith('.jpeg'):
-        logging.info(f"Skipping file: {file_name} (not a JPEG in attachments/images folder)")
+    if not file_name.startswith(os.path.join(ATTACHMENT_FOLDER, "images") + "/"):
+        logging.info(f"Skipping file: {file_name} (not in attachments/images folder)")
         return
 
-    api_key = access_secret_version("claude_api_key")
-    system_prompt = access_secret_version("decode_system_prompt")
-    user_prompt = access_secret_version("decode_user_prompt")
-
-    client = anthropic.Anthropic(api_key=api_key)
+    # Page uploads fire this function too; only the job's manifest (written after the last page) starts OCR
+    if not is_manifest(file_name):
+        logging.debug(f"Skipping file: {file_name} (waiting for the job manifest)")
+        return
 
-    storage_client = storage.Client(credentials=credentials)
+    storage_client = clients.storage_client(runtime.credentials(SCOPES))
     bucket = storage_client.bucket(BUCKET_NAME)
-    for folder in bucket.list_blobs(prefix=os.path.join(ATTACHMENT_FOLDER, "images")):
-        if folder.name.endswith('/'):
-            folder_path = "/tmp/" + folder.name 
-            os.makedirs(folder_path, exist_ok=True)
-            logging.info(f"Downloading folder: {folder.name} to {folder_path}")
-
-            for blob in bucket.list_blobs(prefix=folder.name):
-                if not blob.name.endswith('/'):
-                    file_path = os.path.join(folder_path, os.path.basename(blob.name))
-                    blob.download_to_filename(file_path)
-
-            process_images_in_folder(folder_path, client, system_prompt, user_prompt)
-
-            for file in os.listdir(folder_path):
-                os.remove(os.path.join(folder_path, file))
-            os.rmdir(folder_path)
+    manifest = read_manifest(bucket, file_name)
+    tracing.start_trace("ocr", event, job=manifest["job_id"])
+    logging.info(f"Job {manifest['job_id']} complete with {manifest['page_count']} pages, starting OCR")
+
+    if OCR_WORK_TOPIC:
+        queue_job(event, context, manifest)
+        return
+    run_job(bucket, event, context, manifest)
+
+def run_job(bucket, event, context, manifest):
+    # A duplicate delivery is a no-op; a retry resumes from the parts an earlier attempt wrote
+    with job_state.once(bucket, "ocr", event, context) as first:
+        if not first:
+            return
+        state = job_state.JobState(bucket, "ocr", manifest["job_id"], source=manifest["created"])
+        transcribe_job(bucket, job_prefix_of(event["name"]), manifest, state)
+
+def queue_job(event, context, manifest):
+    """
+    Publishes the job to OCR_WORK_TOPIC for the OCR worker (serve_ocr_queue), with its tenant and
+    its page batches as its cost. A failed publish raises, so the storage event is retried.
+    """
+    image_pages = manifest["page_count"] - len(manifest.get("text_pages", []))
+    item = work_queue.WorkItem(
+        "ocr", {"event": {key: event.get(key) for key in ("bucket", "name", "generation", "metadata", "timeCreated")}, "event_id": getattr(context, "event_id", None)},
+        tenant=work_queue.tenant_of(event.get("metadata")), cost=work_queue.page_batches(image_pages),
+    )
+    message_id = work_queue.publish_item(OCR_WORK_TOPIC, item).result(timeout=PUBLISH_TIMEOUT_SECONDS)
+    logging.info(f"Queued job {manifest['job_id']} on {OCR_WORK_TOPIC} for {item.tenant} (cost {item.cost}): message {message_id}")
+
+def handle_work_item(item):
+    """Transcribes a job queued by queue_job, as the storage trigger would have."""
+    event = item.payload["event"]
+    # The storage event's ID, so duplicate deliveries of the trigger still run the job once
+    context = SimpleNamespace(event_id=item.payload.get("event_id"))
+    bucket = clients.storage_client(runtime.credentials(SCOPES)).bucket(BUCKET_NAME)
+    manifest = read_manifest(bucket, event["name"])
+    tracing.start_trace("ocr", event, job=manifest["job_id"])
+    run_job(bucket, event, context, manifest)
+
+def serve_ocr_queue():
+    """
+    The OCR worker: pulls the jobs queue_job published from OCR_WORK_SUBSCRIPTION and transcribes
+    up to OCR_WORKERS at a time, fair-shared between tenants and capped at the page batches the
+    model rate limit sustains (common/work_queue.py). Runs until stopped.
+    """
+    work_queue.subscribe(OCR_WORK_SUBSCRIPTION, handle_work_item, workers=OCR_WORKERS)
+
+def transcribe_job(bucket, job_prefix, manifest, state):
+    """
+    Transcribes a job's image pages and writes the responses manifest. Every part is recorded
+    in state once it is in the bucket, and pages covered by recorded parts are not sent again.
+    If any request failed, no manifest is written and RuntimeError is raised, so the delivery
+    is retried for the missing pages.
+    """
+    # Parts the job already has: pages whose text the producer extracted, and earlier attempts' parts
+    other_parts = {page["number"]: page["path"] for page in manifest.get("text_pages", [])}
+    done_pages = set(other_parts)
+    for unit, (first_page, last_page) in state.units.items():
+        other_parts[first_page] = unit[len("part:"):]
+        done_pages.update(range(first_page, last_page + 1))
+
+    # Only image pages without a part go to the model
+    image_pages = [page for subfolder in manifest["subfolders"] for page in subfolder["pages"]]
+    remaining = [(number, page) for number, page in zip(image_page_numbers(manifest), image_pages) if number not in done_pages]
+    if len(remaining) < len(image_pages):
+        logging.info(f"Job {manifest['job_id']}: {len(image_pages) - len(remaining)} image pages were transcribed by an earlier attempt")
+    if remaining:
+        api_key = access_secret_version("claude_api_key")
+        system_prompt = access_secret_version("decode_system_prompt")
+        user_prompt = access_secret_version("decode_user_prompt")
+    else:
+        api_key = system_prompt = user_prompt = None
+
+    def record(group):
+        state.complete(f"part:{part_name(group)}", [group[0]["number"], group[-1]["number"]])
+
+    numbered_parts, failed = dict(other_parts), []
+    with scratch.workspace("ocr", manifest["job_id"]) as workspace, BulkTransfer(bucket) as transfer:
+        # Pages are downloaded and transcribed in windows that fit the scratch budget, each window's
+        # files removed before the next; a job that fits (the usual case) is a single window
+        window = max(1, min(len(remaining), workspace.available() // PAGE_SCRATCH_BYTES)) if remaining else 1
+        if window < len(remaining):
+            logging.info(f"Job {manifest['job_id']}: transcribing {len(remaining)} pages in windows of {window} to stay within the scratch budget")
+
+        cache = cache_from_env(bucket)
+        metrics = {}
+        # Streamed responses land in the bucket as they are generated; otherwise they are uploaded below
+        output_bucket = bucket if CLAUDE_STREAM else None
+        for start in range(0, len(remaining), window):
+            pages = remaining[start:start + window]
+            workspace.reserve(len(pages) * PAGE_SCRATCH_BYTES)
+            job_path = workspace.join(f"pages_{start + 1:04d}", "")
+
+            # Download the pages still to transcribe; only the pages the manifest lists, no prefix listing
+            logging.info(f"Downloading {len(pages)} pages of job {job_prefix} to {job_path}")
+            for _, page in pages:
+                transfer.download_file(os.path.join(job_prefix, page), os.path.join(job_path, page))
+            transfer.wait()
+
+            parts, window_failed = process_images_in_folder(
+                job_path, api_key, system_prompt, user_prompt, cache=cache, bucket=output_bucket, job_prefix=job_prefix,
+                metrics=metrics, page_numbers=[number for number, _ in pages], on_part=record,
+            )
+            failed += window_failed
+
+            if output_bucket is None:
+                for part in parts:
+                    # Upload the responses under the job prefix so the concatenation stage picks them up
+                    transfer.upload_file(os.path.join(job_path, part), job_prefix + part, content_type="text/plain")
+                transfer.wait()
+                for part in parts:
+                    state.complete(f"part:{part}", list(part_pages(part)))
+            numbered_parts.update((part_pages(part)[0], part) for part in parts)
+
+            shutil.rmtree(job_path, ignore_errors=True)
+            workspace.release(len(pages) * PAGE_SCRATCH_BYTES)
+        logging.info(f"OCR cache for job {manifest['job_id']}: {cache.stats()}")
+        logging.info(f"OCR metrics for job {manifest['job_id']}: {metrics}")
+        state.flush()
+
+        # The parts that did succeed are checkpointed above, so the retry only requests these pages again
+        if failed:
+            raise RuntimeError(f"Job {manifest['job_id']} has no OCR text for pages {', '.join(failed)}")
+
+        parts = [numbered_parts[number] for number in sorted(numbered_parts)]
+        if parts:
+            # Written last: the concatenation stage assembles the job on this event alone
+            write_responses_manifest(transfer, job_prefix, manifest["job_id"], parts)
+
+if __name__ == "__main__":
+    serve_ocr_queue()
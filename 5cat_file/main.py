@@ -1,33 +1,20 @@
 import os
 import logging
-from google.cloud import storage
-from google.oauth2 import service_account
-from dotenv import load_dotenv
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+from common import clients, job_state, runtime, tracing
+from common.gcs_transfer import compose_in_order
+from common.job_manifest import is_responses_manifest, job_prefix_of, read_manifest
 
-# Load environment variables from .env file
-logging.debug("Loading environment variables from .env file")
-load_dotenv()
+# Logging and .env only; credentials and SDK clients are created on first use (common/runtime.py)
+runtime.setup()
 
-# Load credentials from the JSON key file
-SERVICE_ACCOUNT_FILE = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
 SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
 
-logging.debug(f"Service Account File: {SERVICE_ACCOUNT_FILE}")
-logging.debug(f"Scopes: {SCOPES}")
-
-try:
-    credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    logging.debug("Service account credentials loaded successfully")
-except Exception as e:
-    logging.error(f"Error loading service account credentials: {e}")
-    raise
-
 # Cloud Storage settings
 BUCKET_NAME = "bonesjustice"
 ATTACHMENT_FOLDER = "attachments"
+SEPARATOR_NAME = "responses/separator"  # Temporary object composed between parts
+PART_SEPARATOR = "\n\n"  # Add separator between files
 
 logging.debug(f"Cloud Storage Bucket: {BUCKET_NAME}")
 
@@ -43,33 +30,48 @@ def concatenate_text_files(event, context):
     file_name = event['name']
     logging.debug(f"Processing file: {file_name}")
 
-    # Check if the file is a text file in the attachments/images folder
-    if not file_name.startswith(os.path.join(ATTACHMENT_FOLDER, "images")) or not file_name.lower().endswith('.txt'):
-        logging.info(f"Skipping file: {file_name} (not a text file in attachments/images folder)")
+    if not file_name.startswith(os.path.join(ATTACHMENT_FOLDER, "images") + "/"):
+        logging.info(f"Skipping file: {file_name} (not in attachments/images folder)")
+        return
+
+    # Each response part fires this function too; only the responses manifest (written after the last part) starts assembly
+    if not is_responses_manifest(file_name):
+        logging.debug(f"Skipping file: {file_name} (waiting for the responses manifest)")
         return
 
-    # Initialize Cloud Storage client
-    storage_client = storage.Client(credentials=credentials)
+    # Cloud Storage client, reused across events on a warm instance
+    storage_client = clients.storage_client(runtime.credentials(SCOPES))
     bucket = storage_client.bucket(BUCKET_NAME)
 
-    # Extract the original ZIP filename from the text file's path
-    original_zip_filename = file_name.split("/")[2]  
+    job_prefix = job_prefix_of(file_name)
+    manifest = read_manifest(bucket, file_name)
+    original_zip_filename = manifest["job_id"]
+    tracing.start_trace("concatenate", event, job=original_zip_filename)
 
     # Create a unique folder for the concatenated output
     output_folder_name = f"concatenated_text/{original_zip_filename}"
-
-    # List all text files associated with the same original ZIP upload
-    text_files = list(bucket.list_blobs(prefix=os.path.join(ATTACHMENT_FOLDER, "images", original_zip_filename)))
-
-    # Concatenate the content of all text files
-    concatenated_content = ""
-    for text_file in text_files:
-        if text_file.name.lower().endswith('.txt'):
-            logging.info(f"Concatenating: {text_file.name}")
-            concatenated_content += text_file.download_as_string().decode("utf-8") + "\n\n"  # Add separator between files
-
-    # Upload the concatenated content to the new folder
-    output_blob = bucket.blob(os.path.join(output_folder_name, f"{original_zip_filename}_concatenated.txt"))
-    output_blob.upload_from_string(concatenated_content)
-
-    logging.info(f"Concatenated text files for {original_zip_filename} into {output_blob.name}")
\ No newline at end of file
+    output_blob_name = os.path.join(output_folder_name, f"{original_zip_filename}_concatenated.txt")
+
+    if manifest["failed"]:
+        logging.warning(f"Job {original_zip_filename} has no OCR text for pages {', '.join(manifest['failed'])}")
+
+    # A duplicate delivered while this one runs would delete the separator under it. A rewritten
+    # responses manifest is a new event and replaces the output, so its job is assembled again.
+    with job_state.once(bucket, "concatenate", event, context) as first:
+        if not first:
+            return
+
+        # Server-side compose in page order, with a separator object between parts; nothing is downloaded
+        separator_name = job_prefix + SEPARATOR_NAME
+        bucket.blob(separator_name).upload_from_string(PART_SEPARATOR, content_type="text/plain")
+        sources = []
+        for part in manifest["parts"]:
+            logging.info(f"Concatenating: {part}")
+            sources += [job_prefix + part, separator_name]
+
+        try:
+            compose_in_order(bucket, sources, output_blob_name, content_type="text/plain")
+        finally:
+            bucket.blob(separator_name).delete()
+
+    logging.info(f"Concatenated {len(manifest['parts'])} text files for {original_zip_filename} into {output_blob_name}")
@@ -1,43 +1,47 @@
 import os
 import logging
-import openai
-import glob
-import base64
-from PIL import Image
-import io
+import re
 import time
 import traceback
+from functools import lru_cache, partial
 
-from google.cloud import storage
-from google.oauth2 import service_account
-from dotenv import load_dotenv
-from google.cloud import secretmanager
+from common import clients, job_state, report_index, runtime, tracing
+from common.gcs_transfer import BulkTransfer, open_blob_writer
+from common.secret_cache import get_secret
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+# Logging and .env only; credentials and SDK clients are created on first use (common/runtime.py)
+runtime.setup()
 
-# Load environment variables from .env file
-logging.debug("Loading environment variables from .env file")
-load_dotenv()
-
-# Load credentials from the JSON key file
-SERVICE_ACCOUNT_FILE = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
 SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
 
-logging.debug(f"Service Account File: {SERVICE_ACCOUNT_FILE}")
-logging.debug(f"Scopes: {SCOPES}")
-
-try:
-    credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    logging.debug("Service account credentials loaded successfully")
-except Exception as e:
-    logging.error(f"Error loading service account credentials: {e}")
-    raise
-
 # Cloud Storage and Secret Manager settings
 BUCKET_NAME = "bonesjustice"
 ATTACHMENT_FOLDER = "attachments"
 PROJECT_ID = os.getenv('PROJECT_ID')
+CONCATENATED_FOLDER = "concatenated_text"
+
+# ChatGPT settings
+CHATGPT_MODEL = os.getenv('CHATGPT_MODEL', 'gpt-3.5-turbo')
+CHATGPT_CONTEXT_WINDOW = int(os.getenv('CHATGPT_CONTEXT_WINDOW', '16385'))
+REPORT_MAX_TOKENS = 4096
+CHATGPT_STREAM = os.getenv('CHATGPT_STREAM', '1') == '1'  # Stream the report straight into its GCS upload
+
+# Map-reduce settings for transcripts that don't fit one request
+CHUNK_TOKENS = int(os.getenv('WIZARD_CHUNK_TOKENS', '8000'))
+CHUNK_OVERLAP_TOKENS = int(os.getenv('WIZARD_CHUNK_OVERLAP_TOKENS', '200'))
+MAP_MAX_TOKENS = int(os.getenv('WIZARD_MAP_MAX_TOKENS', '1500'))
+MAP_CONCURRENCY = int(os.getenv('WIZARD_CONCURRENCY', '4'))
+MAX_REDUCE_ROUNDS = 3
+PROMPT_MARGIN_TOKENS = 100  # Chat formatting overhead per request
+MAP_INSTRUCTIONS = (
+    "You are given one part of a longer document transcript, together with the instructions for a report "
+    "that will be written from the whole document. Extract every fact, finding, score, date, name and quotation "
+    "from this part that the report could need, as concise notes in document order. Keep page references. "
+    "Do not write the report itself and do not add anything that is not in the text."
+)
+
+# A paragraph starting with a page label, a placeholder, a markdown heading or an all-caps title begins a new section
+SECTION_START = re.compile(r"^(Image \d+:|\[Page \d+|#{1,6} |[A-Z][A-Z0-9 ,.&/()'-]{3,}$)")
 
 logging.debug(f"Cloud Storage Bucket: {BUCKET_NAME}")
 
@@ -50,78 +54,245 @@ def process_images_in_folder(folder_path, client, system_prompt, user_prompt):
     pass
 
 def access_secret_version(secret_id, version_id="latest"):
-    client = secretmanager.SecretManagerServiceClient(credentials=credentials)
-    name = f"projects/{PROJECT_ID}/secrets/{secret_id}/versions/{version_id}"
+    # Served from the warm-instance secret cache; Secret Manager is only hit on a miss or expiry
     try:
-        response = client.access_secret_version(request={"name": name})
-        payload = response.payload.data.decode("UTF-8")
-        return payload
+        return get_secret(PROJECT_ID, secret_id, version_id, credentials=runtime.credentials(SCOPES))
     except Exception as e:
         logging.error(f"Error accessing secret version: {e}")
         raise
 
 def get_chatgpt_response(messages, system_prompt):
     """Get a response from ChatGPT."""
+    import openai
+
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",  
-            messages=messages,
-            max_tokens=4096,
-            temperature=0.0
-        )
+        with tracing.span("chat.completions.create", request="report") as span:
+            response = openai.ChatCompletion.create(
+                model=CHATGPT_MODEL,
+                messages=messages,
+                max_tokens=REPORT_MAX_TOKENS,
+                temperature=0.0
+            )
+            span.update(input_tokens=response.usage.prompt_tokens, output_tokens=response.usage.completion_tokens)
         return response.choices[0].message.content
     except Exception as e:
         logging.error(f"Error getting response from ChatGPT: {e}")
         raise
 
-def process_text_file(file_name, system_prompt):
-    logging.info(f"Processing file: {file_name}")
+def stream_chatgpt_response(messages, open_writer, metrics=None):
+    """
+    Streams a response into a writer from open_writer() as it is generated and returns the text.
+    The writer is opened on the first token; metrics, if given, receives the time to it.
+    """
+    import openai
 
-    storage_client = storage.Client(credentials=credentials)
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(file_name)
+    started = time.monotonic()
+    writer, pieces = None, []
+    try:
+        with tracing.span("chat.completions.stream", request="report", bytes=0) as span:
+            response = openai.ChatCompletion.create(
+                model=CHATGPT_MODEL,
+                messages=messages,
+                max_tokens=REPORT_MAX_TOKENS,
+                temperature=0.0,
+                stream=True
+            )
+            for chunk in response:
+                choice = chunk.choices[0]
+                if choice.finish_reason == "length":
+                    logging.warning(f"Response hit max_tokens ({REPORT_MAX_TOKENS}) and is truncated")
+                text = choice.delta.get("content")
+                if not text:
+                    continue
+                if writer is None:
+                    span["time_to_first_token_ms"] = round((time.monotonic() - started) * 1000, 1)
+                    if metrics is not None:
+                        metrics["time_to_first_token"] = round(time.monotonic() - started, 3)
+                    writer = open_writer()
+                data = text.encode("utf-8")
+                writer.write(data)
+                span["bytes"] += len(data)
+                pieces.append(text)
+        if writer is None:
+            writer = open_writer()
+        writer.close()
+    except Exception as e:
+        logging.error(f"Error streaming response from ChatGPT: {e}")
+        if writer is not None and not writer.closed:
+            writer.close()  # The caller deletes the partial object
+        raise
+    if metrics is not None:
+        metrics["generation_seconds"] = round(time.monotonic() - started, 3)
+    return "".join(pieces)
 
-    # Download the text file to a temporary location
-    temp_file_path = f"/tmp/{file_name.split('/')[-1]}"
-    blob.download_to_filename(temp_file_path)
+@lru_cache(maxsize=None)
+def get_encoding():
+    import tiktoken
 
     try:
-        with open(temp_file_path, 'r', encoding="utf-8-sig") as f:
-            user_prompt = f.read().strip()
+        return tiktoken.encoding_for_model(CHATGPT_MODEL)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+def count_tokens(text):
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+def split_sections(text, max_tokens):
+    """
+    Splits text into paragraphs as (text, tokens, starts_section) units. A paragraph longer
+    than max_tokens is cut into max_tokens pieces, so every unit fits in a chunk.
+    """
+    units = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        starts_section = bool(SECTION_START.match(paragraph))
+        tokens = get_encoding().encode(paragraph, disallowed_special=())
+        for i in range(0, len(tokens), max_tokens):
+            piece = tokens[i:i + max_tokens]
+            units.append((get_encoding().decode(piece), len(piece), starts_section and i == 0))
+    return units
+
+def chunk_transcript(text, chunk_tokens=CHUNK_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """
+    Packs paragraphs into chunks of at most chunk_tokens. A chunk ends at the last section start
+    that keeps it at least half full, or else at a paragraph boundary. Each chunk after the first
+    repeats up to overlap_tokens of paragraphs from the end of the one before it.
+    """
+    units = split_sections(text, chunk_tokens)
+    chunks = []
+    start = 0
+    while start < len(units):
+        end, size = start, 0
+        while end < len(units) and size + units[end][1] <= chunk_tokens:
+            size += units[end][1]
+            end += 1
+
+        if end < len(units):
+            prefix = size
+            for j in range(end - 1, start, -1):
+                prefix -= units[j][1]
+                if units[j][2] and prefix >= chunk_tokens // 2:
+                    end = j
+                    break
 
-        output_file = os.path.join("/tmp", 'Mindset.html') 
+        chunks.append("\n\n".join(unit[0] for unit in units[start:end]))
+        if end >= len(units):
+            break
 
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
+        next_start, overlap = end, 0
+        while next_start - 1 > start and overlap + units[next_start - 1][1] <= overlap_tokens:
+            next_start -= 1
+            overlap += units[next_start][1]
+        start = next_start
+    return chunks
 
-        assistant_response = get_chatgpt_response(messages, system_prompt)
-        
-        with open(output_file, 'w', encoding="utf-8") as f:
-            f.write(assistant_response)
+def map_chunks(chunks, system_prompt, api_key):
+    """Runs the extraction prompt over every chunk concurrently; returns the notes in chunk order."""
+    from common.openai_async import run_chat_completions
 
-        logging.info(f"The complete response has been saved to {output_file}")
+    requests = [
+        {
+            "model": CHATGPT_MODEL,
+            "messages": [
+                {"role": "system", "content": MAP_INSTRUCTIONS},
+                {"role": "user", "content": f"Report instructions:\n{system_prompt}\n\nTranscript part {i} of {len(chunks)}:\n{chunk}"},
+            ],
+            "max_tokens": MAP_MAX_TOKENS,
+            "temperature": 0.0,
+        }
+        for i, chunk in enumerate(chunks, 1)
+    ]
+    labels = [f"part {i} of {len(chunks)}" for i in range(1, len(chunks) + 1)]
+    results = run_chat_completions(requests, api_key, concurrency=MAP_CONCURRENCY, labels=labels)
 
-        # Upload the output HTML file to a new folder in Cloud Storage
-        original_zip_filename = file_name.split("/")[2]
-        output_file_name = f'Youre_A_Wizard_Harry_{original_zip_filename}.html'
-        output_folder_name = f"chatgpt_output/{original_zip_filename}"
-        output_blob = bucket.blob(os.path.join(output_folder_name, output_file_name))
-        output_blob.upload_from_filename(output_file)
-        logging.info(f"Uploaded HTML file to Cloud Storage: {output_blob.name}")
+    notes = []
+    for label, result in zip(labels, results):
+        if isinstance(result, Exception):
+            # A missing part would silently drop findings from the report
+            raise RuntimeError(f"ChatGPT extraction failed for {label}: {result}")
+        notes.append(f"## {label.capitalize()}\n{result.choices[0].message.content.strip()}")
+    return notes
+
+def summarize_transcript(transcript, system_prompt, api_key, open_writer=None, metrics=None):
+    """
+    Writes the report for a transcript. One that fits in a single request is sent as before;
+    a longer one is chunked, its chunks are extracted concurrently (map), and the notes are
+    merged into the report by one final request (reduce). Notes that are still too long are
+    chunked and extracted again, up to MAX_REDUCE_ROUNDS times.
+    With open_writer, the report is streamed into it as it is generated (see stream_chatgpt_response).
+    """
+    budget = CHATGPT_CONTEXT_WINDOW - REPORT_MAX_TOKENS - count_tokens(system_prompt) - PROMPT_MARGIN_TOKENS
+    chunk_tokens = min(CHUNK_TOKENS, CHATGPT_CONTEXT_WINDOW - MAP_MAX_TOKENS - count_tokens(system_prompt + MAP_INSTRUCTIONS) - PROMPT_MARGIN_TOKENS)
+
+    text = transcript
+    for round_number in range(MAX_REDUCE_ROUNDS + 1):
+        tokens = count_tokens(text)
+        if tokens <= budget:
+            break
+        if round_number == MAX_REDUCE_ROUNDS:
+            raise RuntimeError(f"Notes still {tokens} tokens after {MAX_REDUCE_ROUNDS} rounds, over the {budget} token budget")
+        chunks = chunk_transcript(text, chunk_tokens, CHUNK_OVERLAP_TOKENS)
+        logging.info(f"Map round {round_number + 1}: {tokens} tokens in {len(chunks)} chunks")
+        text = "\n\n".join(map_chunks(chunks, system_prompt, api_key))
+
+    if round_number > 0:
+        text = f"Notes extracted from the transcript, in document order:\n\n{text}"
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": text}
+    ]
+    if open_writer is not None:
+        return stream_chatgpt_response(messages, open_writer, metrics)
+    return get_chatgpt_response(messages, system_prompt)
+
+def process_text_file(file_name, system_prompt, api_key):
+    logging.info(f"Processing file: {file_name}")
+
+    storage_client = clients.storage_client(runtime.credentials(SCOPES))
+    bucket = storage_client.bucket(BUCKET_NAME)
+    transfer = BulkTransfer(bucket, max_workers=1)
+
+    # Output HTML file in a new folder in Cloud Storage
+    original_zip_filename = file_name.split("/")[1]
+    output_file_name = f'Youre_A_Wizard_Harry_{original_zip_filename}.html'
+    output_folder_name = f"chatgpt_output/{original_zip_filename}"
+    output_blob_name = os.path.join(output_folder_name, output_file_name)
+
+    try:
+        # The transcript is read into memory and the report never touches /tmp
+        user_prompt = transfer.download_bytes(file_name).result().decode("utf-8-sig").strip()
+
+        metrics = {}
+        if CHATGPT_STREAM:
+            open_writer = partial(open_blob_writer, bucket, output_blob_name, "text/html")
+            summarize_transcript(user_prompt, system_prompt, api_key, open_writer=open_writer, metrics=metrics)
+        else:
+            assistant_response = summarize_transcript(user_prompt, system_prompt, api_key)
+            transfer.upload_bytes(assistant_response.encode("utf-8"), output_blob_name, content_type="text/html").result()
+        logging.info(f"Uploaded HTML file to Cloud Storage: {output_blob_name}")
+
+        # Lets 7email find the report when it sends the recipient's other reports
+        recipient = report_index.recipient_for(output_blob_name, tracing.object_metadata())
+        if recipient:
+            report_index.add(bucket, output_blob_name, recipient)
+        logging.info(f"Report metrics for {original_zip_filename}: {metrics}")
 
     except Exception as e:
         logging.error(f"An error occurred while processing file {file_name}:")
         logging.error(str(e))
         logging.error("Traceback:")
         traceback.print_exc()
+        # A failed stream may have finalized a partial report
+        output_blob = bucket.blob(output_blob_name)
+        if CHATGPT_STREAM and output_blob.exists():
+            output_blob.delete()
+        # Raised so the event is retried instead of recorded as done
+        raise
 
     finally:
-        # Clean up temporary files
-        os.remove(temp_file_path)
-        if os.path.exists(output_file):
-            os.remove(output_file)
+        transfer.close()
 
 def process_text_files_in_cloud_storage(event, context):
     logging.debug(f"Event: {event}")
@@ -130,14 +301,24 @@ def process_text_files_in_cloud_storage(event, context):
     file_name = event['name']
     logging.debug(f"Processing file: {file_name}")
 
-    if not file_name.startswith(os.path.join(ATTACHMENT_FOLDER, "images")) or not file_name.lower().endswith('.txt'):
-        logging.info(f"Skipping file: {file_name} (not a text file in attachments/images folder)")
+    # The whole transcript, as assembled by the concatenation stage
+    if not file_name.startswith(CONCATENATED_FOLDER + "/") or not file_name.lower().endswith('.txt'):
+        logging.info(f"Skipping file: {file_name} (not a text file in {CONCATENATED_FOLDER} folder)")
         return
 
-    # Get secrets from Secret Manager
-    api_key = access_secret_version("chatgpt_api_key")
-    system_prompt = access_secret_version("chatgpt_system_prompt")
+    tracing.start_trace("report", event, job=file_name.split("/")[1])
+
+    # A duplicate delivery would bill the whole report again
+    bucket = clients.storage_client(runtime.credentials(SCOPES)).bucket(BUCKET_NAME)
+    with job_state.once(bucket, "report", event, context) as first:
+        if not first:
+            return
+
+        # Get secrets from Secret Manager
+        api_key = access_secret_version("chatgpt_api_key")
+        system_prompt = access_secret_version("chatgpt_system_prompt")
 
-    openai.api_key = api_key
+        import openai
+        openai.api_key = api_key
 
-    process_text_file(file_name, system_prompt)
+        process_text_file(file_name, system_prompt, api_key)
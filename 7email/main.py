@@ -1,70 +1,79 @@
 import os
 import logging
-from google.cloud import storage
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
-from dotenv import load_dotenv
-
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-
-# Load environment variables from .env file
-logging.debug("Loading environment variables from .env file")
-load_dotenv()
-
-# Load credentials from the JSON key file
-SERVICE_ACCOUNT_FILE = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
-SCOPES = ['https://www.googleapis.com/auth/cloud-platform', 
-          'https://www.googleapis.com/auth/gmail.send']  # Add Gmail send scope
-
-logging.debug(f"Service Account File: {SERVICE_ACCOUNT_FILE}")
-logging.debug(f"Scopes: {SCOPES}")
-
-try:
-    credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    logging.debug("Service account credentials loaded successfully")
-except Exception as e:
-    logging.error(f"Error loading service account credentials: {e}")
-    raise
+import datetime
+
+from common import clients, job_state, report_index, runtime, tracing
+from common.gcs_transfer import BulkTransfer
+from common.gmail_delivery import GMAIL_SCOPES, DeliveryError, Outbox
+from common.report_index import recipient_for
+
+# Logging and .env only; credentials and SDK clients are created on first use (common/runtime.py)
+runtime.setup()
+
+SCOPES = ['https://www.googleapis.com/auth/cloud-platform'] + GMAIL_SCOPES  # Add Gmail send scope
 
 # Cloud Storage settings
 BUCKET_NAME = "bonesjustice"
 ATTACHMENT_FOLDER = "attachments"
+REPORT_FOLDERS = ("chatgpt_output/", "claude_output/")  # 6wizard writes chatgpt_output/; claude_output/ is the older name
 
-logging.debug(f"Cloud Storage Bucket: {BUCKET_NAME}")
-
-def send_email_with_html_attachment(sender_email, html_file_path):
-    """Sends an email with the generated HTML file attached to the original sender."""
+# Delivery settings
+REPORT_CLAIM_FOLDER = "job_state/email/reports/"  # <claim folder><report name>: the report is being, or has been, sent
+REPORT_CLAIM_STALE_SECONDS = int(os.getenv('REPORT_CLAIM_STALE_SECONDS', '900'))
+MAX_REPORTS_PER_MESSAGE = int(os.getenv('MAX_REPORTS_PER_MESSAGE', '10'))
 
-    # Build the Gmail service
-    service = build('gmail', 'v1', credentials=credentials)
+logging.debug(f"Cloud Storage Bucket: {BUCKET_NAME}")
 
-    # Create the email message
-    message = MIMEMultipart()
-    message['to'] = sender_email
-    message['from'] = 'coop@farehard.com'
-    message['subject'] = 'Your processed attachment'
+_outbox = None
 
-    # Attach the HTML file
-    with open(html_file_path, 'r', encoding="utf-8") as f:
-        html_content = f.read()
+def is_report(name):
+    return name.startswith(REPORT_FOLDERS) and name.lower().endswith('.html')
 
-    msg_html = MIMEText(html_content, 'html')
-    message.attach(msg_html)
+def report_bucket():
+    # Cloud Storage client, reused across events on a warm instance
+    return clients.storage_client(runtime.credentials(SCOPES)).bucket(BUCKET_NAME)
 
-    # Encode the message
-    raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
+def claim_report(bucket, name):
+    return job_state.claim(bucket, REPORT_CLAIM_FOLDER + name, REPORT_CLAIM_STALE_SECONDS)
 
-    # Send the email
-    try:
-        message = (service.users().messages().send(userId='me', body={'raw': raw_message}).execute())
-        logging.info(f"Email sent successfully to {sender_email} with message ID: {message['id']}")
-    except Exception as e:
-        logging.error(f"Error sending email: {e}")
+def gather_reports(bucket, recipient, names):
+    """
+    The recipient's other reports whose own events haven't claimed them yet, claimed so they go
+    out in this message; their events then find them claimed and skip them. Only the recipient's
+    entries in the report index are listed (common/report_index.py), not the report folders.
+    """
+    reports = []
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for name, entry in report_index.pending(bucket, recipient):
+        if len(names) + len(reports) >= MAX_REPORTS_PER_MESSAGE:
+            break
+        if name in names:
+            continue
+        if entry.updated is not None and (now - entry.updated).total_seconds() > REPORT_CLAIM_STALE_SECONDS:
+            report_index.remove(bucket, name, recipient)  # Its own event has long since run
+            continue
+        # Any claim, even a stale one, means the report was sent or its event is sending it
+        if bucket.get_blob(REPORT_CLAIM_FOLDER + name) is not None:
+            report_index.remove(bucket, name, recipient)
+            continue
+        if not claim_report(bucket, name):
+            continue
+        blob = bucket.get_blob(name)
+        if blob is None:
+            job_state.release(bucket, REPORT_CLAIM_FOLDER + name)
+            report_index.remove(bucket, name, recipient)
+            continue
+        reports.append((name, blob.download_as_bytes()))
+    if reports:
+        logging.info(f"Sending {len(reports)} more report(s) to {recipient} in the same message: {[name for name, _ in reports]}")
+    return reports
+
+def outbox():
+    """The instance's outbox; its send pool and Gmail connections are reused across invocations."""
+    global _outbox
+    if _outbox is None:
+        _outbox = Outbox(runtime.credentials(SCOPES), gather=lambda recipient, names: gather_reports(report_bucket(), recipient, names))
+    return _outbox
 
 def email_generated_html(event, context):
     """Triggered by a change to a Cloud Storage bucket.
@@ -78,25 +87,42 @@ def email_generated_html(event, context):
     file_name = event['name']
     logging.debug(f"Processing file: {file_name}")
 
-    # Check if the file is an HTML file in the claude_output folder
-    if not file_name.startswith("claude_output/") or not file_name.lower().endswith('.html'):
-        logging.info(f"Skipping file: {file_name} (not an HTML file in claude_output folder)")
+    # Check if the file is an HTML report from the report stage
+    if not is_report(file_name):
+        logging.info(f"Skipping file: {file_name} (not an HTML file in {' or '.join(REPORT_FOLDERS)})")
         return
 
-    # Extract sender's email from file path (adjust this logic as needed based on your file naming)
-    sender_email = file_name.split('_')[2]  # Assuming format: claude_output/<zip_filename>/Youre_A_Wizard_Harry_<sender_email>_<rest_of_filename>.html
-
-    # Initialize Cloud Storage client
-    storage_client = storage.Client(credentials=credentials)
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(file_name)
+    tracing.start_trace("email", event, job=file_name.split('/')[1])
 
-    # Download the HTML file to a temporary location
-    temp_file_path = f"/tmp/{file_name.split('/')[-1]}"
-    blob.download_to_filename(temp_file_path)
-
-    # Send the email
-    send_email_with_html_attachment(sender_email, temp_file_path)
+    sender_email = recipient_for(file_name, event.get('metadata'))
+    if sender_email is None:
+        logging.error(f"No recipient for {file_name}: the upload carried no sender and the file name holds no address")
+        return
 
-    # Clean up the temporary file
-    os.remove(temp_file_path)
\ No newline at end of file
+    bucket = report_bucket()
+
+    # A duplicate delivery would send the email twice
+    with job_state.once(bucket, "email", event, context) as first:
+        if not first:
+            return
+
+        # Reports sent along with another one's message are already claimed
+        if not claim_report(bucket, file_name):
+            logging.info(f"Skipping file: {file_name} (already sent, or being sent, with another report)")
+            return
+
+        with BulkTransfer(bucket, max_workers=1) as transfer:
+            html = transfer.download_bytes(file_name).result()
+
+        # Adds latency to every delivery: the report waits out the coalescing window, up to
+        # GMAIL_COALESCE_SECONDS (5 by default, 0 sends at once), for other reports to the same recipient
+        try:
+            message_id, names = outbox().submit(sender_email, file_name, html).result()
+        except DeliveryError as e:
+            # Every report in the message goes back to its own event's retry
+            for name in e.names:
+                job_state.release(bucket, REPORT_CLAIM_FOLDER + name)
+            raise
+        for name in names:
+            report_index.remove(bucket, name, sender_email)
+        logging.info(f"Delivered {file_name} to {sender_email} in message {message_id} ({len(names)} report(s))")
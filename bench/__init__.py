@@ -0,0 +1,4 @@
+"""
+Benchmarks and local stand-ins for the services the pipeline talks to. Run from the repository root,
+e.g. python -m bench.bench_gcs_transfer
+"""
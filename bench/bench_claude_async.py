@@ -0,0 +1,74 @@
+"""
+Runs a job's worth of OCR requests against the fake Messages endpoint, one at a time
+(the old serial loop) and through common.claude_async, and checks results come back in page order.
+
+    python -m bench.bench_claude_async --folders 20 --latency-ms 300 --error-rate 0.2
+"""
+import argparse
+import json
+import os
+import time
+
+import anthropic
+
+from bench.fake_anthropic import FakeAnthropicServer
+from common import claude_async
+
+def build_requests(folders):
+    return [
+        {
+            "model": "claude-3-5-sonnet-20240620",
+            "max_tokens": 8192,
+            "system": "Transcribe the pages.",
+            "messages": [{"role": "user", "content": [
+                {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": "AAAA"}},
+                {"type": "text", "text": f"subfolder_{i + 1:02d}"},
+            ]}],
+        }
+        for i in range(folders)
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--folders", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--error-rate", type=float, default=0.2)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    latency = (args.latency_ms / 2000, args.latency_ms / 1000 * 1.5)
+    requests = build_requests(args.folders)
+    results = {}
+
+    server = FakeAnthropicServer(latency_seconds=latency, error_rate=args.error_rate).start()
+    os.environ["ANTHROPIC_BASE_URL"] = server.url
+    try:
+        client = anthropic.Anthropic(api_key="fake", max_retries=10)
+        start = time.perf_counter()
+        for request in requests:
+            client.messages.create(**request)
+        results["serial"] = {"seconds": round(time.perf_counter() - start, 3), "calls": server.calls}
+
+        server.calls = server.errors = 0
+        start = time.perf_counter()
+        messages = claude_async.run_messages(requests, "fake", concurrency=args.concurrency)
+        failures = [m for m in messages if isinstance(m, Exception)]
+        in_order = all(
+            not isinstance(m, Exception) and m.content[0].text.endswith(f"subfolder_{i + 1:02d}")
+            for i, m in enumerate(messages)
+        )
+        results["async"] = {
+            "seconds": round(time.perf_counter() - start, 3),
+            "calls": server.calls,
+            "injected_errors": server.errors,
+            "failures": len(failures),
+            "in_page_order": in_order,
+        }
+    finally:
+        server.stop()
+
+    results["speedup"] = round(results["serial"]["seconds"] / results["async"]["seconds"], 1)
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Compares the old one-blob-at-a-time upload loop with common.gcs_transfer.BulkTransfer
+against the in-memory fake bucket.
+
+    python -m bench.bench_gcs_transfer --files 200 --size-kb 300 --latency-ms 30
+"""
+import argparse
+import json
+import os
+import time
+
+from bench.fake_gcs import FakeBucket
+from common.gcs_transfer import BulkTransfer
+
+def bench_sequential(bucket, payloads):
+    start = time.perf_counter()
+    for name, data in payloads:
+        bucket.blob(name).upload_from_string(data)
+    return time.perf_counter() - start
+
+def bench_bulk(bucket, payloads, workers):
+    start = time.perf_counter()
+    with BulkTransfer(bucket, max_workers=workers) as transfer:
+        for name, data in payloads:
+            transfer.upload_bytes(data, name)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--size-kb", type=int, default=300)
+    parser.add_argument("--latency-ms", type=float, default=30)
+    parser.add_argument("--bandwidth-mbps", type=float, default=400)
+    parser.add_argument("--workers", type=int, default=16)
+    args = parser.parse_args()
+
+    payloads = [(f"attachments/images/subfolder_{i // 10 + 1:02d}/image_{i + 1:02d}.jpeg", os.urandom(args.size_kb * 1024)) for i in range(args.files)]
+    total_mb = args.files * args.size_kb / 1024
+
+    results = {}
+    for mode in ("sequential", "bulk"):
+        bucket = FakeBucket(latency_seconds=args.latency_ms / 1000, bandwidth_mbps=args.bandwidth_mbps)
+        if mode == "sequential":
+            elapsed = bench_sequential(bucket, payloads)
+        else:
+            elapsed = bench_bulk(bucket, payloads, args.workers)
+        results[mode] = {
+            "seconds": round(elapsed, 3),
+            "files_per_second": round(args.files / elapsed, 1),
+            "mb_per_second": round(total_mb / elapsed, 1),
+            "requests": bucket.requests,
+        }
+
+    results["speedup"] = round(results["sequential"]["seconds"] / results["bulk"]["seconds"], 1)
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
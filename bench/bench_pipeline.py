@@ -0,0 +1,212 @@
+"""
+End-to-end pipeline benchmark. Generates a synthetic corpus (scanned PDFs, archives, .docx,
+.xls), starts the fake Anthropic and OpenAI servers, and runs every stage in-process
+through pipeline.runner against a local-directory bucket. Reports per-stage wall time,
+pages/sec, peak RSS, peak /tmp usage and API call counts, and writes them as JSON.
+
+    python -m bench.bench_pipeline --pdfs 2 --pages 10 --output bench_results.json
+    python -m bench.bench_pipeline --compare bench_results.json  # Exit 1 on a regression
+
+Stages that need tools missing on the machine (poppler, LibreOffice) record their errors in
+the results instead of stopping the run.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bench.fake_anthropic import FakeAnthropicServer
+from bench.fake_openai import FakeOpenAIServer
+from bench.synthetic import make_corpus
+
+BUCKET = "bench-bucket"
+SECRETS = {
+    "claude_api_key": "fake-anthropic-key",
+    "decode_system_prompt": "Transcribe every page exactly.",
+    "decode_user_prompt": "Transcribe the images above.",
+    "chatgpt_api_key": "fake-openai-key",
+    "chatgpt_system_prompt": "Write an HTML report from the transcript.",
+}
+# Metrics where a higher value is a regression; pages_per_second is checked the other way
+LOWER_IS_BETTER = ("seconds", "peak_rss_mb", "peak_tmp_mb")
+
+class TmpUsageSampler(threading.Thread):
+    """Samples used space on the /tmp filesystem and keeps the peak above the starting level."""
+
+    def __init__(self, path=tempfile.gettempdir(), interval=0.05):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.baseline = shutil.disk_usage(path).used
+        self.peak = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.peak = max(self.peak, shutil.disk_usage(self.path).used - self.baseline)
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        return self.peak
+
+def peak_rss_mb():
+    """Peak resident set size of this process and of its children (pdftoppm, soffice), in MiB."""
+    per_mb = 1024 * 1024 if sys.platform == "darwin" else 1024  # ru_maxrss is bytes on macOS, KiB on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(own / per_mb, 1), round(children / per_mb, 1)
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "-C", os.path.dirname(os.path.abspath(__file__)), "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def count_pages(storage):
+    """Pages rasterized, from the page manifests the pipeline wrote."""
+    bucket = storage.bucket(BUCKET)
+    pages = 0
+    for blob in bucket.list_blobs(prefix="attachments/images/"):
+        if blob.name.endswith("/manifest.json"):
+            manifest = json.loads(blob.download_as_bytes())
+            pages += sum(len(subfolder["pages"]) for subfolder in manifest["subfolders"])
+    return pages
+
+def summarize_stages(runs):
+    stages = {}
+    for run in runs:
+        stage = stages.setdefault(run["stage"], {"runs": 0, "seconds": 0.0, "max_seconds": 0.0, "errors": []})
+        stage["runs"] += 1
+        stage["seconds"] = round(stage["seconds"] + run["seconds"], 3)
+        stage["max_seconds"] = max(stage["max_seconds"], run["seconds"])
+        if run["error"]:
+            stage["errors"].append(f"{run['object']}: {run['error']}")
+    return stages
+
+def compare(results, previous, tolerance):
+    """Lists the metrics that got worse than previous by more than tolerance (a fraction)."""
+    regressions = []
+
+    def check(name, current, before, higher_is_better=False):
+        if not before or current is None:
+            return
+        change = (before - current) / before if higher_is_better else (current - before) / before
+        if change > tolerance:
+            regressions.append(f"{name}: {before} -> {current} ({change:+.0%})")
+
+    for metric in LOWER_IS_BETTER:
+        check(metric, results[metric], previous.get(metric))
+    check("pages_per_second", results["pages_per_second"], previous.get("pages_per_second"), higher_is_better=True)
+    for name, stage in results["stages"].items():
+        before = previous.get("stages", {}).get(name)
+        if before:
+            check(f"stages.{name}.seconds", stage["seconds"], before["seconds"])
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pdfs", type=int, default=2)
+    parser.add_argument("--pages", type=int, default=10, help="Pages per PDF, including the PDFs inside archives")
+    parser.add_argument("--zips", type=int, default=1)
+    parser.add_argument("--docx", type=int, default=1)
+    parser.add_argument("--xls", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--claude-latency-ms", type=float, default=800)
+    parser.add_argument("--openai-latency-ms", type=float, default=1500)
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    parser.add_argument("--root", help="Working directory for the corpus and local bucket (default: a new directory under the current one)")
+    parser.add_argument("--keep", action="store_true", help="Keep the working directory for inspection")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="Previous results file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown before a metric counts as a regression")
+    args = parser.parse_args()
+
+    # Outside /tmp, so the /tmp figure only counts the stages' own scratch files
+    root = args.root or tempfile.mkdtemp(prefix="bench_pipeline_", dir=os.getcwd())
+    corpus_dir, storage_dir, secrets_dir = (os.path.join(root, name) for name in ("corpus", "storage", "secrets"))
+    os.makedirs(secrets_dir, exist_ok=True)
+    for secret_id, value in SECRETS.items():
+        with open(os.path.join(secrets_dir, secret_id), "w") as f:
+            f.write(value)
+
+    started = time.perf_counter()
+    inputs = make_corpus(corpus_dir, pdfs=args.pdfs, pages=args.pages, zips=args.zips, docx=args.docx, xls=args.xls, seed=args.seed)
+    print(f"Generated {len(inputs)} input files in {time.perf_counter() - started:.1f}s")
+
+    claude = FakeAnthropicServer(latency_seconds=(args.claude_latency_ms / 2000, args.claude_latency_ms / 1000 * 1.5), error_rate=args.error_rate, seed=args.seed).start()
+    chatgpt = FakeOpenAIServer(latency_seconds=(args.openai_latency_ms / 2000, args.openai_latency_ms / 1000 * 1.5), error_rate=args.error_rate, seed=args.seed).start()
+
+    # Stages and their clients read these at import time, so they are set before the runner loads any stage
+    os.environ.update({
+        "ANTHROPIC_BASE_URL": claude.url,
+        "OPENAI_API_BASE": chatgpt.url + "/v1",
+        "LOCAL_SECRETS_DIR": secrets_dir,
+        "CLOUD_STORAGE_BUCKET": BUCKET,
+        "OCR_CACHE_BACKEND": "none",  # Every run measures real OCR calls
+    })
+    os.environ.pop("GOOGLE_APPLICATION_CREDENTIALS", None)
+    from pipeline.runner import PipelineRunner
+
+    runner = PipelineRunner(storage_dir)
+    for path in inputs:
+        runner.submit(path, "attachments/" + os.path.basename(path), BUCKET)
+
+    sampler = TmpUsageSampler()
+    sampler.start()
+    started = time.perf_counter()
+    try:
+        runs = runner.run()
+    finally:
+        seconds = time.perf_counter() - started
+        peak_tmp = sampler.stop()
+        claude.stop()
+        chatgpt.stop()
+
+    pages = count_pages(runner.storage)
+    rss, children_rss = peak_rss_mb()
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "corpus": {"pdfs": args.pdfs, "pages": args.pages, "zips": args.zips, "docx": args.docx, "xls": args.xls, "seed": args.seed},
+        "seconds": round(seconds, 3),
+        "pages": pages,
+        "pages_per_second": round(pages / seconds, 2) if seconds else None,
+        "peak_rss_mb": rss,
+        "peak_children_rss_mb": children_rss,
+        "peak_tmp_mb": round(peak_tmp / (1024 * 1024), 1),
+        "objects_written": runner.objects_written,
+        "api_calls": {
+            "anthropic": {"calls": claude.calls, "injected_errors": claude.errors},
+            "openai": {"calls": chatgpt.calls, "injected_errors": chatgpt.errors},
+        },
+        "stages": summarize_stages(runs),
+        "failed_runs": sum(1 for run in runs if run["error"]),
+    }
+    print(json.dumps(results, indent=2))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if not args.keep and not args.root:
+        shutil.rmtree(root, ignore_errors=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.compare}")
+
+if __name__ == "__main__":
+    main()
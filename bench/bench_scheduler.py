@@ -0,0 +1,97 @@
+"""
+Simulates one tenant's burst of uploads arriving just ahead of other tenants' small jobs, and
+compares a plain FIFO with common.work_queue's fair share. Each job holds page_batches(pages)
+of the in-flight cap for --request-ms, like an OCR job sending its batches concurrently.
+Reports each tenant's wait from enqueue to start and when its last job finished.
+
+    python -m bench.bench_scheduler --burst-jobs 50 --tenants 5 --max-in-flight 25
+    python -m bench.bench_scheduler --backend sqlite
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+from common.work_queue import MemoryQueue, SQLiteQueue, WorkItem, drain, page_batches
+
+def make_jobs(burst_jobs, burst_pages, tenants, jobs_per_tenant, pages, seed):
+    rng = random.Random(seed)
+    jobs = [("burst", rng.randint(burst_pages // 2, burst_pages)) for _ in range(burst_jobs)]
+    for tenant in range(tenants):
+        jobs += [(f"tenant-{tenant + 1}", rng.randint(1, pages)) for _ in range(jobs_per_tenant)]
+    return jobs
+
+def run(queue, jobs, fair, workers, request_seconds):
+    started = {}
+    finished = {}
+    lock = threading.Lock()
+
+    def handle(item):
+        with lock:
+            started[item.item_id] = time.perf_counter()
+        time.sleep(request_seconds)
+        with lock:
+            finished[item.item_id] = time.perf_counter()
+
+    begin = time.perf_counter()
+    items = []
+    for tenant, pages in jobs:
+        # FIFO: every job is the same tenant's, so items go out in arrival order
+        item = WorkItem("ocr", {"pages": pages}, tenant=tenant if fair else "all", cost=page_batches(pages))
+        item.owner = tenant
+        items.append(queue.put(item))
+    drain(queue, handle, workers=workers, idle_seconds=0.005)
+
+    report = {}
+    for item in items:
+        entry = report.setdefault(item.owner, {"jobs": 0, "waits": [], "done": 0.0})
+        entry["jobs"] += 1
+        entry["waits"].append(started[item.item_id] - begin)
+        entry["done"] = max(entry["done"], finished[item.item_id] - begin)
+    return {
+        tenant: {
+            "jobs": entry["jobs"],
+            "mean_wait_seconds": round(sum(entry["waits"]) / len(entry["waits"]), 3),
+            "max_wait_seconds": round(max(entry["waits"]), 3),
+            "done_seconds": round(entry["done"], 3),
+        }
+        for tenant, entry in sorted(report.items())
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--burst-jobs", type=int, default=50)
+    parser.add_argument("--burst-pages", type=int, default=40)
+    parser.add_argument("--tenants", type=int, default=5)
+    parser.add_argument("--jobs-per-tenant", type=int, default=2)
+    parser.add_argument("--pages", type=int, default=10, help="Most pages in a small tenant's job")
+    parser.add_argument("--max-in-flight", type=int, default=25, help="Model requests in flight (the cap)")
+    parser.add_argument("--workers", type=int, default=25)
+    parser.add_argument("--request-ms", type=float, default=50)
+    parser.add_argument("--backend", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    jobs = make_jobs(args.burst_jobs, args.burst_pages, args.tenants, args.jobs_per_tenant, args.pages, args.seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for mode in ("fifo", "fair"):
+            limits = {"max_in_flight": args.max_in_flight, "max_depth": len(jobs), "tenant_max_depth": len(jobs)}
+            if args.backend == "sqlite":
+                queue = SQLiteQueue(os.path.join(work_dir, f"{mode}.sqlite"), **limits)
+            else:
+                queue = MemoryQueue(**limits)
+            results[mode] = run(queue, jobs, mode == "fair", args.workers, args.request_ms / 1000)
+
+    small = [tenant for tenant in results["fair"] if tenant != "burst"]
+    results["small_tenant_mean_wait_seconds"] = {
+        mode: round(sum(results[mode][tenant]["mean_wait_seconds"] for tenant in small) / max(1, len(small)), 3)
+        for mode in ("fifo", "fair")
+    }
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Local stand-in for the Anthropic Messages endpoint with injectable latency and errors.
+
+    server = FakeAnthropicServer(latency_seconds=(0.2, 0.5), error_rate=0.1).start()
+    os.environ["ANTHROPIC_BASE_URL"] = server.url
+"""
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeAnthropicServer:
+    """
+    Serves POST /v1/messages. Each response sleeps for a random latency in latency_seconds,
+    and a fraction error_rate of requests fail with 429 (with retry-after) or 529 (overloaded).
+    Responses echo the request's text items so callers can check results come back in order.
+    Requests with more than truncate_above_images images stop with stop_reason "max_tokens".
+    With "stream": true the text is sent as server-sent events: the first token arrives after
+    first_token_share of the latency and the rest is spread over the remainder.
+    """
+
+    def __init__(self, latency_seconds=(0.05, 0.1), error_rate=0.0, requests_per_minute=1000, truncate_above_images=None, first_token_share=0.2, seed=0):
+        self.latency_seconds = latency_seconds
+        self.first_token_share = first_token_share
+        self.error_rate = error_rate
+        self.truncate_above_images = truncate_above_images
+        self.requests_per_minute = requests_per_minute
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _next_outcome(self):
+        with self._lock:
+            self.calls += 1
+            latency = self.random.uniform(*self.latency_seconds)
+            roll = self.random.random()
+            if roll < self.error_rate:
+                self.errors += 1
+                return latency, 429 if roll < self.error_rate / 2 else 529
+            return latency, 200
+
+    def _rate_limit_headers(self):
+        reset = (datetime.now(timezone.utc) + timedelta(seconds=1)).isoformat().replace("+00:00", "Z")
+        return {
+            "anthropic-ratelimit-requests-limit": str(self.requests_per_minute),
+            "anthropic-ratelimit-requests-remaining": str(self.requests_per_minute - 1),
+            "anthropic-ratelimit-requests-reset": reset,
+            "anthropic-ratelimit-input-tokens-limit": "1000000",
+            "anthropic-ratelimit-input-tokens-remaining": "999000",
+            "anthropic-ratelimit-input-tokens-reset": reset,
+        }
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body, headers=None):
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _send_stream(self, message, latency, headers):
+                self.send_response(200)
+                self.send_header("content-type", "text/event-stream")
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+
+                def event(name, data):
+                    self.wfile.write(f"event: {name}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+
+                text = message["content"][0]["text"]
+                pieces = [text[i:i + 16] for i in range(0, len(text), 16)] or [""]
+                event("message_start", {"type": "message_start", "message": dict(message, content=[], stop_reason=None)})
+                event("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+                for piece in pieces:
+                    event("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": piece}})
+                    time.sleep(latency * (1 - fake.first_token_share) / len(pieces))
+                event("content_block_stop", {"type": "content_block_stop", "index": 0})
+                event("message_delta", {"type": "message_delta", "delta": {"stop_reason": message["stop_reason"], "stop_sequence": None}, "usage": {"output_tokens": message["usage"]["output_tokens"]}})
+                event("message_stop", {"type": "message_stop"})
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))))
+                latency, status = fake._next_outcome()
+                streaming = request.get("stream", False)
+                time.sleep(latency * fake.first_token_share if streaming else latency)
+
+                headers = fake._rate_limit_headers()
+                if status == 429:
+                    headers["retry-after"] = "0.2"
+                    return self._send(429, {"type": "error", "error": {"type": "rate_limit_error", "message": "Rate limited"}}, headers)
+                if status == 529:
+                    return self._send(529, {"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}}, headers)
+
+                content = request["messages"][-1]["content"]
+                texts = [item["text"] for item in content if item["type"] == "text"]
+                images = sum(1 for item in content if item["type"] == "image")
+                text = f"{images} images. " + " ".join(texts)
+                truncated = fake.truncate_above_images is not None and images > fake.truncate_above_images
+                message = {
+                    "id": f"msg_fake_{fake.calls}",
+                    "type": "message",
+                    "role": "assistant",
+                    "model": request["model"],
+                    "content": [{"type": "text", "text": text}],
+                    "stop_reason": "max_tokens" if truncated else "end_turn",
+                    "stop_sequence": None,
+                    "usage": {"input_tokens": images * 1600, "output_tokens": len(text) // 4},
+                }
+                if streaming:
+                    return self._send_stream(message, latency, headers)
+                self._send(200, message, headers)
+
+        return Handler
@@ -0,0 +1,118 @@
+import io
+import os
+import threading
+import time
+
+class FakeBlobWriter(io.BytesIO):
+    """Buffers writes and stores the object on close, like a finalized resumable upload."""
+
+    def __init__(self, blob):
+        super().__init__()
+        self.blob = blob
+
+    def close(self):
+        if not self.closed:
+            self.blob.upload_from_string(self.getvalue())
+        super().close()
+
+class FakeBlob:
+    """The subset of google.cloud.storage.Blob the pipeline uses, backed by a FakeBucket."""
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.content_type = None
+        self.metadata = None
+
+    def upload_from_string(self, data, content_type=None):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.bucket._request(len(data))
+        self.bucket._put(self.name, bytes(data))
+
+    def upload_from_filename(self, filename, content_type=None):
+        with open(filename, "rb") as f:
+            self.upload_from_string(f.read(), content_type=content_type)
+
+    def download_as_bytes(self):
+        data = self.bucket._get(self.name)
+        self.bucket._request(len(data))
+        return data
+
+    def download_as_string(self):
+        return self.download_as_bytes()
+
+    def download_to_filename(self, filename):
+        data = self.download_as_bytes()
+        with open(filename, "wb") as f:
+            f.write(data)
+
+    def open(self, mode="rb", chunk_size=None, content_type=None):
+        if mode != "wb":
+            raise ValueError("FakeBlob only opens for binary writing")
+        return FakeBlobWriter(self)
+
+    def compose(self, sources):
+        if len(sources) > 32:
+            raise ValueError("compose takes at most 32 sources")
+        data = b"".join(self.bucket._get(source.name) for source in sources)
+        self.bucket._request(0)  # Server-side: no data crosses the network
+        self.bucket._put(self.name, data)
+
+    def exists(self):
+        return self.name in self.bucket.objects
+
+    def delete(self):
+        self.bucket._request(0)
+        with self.bucket._lock:
+            del self.bucket.objects[self.name]
+
+class FakeBucket:
+    """
+    In-memory stand-in for a GCS bucket. Every request pays a fixed round-trip latency plus
+    transfer time at the given bandwidth, which is what makes sequential transfers slow.
+    """
+
+    def __init__(self, name="fake-bucket", latency_seconds=0.03, bandwidth_mbps=400):
+        self.name = name
+        self.latency_seconds = latency_seconds
+        self.bytes_per_second = bandwidth_mbps * 1024 * 1024 / 8
+        self.objects = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _request(self, size):
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency_seconds + size / self.bytes_per_second)
+
+    def _put(self, name, data):
+        with self._lock:
+            self.objects[name] = data
+
+    def _get(self, name):
+        with self._lock:
+            if name not in self.objects:
+                raise FileNotFoundError(name)
+            return self.objects[name]
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix=""):
+        self._request(0)
+        with self._lock:
+            names = sorted(n for n in self.objects if n.startswith(prefix))
+        return [FakeBlob(self, n) for n in names]
+
+class FakeClient:
+    """Stand-in for google.cloud.storage.Client that hands out FakeBuckets by name."""
+
+    def __init__(self, **bucket_options):
+        self.bucket_options = bucket_options
+        self.buckets = {}
+
+    def bucket(self, name):
+        if name not in self.buckets:
+            self.buckets[name] = FakeBucket(name, **self.bucket_options)
+        return self.buckets[name]
@@ -0,0 +1,94 @@
+"""
+Local stand-in for the Gmail API's messages.send with injectable latency and errors.
+
+    server = FakeGmailServer(latency_seconds=(0.05, 0.1), error_rate=0.1).start()
+    os.environ["GMAIL_API_ENDPOINT"] = server.url + "/"  # Read by common/gmail_delivery.py at import
+"""
+import re
+import json
+import base64
+import random
+import threading
+import time
+from email import message_from_bytes
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SEND_PATH = re.compile(r"^/gmail/v1/users/([^/]+)/messages/send(\?.*)?$")
+
+class FakeGmailServer:
+    """
+    Serves POST /gmail/v1/users/<user>/messages/send. Each request sleeps for a random latency
+    in latency_seconds, and a fraction error_rate of requests fail with 429 or 503. Sent
+    messages are kept, parsed, in messages: {"to", "subject", "parts": [(content type, filename)]}.
+    """
+
+    def __init__(self, latency_seconds=(0.02, 0.05), error_rate=0.0, seed=0):
+        self.latency_seconds = latency_seconds
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+        self.messages = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _next_outcome(self):
+        with self._lock:
+            self.calls += 1
+            latency = self.random.uniform(*self.latency_seconds)
+            roll = self.random.random()
+            if roll < self.error_rate:
+                self.errors += 1
+                return latency, 429 if roll < self.error_rate / 2 else 503
+            return latency, 200
+
+    def _record(self, raw):
+        message = message_from_bytes(base64.urlsafe_b64decode(raw))
+        parts = [(part.get_content_type(), part.get_filename()) for part in message.walk() if not part.is_multipart()]
+        with self._lock:
+            self.messages.append({"to": message["to"], "subject": message["subject"], "parts": parts, "bytes": len(raw)})
+            return f"fake{len(self.messages)}"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body):
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("content-length", 0)))
+                if not SEND_PATH.match(self.path):
+                    return self._send(404, {"error": {"code": 404, "message": f"No such method: {self.path}"}})
+                latency, status = fake._next_outcome()
+                time.sleep(latency)
+                if status == 429:
+                    return self._send(429, {"error": {"code": 429, "message": "User-rate limit exceeded", "status": "RESOURCE_EXHAUSTED"}})
+                if status == 503:
+                    return self._send(503, {"error": {"code": 503, "message": "The service is currently unavailable", "status": "UNAVAILABLE"}})
+
+                message_id = fake._record(json.loads(body)["raw"])
+                self._send(200, {"id": message_id, "threadId": message_id, "labelIds": ["SENT"]})
+
+        return Handler
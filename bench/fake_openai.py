@@ -0,0 +1,132 @@
+"""
+Local stand-in for the OpenAI chat completions endpoint with injectable latency and errors.
+
+    server = FakeOpenAIServer(latency_seconds=(0.2, 0.5), error_rate=0.1).start()
+    os.environ["OPENAI_API_BASE"] = server.url + "/v1"  # Read by openai 0.27 at import
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeOpenAIServer:
+    """
+    Serves POST /v1/chat/completions. Each response sleeps for a random latency in
+    latency_seconds, and a fraction error_rate of requests fail with 429 (with retry-after
+    and x-ratelimit-* headers) or 503. Replies are a short HTML document describing the
+    request. With "stream": true the reply is sent as server-sent event chunks.
+    """
+
+    def __init__(self, latency_seconds=(0.05, 0.1), error_rate=0.0, requests_per_minute=1000, first_token_share=0.2, seed=0):
+        self.latency_seconds = latency_seconds
+        self.error_rate = error_rate
+        self.requests_per_minute = requests_per_minute
+        self.first_token_share = first_token_share
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _next_outcome(self):
+        with self._lock:
+            self.calls += 1
+            latency = self.random.uniform(*self.latency_seconds)
+            roll = self.random.random()
+            if roll < self.error_rate:
+                self.errors += 1
+                return latency, 429 if roll < self.error_rate / 2 else 503
+            return latency, 200
+
+    def _rate_limit_headers(self):
+        return {
+            "x-ratelimit-limit-requests": str(self.requests_per_minute),
+            "x-ratelimit-remaining-requests": str(self.requests_per_minute - 1),
+            "x-ratelimit-reset-requests": "60ms",
+            "x-ratelimit-limit-tokens": "1000000",
+            "x-ratelimit-remaining-tokens": "999000",
+            "x-ratelimit-reset-tokens": "6ms",
+        }
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body, headers=None):
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _send_stream(self, completion, latency, headers):
+                self.send_response(200)
+                self.send_header("content-type", "text/event-stream")
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+
+                def chunk(delta, finish_reason=None):
+                    data = dict(completion, object="chat.completion.chunk", choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason}])
+                    data.pop("usage", None)
+                    self.wfile.write(f"data: {json.dumps(data)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+
+                text = completion["choices"][0]["message"]["content"]
+                pieces = [text[i:i + 16] for i in range(0, len(text), 16)]
+                chunk({"role": "assistant", "content": ""})
+                for piece in pieces:
+                    chunk({"content": piece})
+                    time.sleep(latency * (1 - fake.first_token_share) / len(pieces))
+                chunk({}, "stop")
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))))
+                latency, status = fake._next_outcome()
+                streaming = request.get("stream", False)
+                time.sleep(latency * fake.first_token_share if streaming else latency)
+
+                headers = fake._rate_limit_headers()
+                if status == 429:
+                    headers["retry-after"] = "0.2"
+                    return self._send(429, {"error": {"type": "requests", "message": "Rate limit reached", "code": "rate_limit_exceeded"}}, headers)
+                if status == 503:
+                    return self._send(503, {"error": {"type": "server_error", "message": "The server is overloaded"}}, headers)
+
+                prompt = request["messages"][-1]["content"]
+                text = f"<html><body><p>{len(request['messages'])} messages, {len(prompt)} characters.</p><p>{prompt[:80]}</p></body></html>"
+                completion = {
+                    "id": f"chatcmpl-fake{fake.calls}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(text) // 4, "total_tokens": (len(prompt) + len(text)) // 4},
+                }
+                if streaming:
+                    return self._send_stream(completion, latency, headers)
+                self._send(200, completion, headers)
+
+        return Handler
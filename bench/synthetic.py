@@ -0,0 +1,135 @@
+"""
+Synthetic input documents for the benchmarks: scanned-style multi-page PDFs, .docx, .xls and
+archives of PDFs. Content is seeded, so a corpus is identical from run to run.
+"""
+import os
+import random
+import zipfile
+from xml.sax.saxutils import escape
+
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+try:
+    import xlwt
+except ImportError:  # Falls back to SpreadsheetML, which office suites open as .xls
+    xlwt = None
+
+WORDS = (
+    "patient reports history assessment memory attention score percentile within normal limits "
+    "impaired average testing session referral interview collateral records medication sleep "
+    "mood anxiety processing speed executive function verbal visual recall recognition"
+).split()
+
+def sentence(rng, words=12):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+def load_font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:  # Pillow < 10.1 only has the fixed-size bitmap font
+        return ImageFont.load_default()
+
+def scanned_page(rng, page_number, width=1700, height=2200):
+    """A letter page at 200 DPI with a header, paragraphs of text, slight skew and scanner noise."""
+    page = Image.new("L", (width, height), 238)
+    draw = ImageDraw.Draw(page)
+    title_font, body_font = load_font(44), load_font(28)
+    draw.text((150, 120), f"CLINICAL SUMMARY - PAGE {page_number}", fill=25, font=title_font)
+    y = 240
+    while y < height - 200:
+        if rng.random() < 0.15:
+            y += 40  # Paragraph break
+        draw.text((150, y), sentence(rng, rng.randint(8, 14)), fill=rng.randint(10, 60), font=body_font)
+        y += 44
+    page = page.rotate(rng.uniform(-0.8, 0.8), fillcolor=238, resample=Image.BILINEAR)
+    noise = Image.effect_noise((width // 2, height // 2), 12).resize((width, height))
+    page = Image.blend(page, noise, 0.08).filter(ImageFilter.GaussianBlur(0.6))
+    return page.convert("RGB")
+
+def make_pdf(path, pages, seed=0):
+    """Writes a PDF of JPEG-compressed page images, like the output of a document scanner."""
+    rng = random.Random(seed)
+    images = [scanned_page(rng, number) for number in range(1, pages + 1)]
+    images[0].save(path, "PDF", resolution=200.0, save_all=True, append_images=images[1:], quality=80)
+    return path
+
+def make_docx(path, paragraphs=40, seed=0):
+    """Writes a minimal but valid .docx (WordprocessingML in a zip) without python-docx."""
+    rng = random.Random(seed)
+    body = "".join(f"<w:p><w:r><w:t>{escape(sentence(rng, rng.randint(10, 30)))}</w:t></w:r></w:p>" for _ in range(paragraphs))
+    document = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+        f"<w:body>{body}</w:body></w:document>"
+    )
+    content_types = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+        "</Types>"
+    )
+    rels = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>'
+        "</Relationships>"
+    )
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr("[Content_Types].xml", content_types)
+        docx.writestr("_rels/.rels", rels)
+        docx.writestr("word/document.xml", document)
+    return path
+
+def make_xls(path, rows=200, seed=0):
+    """Writes a score sheet as a BIFF .xls with xlwt, or as SpreadsheetML when xlwt isn't installed."""
+    rng = random.Random(seed)
+    header = ["Test", "Raw score", "Percentile", "Notes"]
+    data = [[rng.choice(WORDS).title(), rng.randint(0, 80), rng.randint(1, 99), sentence(rng, 6)] for _ in range(rows)]
+
+    if xlwt is not None:
+        workbook = xlwt.Workbook()
+        sheet = workbook.add_sheet("Scores")
+        for r, row in enumerate([header] + data):
+            for c, value in enumerate(row):
+                sheet.write(r, c, value)
+        workbook.save(path)
+        return path
+
+    def cell(value):
+        kind = "Number" if isinstance(value, int) else "String"
+        return f'<Cell><Data ss:Type="{kind}">{escape(str(value))}</Data></Cell>'
+
+    rows_xml = "".join("<Row>" + "".join(cell(v) for v in row) + "</Row>" for row in [header] + data)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(
+            '<?xml version="1.0"?><Workbook xmlns="urn:schemas-microsoft-com:office:spreadsheet" '
+            'xmlns:ss="urn:schemas-microsoft-com:office:spreadsheet">'
+            f'<Worksheet ss:Name="Scores"><Table>{rows_xml}</Table></Worksheet></Workbook>'
+        )
+    return path
+
+def make_zip(path, pdfs=2, pages=5, seed=0):
+    """Writes an archive of scanned PDFs, named <folder>_<rest>.zip as the unzip stage expects."""
+    work_dir = os.path.dirname(path) or "."
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as archive:  # JPEG pages don't deflate
+        for i in range(pdfs):
+            pdf_path = make_pdf(os.path.join(work_dir, f".member_{seed}_{i}.pdf"), pages, seed=seed * 100 + i)
+            archive.write(pdf_path, f"scans/document_{i + 1:02d}.pdf")
+            os.remove(pdf_path)
+    return path
+
+def make_corpus(directory, pdfs=2, pages=10, zips=1, docx=1, xls=0, seed=0):
+    """Generates a benchmark corpus in directory and returns the file paths."""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(pdfs):
+        paths.append(make_pdf(os.path.join(directory, f"scan{i + 1:02d}.pdf"), pages, seed=seed + i))
+    for i in range(zips):
+        paths.append(make_zip(os.path.join(directory, f"batch{i + 1:02d}_upload.zip"), pages=pages, seed=seed + 100 + i))
+    for i in range(docx):
+        paths.append(make_docx(os.path.join(directory, f"letter{i + 1:02d}.docx"), seed=seed + 200 + i))
+    for i in range(xls):
+        paths.append(make_xls(os.path.join(directory, f"scores{i + 1:02d}.xls"), seed=seed + 300 + i))
+    return paths
@@ -0,0 +1,3 @@
+"""
+Code shared by the pipeline stages. Each stage's Dockerfile copies this package next to its main.py.
+"""
@@ -0,0 +1,189 @@
+"""
+Concurrent Claude Messages requests on asyncio, with bounded concurrency, header-driven rate
+limiting, jittered backoff on 429/529 and per-request timeouts. Requests can also be streamed
+into writers (e.g. resumable GCS uploads) as the text is generated.
+"""
+import os
+import time
+import asyncio
+import logging
+
+import anthropic
+
+from common import tracing
+from common.rate_limit import RateLimiter, backoff_delay, retry_after_seconds
+
+CLAUDE_CONCURRENCY = int(os.getenv('CLAUDE_CONCURRENCY', '4'))
+CLAUDE_TIMEOUT_SECONDS = float(os.getenv('CLAUDE_TIMEOUT_SECONDS', '300'))
+CLAUDE_MAX_ATTEMPTS = int(os.getenv('CLAUDE_MAX_ATTEMPTS', '6'))
+CLAUDE_REQUESTS_PER_MINUTE = int(os.getenv('CLAUDE_REQUESTS_PER_MINUTE', '50'))
+CLAUDE_INPUT_TOKENS_PER_MINUTE = int(os.getenv('CLAUDE_INPUT_TOKENS_PER_MINUTE', '40000'))
+
+# 429 rate limited, 529 overloaded, plus transient server errors
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504, 529}
+IMAGE_TOKEN_ESTIMATE = 1600  # A 1568 px page costs roughly this many input tokens
+
+def estimate_input_tokens(request):
+    """Rough input-token cost of a request, used to draw from the token bucket before sending."""
+    tokens = len(request.get("system", "")) // 4
+    for message in request["messages"]:
+        for item in message["content"]:
+            if item["type"] == "image":
+                tokens += IMAGE_TOKEN_ESTIMATE
+            elif item["type"] == "text":
+                tokens += len(item["text"]) // 4
+    return tokens
+
+def is_retryable(error):
+    """Retryable HTTP statuses, plus overload and rate-limit errors sent as events mid-stream (status 200)."""
+    if error.status_code in RETRYABLE_STATUS_CODES:
+        return True
+    body = error.body if isinstance(error.body, dict) else {}
+    return body.get("error", {}).get("type") in ("overloaded_error", "rate_limit_error", "api_error")
+
+async def with_retries(limiter, request, label, send):
+    """Runs send() for a request, retrying retryable failures with jittered backoff."""
+    for attempt in range(CLAUDE_MAX_ATTEMPTS):
+        last_attempt = attempt == CLAUDE_MAX_ATTEMPTS - 1
+        await limiter.acquire(estimate_input_tokens(request))
+        try:
+            return await send()
+        except anthropic.APIStatusError as e:
+            limiter.update_from_headers(e.response.headers)
+            if not is_retryable(e) or last_attempt:
+                raise
+            delay = retry_after_seconds(e.response.headers) or backoff_delay(attempt)
+            if e.status_code == 429:
+                limiter.pause(delay)
+            logging.warning(f"Claude request {label} got {e.status_code}, retrying in {delay:.1f}s")
+        except (anthropic.APIConnectionError, asyncio.TimeoutError) as e:
+            if last_attempt:
+                raise
+            delay = backoff_delay(attempt)
+            logging.warning(f"Claude request {label} failed ({type(e).__name__}), retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+async def create_message(client, limiter, semaphore, request, label=""):
+    """Sends one Messages request and returns the Message."""
+    async def send():
+        async with semaphore:
+            with tracing.span("messages.create", request=label) as span:
+                raw = await asyncio.wait_for(
+                    client.messages.with_raw_response.create(**request),
+                    timeout=CLAUDE_TIMEOUT_SECONDS,
+                )
+                message = await raw.parse()
+                span.update(input_tokens=message.usage.input_tokens, output_tokens=message.usage.output_tokens)
+        limiter.update_from_headers(raw.headers)
+        return message
+
+    return await with_retries(limiter, request, label, send)
+
+def close_quietly(writer):
+    try:
+        writer.close()
+    except Exception as e:
+        logging.warning(f"Error closing stream writer: {e}")
+
+async def stream_message(client, limiter, semaphore, request, open_writer, label=""):
+    """
+    Streams one Messages request, writing the text to a writer from open_writer() as it arrives.
+    The writer is opened on the first token and closed when the message is complete. Returns
+    the final Message and the monotonic time its first token arrived.
+    A retry reopens the writer, replacing whatever a failed attempt had written.
+    """
+    async def send():
+        state = {"writer": None, "first_token_at": None, "bytes": 0}
+
+        async def consume():
+            async with client.messages.stream(**request) as stream:
+                limiter.update_from_headers(stream.response.headers)
+                async for text in stream.text_stream:
+                    if state["writer"] is None:
+                        state["first_token_at"] = time.monotonic()
+                        state["writer"] = await asyncio.to_thread(open_writer)
+                    # Writes go off the event loop: the writer uploads whenever a chunk fills
+                    data = text.encode("utf-8")
+                    await asyncio.to_thread(state["writer"].write, data)
+                    state["bytes"] += len(data)
+                return await stream.get_final_message()
+
+        async with semaphore:
+            started = time.monotonic()
+            with tracing.span("messages.stream", request=label) as span:
+                try:
+                    message = await asyncio.wait_for(consume(), timeout=CLAUDE_TIMEOUT_SECONDS)
+                except BaseException:
+                    if state["writer"] is not None:
+                        # Finalizes the partial text; the retry (or the caller, on failure) replaces it
+                        await asyncio.to_thread(close_quietly, state["writer"])
+                    raise
+                finally:
+                    span["bytes"] = state["bytes"]
+                    if state["first_token_at"] is not None:
+                        span["time_to_first_token_ms"] = round((state["first_token_at"] - started) * 1000, 1)
+                span.update(input_tokens=message.usage.input_tokens, output_tokens=message.usage.output_tokens)
+        if state["writer"] is None:
+            # No text at all: still finalize an (empty) object
+            state["first_token_at"] = time.monotonic()
+            state["writer"] = await asyncio.to_thread(open_writer)
+        await asyncio.to_thread(state["writer"].close)
+        return message, state["first_token_at"]
+
+    return await with_retries(limiter, request, label, send)
+
+async def notify(index, coroutine, on_result):
+    """Awaits one request and hands its result (or exception) to on_result as soon as it is in."""
+    try:
+        result = await coroutine
+    except Exception as e:
+        result = e
+    if on_result is not None:
+        await asyncio.to_thread(on_result, index, result)
+    return result
+
+async def create_messages(requests, api_key, concurrency=CLAUDE_CONCURRENCY, labels=None, on_result=None):
+    """
+    Sends all requests concurrently and returns their results in the same order as the
+    requests. A request that ultimately fails yields its exception instead of a Message.
+    on_result(index, result), if given, is called (in a worker thread) as each request finishes.
+    """
+    labels = labels or [str(i) for i in range(len(requests))]
+    limiter = RateLimiter(CLAUDE_REQUESTS_PER_MINUTE, CLAUDE_INPUT_TOKENS_PER_MINUTE)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    # SDK retries are off: retries go through the limiter and backoff above instead
+    async with anthropic.AsyncAnthropic(api_key=api_key, max_retries=0, timeout=CLAUDE_TIMEOUT_SECONDS) as client:
+        return await asyncio.gather(
+            *(
+                notify(i, create_message(client, limiter, semaphore, request, label), on_result)
+                for i, (request, label) in enumerate(zip(requests, labels))
+            ),
+            return_exceptions=True,
+        )
+
+def run_messages(requests, api_key, concurrency=CLAUDE_CONCURRENCY, labels=None, on_result=None):
+    """Blocking entry point for the (synchronous) Cloud Function handlers."""
+    return asyncio.run(create_messages(requests, api_key, concurrency=concurrency, labels=labels, on_result=on_result))
+
+async def stream_messages(requests, open_writers, api_key, concurrency=CLAUDE_CONCURRENCY, labels=None, on_result=None):
+    """
+    Like create_messages, but streams each request's text into the writer from the matching
+    open_writers entry. Returns (Message, first_token_at) or the exception for each request, in order.
+    """
+    labels = labels or [str(i) for i in range(len(requests))]
+    limiter = RateLimiter(CLAUDE_REQUESTS_PER_MINUTE, CLAUDE_INPUT_TOKENS_PER_MINUTE)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with anthropic.AsyncAnthropic(api_key=api_key, max_retries=0, timeout=CLAUDE_TIMEOUT_SECONDS) as client:
+        return await asyncio.gather(
+            *(
+                notify(i, stream_message(client, limiter, semaphore, request, open_writer, label), on_result)
+                for i, (request, open_writer, label) in enumerate(zip(requests, open_writers, labels))
+            ),
+            return_exceptions=True,
+        )
+
+def run_streamed_messages(requests, open_writers, api_key, concurrency=CLAUDE_CONCURRENCY, labels=None, on_result=None):
+    """Blocking entry point for stream_messages."""
+    return asyncio.run(stream_messages(requests, open_writers, api_key, concurrency=concurrency, labels=labels, on_result=on_result))
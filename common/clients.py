@@ -0,0 +1,86 @@
+"""
+Process-wide registry of API clients.
+
+Cloud Functions reuse a warm instance across invocations, so clients created here (and the
+gRPC channels, HTTP pools and auth tokens behind them) survive from one event to the next
+instead of being rebuilt per event. SDKs are imported inside the factories, so a stage only
+pays for the clients it actually uses.
+"""
+import os
+import hashlib
+import logging
+import threading
+
+_clients = {}
+_lock = threading.Lock()
+_storage_override = None
+
+def get_client(key, factory):
+    """Returns the client registered under key, creating it with factory() on first use."""
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                logging.debug(f"Creating client: {key[0]}")
+                client = factory()
+                _clients[key] = client
+    return client
+
+def _fingerprint(value):
+    # Keeps API keys out of the registry keys (and anything that logs them)
+    return hashlib.sha256(str(value).encode("utf-8")).hexdigest()[:12]
+
+def use_storage_client(client):
+    """
+    Makes storage_client() return client (e.g. a common.local_storage.LocalStorageClient)
+    instead of a Cloud Storage client; None restores the default.
+    """
+    global _storage_override
+    _storage_override = client
+
+def storage_client(credentials=None):
+    if _storage_override is not None:
+        return _storage_override
+
+    def factory():
+        from google.cloud import storage
+        return storage.Client(credentials=credentials)
+    return get_client(("storage", id(credentials)), factory)
+
+def secret_manager_client(credentials=None):
+    def factory():
+        from google.cloud import secretmanager
+        return secretmanager.SecretManagerServiceClient(credentials=credentials)
+    return get_client(("secretmanager", id(credentials)), factory)
+
+def documentai_client(credentials=None):
+    def factory():
+        from google.cloud import documentai_v1 as documentai
+        return documentai.DocumentProcessorServiceClient(credentials=credentials)
+    return get_client(("documentai", id(credentials)), factory)
+
+def publisher_client():
+    """
+    Pub/Sub publisher. Messages published from one instance are batched (up to
+    PUBSUB_BATCH_MAX_MESSAGES, or PUBSUB_BATCH_MAX_LATENCY seconds) into one publish call.
+    """
+    def factory():
+        from google.cloud import pubsub_v1
+        batch_settings = pubsub_v1.types.BatchSettings(
+            max_messages=int(os.getenv('PUBSUB_BATCH_MAX_MESSAGES', '100')),
+            max_latency=float(os.getenv('PUBSUB_BATCH_MAX_LATENCY', '0.05')),
+        )
+        return pubsub_v1.PublisherClient(batch_settings=batch_settings)
+    return get_client(("pubsub",), factory)
+
+def anthropic_client(api_key):
+    def factory():
+        import anthropic
+        return anthropic.Anthropic(api_key=api_key)
+    return get_client(("anthropic", _fingerprint(api_key)), factory)
+
+def reset():
+    """Drops every cached client (e.g. after rotating credentials)."""
+    with _lock:
+        _clients.clear()
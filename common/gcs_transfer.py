@@ -0,0 +1,234 @@
+import os
+import logging
+import threading
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from common import tracing
+
+# Transfer settings
+TRANSFER_WORKERS = int(os.getenv('GCS_TRANSFER_WORKERS', '16'))
+TRANSFER_MAX_IN_FLIGHT = int(os.getenv('GCS_TRANSFER_MAX_IN_FLIGHT', '32'))
+TRANSFER_RETRIES = int(os.getenv('GCS_TRANSFER_RETRIES', '3'))
+TRANSFER_BACKOFF_SECONDS = 0.5
+STREAM_CHUNK_BYTES = int(os.getenv('GCS_STREAM_CHUNK_BYTES', str(256 * 1024)))  # Resumable uploads send multiples of 256 KiB
+
+@lru_cache(maxsize=None)
+def retryable_errors():
+    """
+    Transient errors worth retrying. google.api_core (with protobuf and certifi behind it) is
+    imported on the first transfer rather than at import, which is most of a stage's import time.
+    """
+    try:
+        from google.api_core import exceptions as api_exceptions
+    except ImportError:  # Lets the benchmark run against the fake bucket without the GCP SDK
+        return (ConnectionError, TimeoutError)
+    return (
+        api_exceptions.TooManyRequests,
+        api_exceptions.InternalServerError,
+        api_exceptions.BadGateway,
+        api_exceptions.ServiceUnavailable,
+        api_exceptions.GatewayTimeout,
+        ConnectionError,
+        TimeoutError,
+    )
+
+class TransferStats:
+    """Thread-safe progress counters for a BulkTransfer."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.uploaded = 0
+        self.downloaded = 0
+        self.bytes_uploaded = 0
+        self.bytes_downloaded = 0
+        self.retries = 0
+        self.failed = 0
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "uploaded": self.uploaded,
+                "downloaded": self.downloaded,
+                "bytes_uploaded": self.bytes_uploaded,
+                "bytes_downloaded": self.bytes_downloaded,
+                "retries": self.retries,
+                "failed": self.failed,
+            }
+
+class BulkTransfer:
+    """
+    Concurrent uploads and downloads against one bucket.
+
+    Work is run on a thread pool; submitting blocks once max_in_flight requests are
+    outstanding, so a fast producer (e.g. the rasterizer) cannot queue unbounded data.
+    Transient errors are retried with exponential backoff. Use as a context manager,
+    or call wait() to block until everything submitted so far has finished.
+    """
+
+    def __init__(self, bucket, max_workers=TRANSFER_WORKERS, max_in_flight=TRANSFER_MAX_IN_FLIGHT, retries=TRANSFER_RETRIES):
+        self.bucket = bucket
+        self.retries = retries
+        self.stats = TransferStats()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gcs-transfer")
+        self._slots = threading.BoundedSemaphore(max(max_in_flight, max_workers))
+        self._futures = []
+        self._futures_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.wait()
+        finally:
+            self.close()
+
+    def close(self):
+        """Waits for running transfers to finish and releases the worker threads."""
+        self._executor.shutdown(wait=True)
+
+    def _with_retries(self, description, func, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args)
+            except retryable_errors() as e:
+                if attempt == self.retries:
+                    self.stats.add(failed=1)
+                    logging.error(f"Giving up on {description} after {attempt + 1} attempts: {e}")
+                    raise
+                self.stats.add(retries=1)
+                delay = TRANSFER_BACKOFF_SECONDS * (2 ** attempt)
+                logging.warning(f"Retrying {description} in {delay:.1f}s: {e}")
+                time.sleep(delay)
+            except Exception:
+                self.stats.add(failed=1)
+                raise
+
+    def _submit(self, description, func, *args):
+        self._slots.acquire()
+
+        def run():
+            try:
+                return self._with_retries(description, func, *args)
+            finally:
+                self._slots.release()
+
+        # In the submitter's context, so uploads are tagged with its job's trace (common/tracing.py)
+        future = self._executor.submit(contextvars.copy_context().run, run)
+        with self._futures_lock:
+            self._futures.append(future)
+        return future
+
+    def upload_file(self, local_path, blob_name, content_type=None, remove=False):
+        """Uploads a local file; with remove, the file is deleted once it is safely uploaded."""
+        def upload():
+            size = os.path.getsize(local_path)
+            with tracing.span("upload", object=blob_name, bytes=size):
+                tracing.tag_blob(self.bucket.blob(blob_name)).upload_from_filename(local_path, content_type=content_type)
+            if remove:
+                os.remove(local_path)
+            self.stats.add(uploaded=1, bytes_uploaded=size)
+            return blob_name
+
+        return self._submit(f"upload {blob_name}", upload)
+
+    def upload_bytes(self, data, blob_name, content_type=None):
+        """Uploads straight from an in-memory buffer, without touching /tmp."""
+        def upload():
+            with tracing.span("upload", object=blob_name, bytes=len(data)):
+                tracing.tag_blob(self.bucket.blob(blob_name)).upload_from_string(data, content_type=content_type)
+            self.stats.add(uploaded=1, bytes_uploaded=len(data))
+            return blob_name
+
+        return self._submit(f"upload {blob_name}", upload)
+
+    def download_file(self, blob_name, local_path):
+        """Downloads a blob to local_path, creating parent directories as needed."""
+        def download():
+            os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+            with tracing.span("download", object=blob_name) as span:
+                self.bucket.blob(blob_name).download_to_filename(local_path)
+                span["bytes"] = os.path.getsize(local_path)
+            self.stats.add(downloaded=1, bytes_downloaded=span["bytes"])
+            return local_path
+
+        return self._submit(f"download {blob_name}", download)
+
+    def download_bytes(self, blob_name):
+        """Downloads a blob into memory; the future's result is its content."""
+        def download():
+            with tracing.span("download", object=blob_name) as span:
+                data = self.bucket.blob(blob_name).download_as_bytes()
+                span["bytes"] = len(data)
+            self.stats.add(downloaded=1, bytes_downloaded=len(data))
+            return data
+
+        return self._submit(f"download {blob_name}", download)
+
+    def wait(self, futures=None):
+        """
+        Blocks until the given transfers (by default, everything submitted so far) finish and
+        re-raises the first failure. Waited-for transfers are no longer tracked, so a failure
+        the caller has handled isn't raised again by a later wait() or on exit.
+        """
+        everything = futures is None
+        with self._futures_lock:
+            if everything:
+                futures, self._futures = self._futures, []
+            else:
+                futures = list(futures)
+                self._futures = [f for f in self._futures if f not in futures]
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if everything:
+            logging.info(f"GCS transfers complete: {self.stats.snapshot()}")
+        if errors:
+            raise errors[0]
+        return [f.result() for f in futures]
+
+MAX_COMPOSE_SOURCES = 32  # GCS limit per compose request
+
+def compose_in_order(bucket, source_names, destination_name, content_type=None):
+    """
+    Concatenates source blobs, in the given order, into destination_name with server-side
+    compose: no object data passes through this process. More than 32 sources are composed
+    in rounds through temporary objects, which are deleted afterwards; the destination itself
+    is written once, by the last round.
+    """
+    names = list(source_names)
+    temporary = []
+    level = 0
+    with tracing.span("compose", object=destination_name, sources=len(names)):
+        while len(names) > MAX_COMPOSE_SOURCES:
+            merged = []
+            for i in range(0, len(names), MAX_COMPOSE_SOURCES):
+                part_name = f"{destination_name}.compose-{level}-{i // MAX_COMPOSE_SOURCES:04d}"
+                bucket.blob(part_name).compose([bucket.blob(name) for name in names[i:i + MAX_COMPOSE_SOURCES]])
+                merged.append(part_name)
+            temporary += merged
+            names = merged
+            level += 1
+
+        destination = tracing.tag_blob(bucket.blob(destination_name))
+        destination.content_type = content_type
+        destination.compose([bucket.blob(name) for name in names])
+
+    for name in temporary:
+        bucket.blob(name).delete()
+    logging.info(f"Composed {len(source_names)} objects into {destination_name} ({level + 1} rounds)")
+    return destination_name
+
+def open_blob_writer(bucket, blob_name, content_type=None):
+    """
+    A binary file-like writer backed by a resumable upload. Each full STREAM_CHUNK_BYTES chunk is
+    sent as it fills; close() sends the rest and finalizes the object, which appears only then.
+    """
+    return tracing.tag_blob(bucket.blob(blob_name)).open("wb", chunk_size=STREAM_CHUNK_BYTES, content_type=content_type)
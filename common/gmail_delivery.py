@@ -0,0 +1,176 @@
+"""
+Report delivery over the Gmail API.
+
+The Gmail service is built once per instance from the discovery document bundled with
+google-api-python-client (static discovery), so no invocation fetches or parses it again.
+Reports go out through an Outbox:
+
+- reports for the same recipient submitted within GMAIL_COALESCE_SECONDS go out as one
+  message; when the window closes, gather(recipient, names) can add reports found elsewhere
+  (7email claims the recipient's other reports in the bucket);
+- messages are sent on a bounded thread pool, each thread with its own HTTP connection
+  (httplib2 isn't thread-safe), and retried with backoff on 429 and 5xx;
+- reports are inlined as HTML while the message body stays under GMAIL_INLINE_MAX_BYTES
+  (Gmail clips longer bodies) and gzip-attached beyond that.
+
+    outbox = Outbox(credentials)
+    message_id, names = outbox.submit("someone@example.com", blob_name, html).result()
+
+GMAIL_API_ENDPOINT sends the requests to another endpoint, such as bench/fake_gmail.py.
+"""
+import os
+import gzip
+import base64
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.base import MIMEBase
+from email import encoders
+
+from common import clients, tracing
+
+GMAIL_SCOPES = ['https://www.googleapis.com/auth/gmail.send']
+GMAIL_SENDER = os.getenv('GMAIL_SENDER', 'coop@farehard.com')
+GMAIL_SUBJECT = 'Your processed attachment'
+GMAIL_API_ENDPOINT = os.getenv('GMAIL_API_ENDPOINT')  # e.g. http://127.0.0.1:8080/ for a fake
+GMAIL_SEND_WORKERS = int(os.getenv('GMAIL_SEND_WORKERS', '4'))
+GMAIL_MAX_ATTEMPTS = int(os.getenv('GMAIL_MAX_ATTEMPTS', '5'))
+GMAIL_TIMEOUT_SECONDS = float(os.getenv('GMAIL_TIMEOUT_SECONDS', '60'))
+GMAIL_COALESCE_SECONDS = float(os.getenv('GMAIL_COALESCE_SECONDS', '5'))  # Longest a report waits for others to the same recipient
+GMAIL_INLINE_MAX_BYTES = int(os.getenv('GMAIL_INLINE_MAX_BYTES', str(100 * 1024)))  # Gmail clips message bodies past ~102 KB
+
+class DeliveryError(Exception):
+    """A message that could not be sent; names are the reports it carried."""
+
+    def __init__(self, recipient, names, cause):
+        super().__init__(f"Could not send {len(names)} report(s) to {recipient}: {cause}")
+        self.recipient = recipient
+        self.names = names
+
+def gmail_service():
+    """
+    The Gmail API service, built once per instance from the bundled discovery document. It only
+    builds requests; each thread executes them on its own HTTP connection (Outbox._http).
+    """
+    def factory():
+        import httplib2
+        from googleapiclient.discovery import build
+        client_options = {"api_endpoint": GMAIL_API_ENDPOINT} if GMAIL_API_ENDPOINT else None
+        return build("gmail", "v1", http=httplib2.Http(), static_discovery=True, cache_discovery=False, client_options=client_options)
+    return clients.get_client(("gmail", GMAIL_API_ENDPOINT), factory)
+
+def build_message(recipient, reports, sender=GMAIL_SENDER, subject=GMAIL_SUBJECT):
+    """
+    The MIME message for reports, [(name, html bytes)] in order: each inlined as an HTML part
+    while the inlined total stays under GMAIL_INLINE_MAX_BYTES, the rest attached as .html.gz.
+    """
+    message = MIMEMultipart()
+    message['to'] = recipient
+    message['from'] = sender
+    message['subject'] = subject if len(reports) == 1 else f"{subject}s ({len(reports)} reports)"
+
+    parts, attached, inline_bytes = [], [], 0
+    for name, html in reports:
+        file_name = os.path.basename(name)
+        if inline_bytes + len(html) <= GMAIL_INLINE_MAX_BYTES:
+            inline_bytes += len(html)
+            parts.append(MIMEText(html.decode("utf-8"), 'html', 'utf-8'))
+            continue
+        part = MIMEBase('application', 'gzip')
+        part.set_payload(gzip.compress(html))
+        encoders.encode_base64(part)
+        part.add_header('Content-Disposition', 'attachment', filename=f"{file_name}.gz")
+        parts.append(part)
+        attached.append(file_name)
+
+    if attached:
+        note = "Too large to show in the email, attached compressed (.gz): " + ", ".join(attached)
+        message.attach(MIMEText(note, 'plain', 'utf-8'))
+    for part in parts:
+        message.attach(part)
+    return message
+
+class _Batch:
+    def __init__(self, recipient):
+        self.recipient = recipient
+        self.reports = []
+        self.future = Future()
+        self.timer = None
+
+class Outbox:
+    """
+    Coalesces reports per recipient and sends them on a thread pool. One per instance: the
+    pool, the HTTP connections and the service are reused across invocations.
+    """
+
+    def __init__(self, credentials=None, window_seconds=GMAIL_COALESCE_SECONDS, workers=GMAIL_SEND_WORKERS, gather=None):
+        self.credentials = credentials
+        self.window_seconds = window_seconds
+        self.gather = gather
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gmail")
+        self._pending = {}  # recipient -> the batch still collecting reports
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def submit(self, recipient, name, html):
+        """Queues a report; the future resolves to (message ID, names of the reports sent with it)."""
+        with self._lock:
+            batch = self._pending.get(recipient)
+            if batch is None:
+                batch = self._pending[recipient] = _Batch(recipient)
+                batch.timer = threading.Timer(self.window_seconds, self._flush, (recipient, batch))
+                batch.timer.daemon = True
+                batch.timer.start()
+            batch.reports.append((name, html))
+            return batch.future
+
+    def _flush(self, recipient, batch):
+        with self._lock:
+            if self._pending.get(recipient) is not batch:
+                return
+            del self._pending[recipient]
+        batch.timer.cancel()
+        self._executor.submit(self._send_batch, batch)
+
+    def flush(self):
+        """Sends every collecting batch now instead of at the end of its window."""
+        with self._lock:
+            batches = list(self._pending.items())
+        for recipient, batch in batches:
+            self._flush(recipient, batch)
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown(wait=True)
+
+    def _http(self):
+        """This thread's HTTP connection, authorized unless the requests go to GMAIL_API_ENDPOINT."""
+        http = getattr(self._local, "http", None)
+        if http is None:
+            import httplib2
+            http = httplib2.Http(timeout=GMAIL_TIMEOUT_SECONDS)
+            if not GMAIL_API_ENDPOINT:
+                import google.auth
+                import google_auth_httplib2
+                credentials = self.credentials or google.auth.default(scopes=GMAIL_SCOPES)[0]
+                http = google_auth_httplib2.AuthorizedHttp(credentials, http=http)
+            self._local.http = http
+        return http
+
+    def _send_batch(self, batch):
+        reports = list(batch.reports)
+        try:
+            if self.gather:
+                reports += self.gather(batch.recipient, [name for name, _ in reports])
+            raw = base64.urlsafe_b64encode(build_message(batch.recipient, reports).as_bytes()).decode('utf-8')
+            request = gmail_service().users().messages().send(userId='me', body={'raw': raw})
+            with tracing.span("gmail.send", reports=len(reports), bytes=len(raw)):
+                # The client retries 429 and 5xx responses with exponential backoff
+                sent = request.execute(http=self._http(), num_retries=GMAIL_MAX_ATTEMPTS - 1)
+        except Exception as e:
+            batch.future.set_exception(DeliveryError(batch.recipient, [name for name, _ in reports], e))
+            return
+        logging.info(f"Email sent to {batch.recipient} with {len(reports)} report(s), message ID: {sent['id']}")
+        batch.future.set_result((sent['id'], [name for name, _ in reports]))
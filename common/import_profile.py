@@ -0,0 +1,101 @@
+"""
+Import-time profile of a stage, i.e. the module-loading part of its cold start.
+
+Imports the stage's main.py in a fresh interpreter under python -X importtime and reports the
+total and the cost per top-level package (self time summed over each package's modules),
+so a heavy SDK that creeps back into a module-level import shows up straight away.
+
+    python -m common.import_profile 4jpeg_to_text_claude 6wizard
+    python -m common.import_profile --all --budget-ms 300   # Exit 1 if any stage is over budget
+    python -m common.import_profile .                       # Inside a stage's image (/app)
+
+Run it where the stage's requirements are installed (its image, or a matching virtualenv);
+a missing package is reported as the import error.
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+def stage_directories(root=REPO_ROOT):
+    """The stage directories: numbered directories with a main.py, in pipeline order."""
+    return sorted(
+        name for name in os.listdir(root)
+        if re.match(r"^\d", name) and os.path.isfile(os.path.join(root, name, "main.py"))
+    )
+
+def profile_stage(directory, root=REPO_ROOT):
+    """
+    Imports directory/main.py in a subprocess and returns its total import time, the import
+    time of each top-level package, and the import error if the module failed to load.
+    """
+    directory = os.path.abspath(directory)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [directory, root, os.environ.get("PYTHONPATH")])))
+    env.pop("PYTHONDONTWRITEBYTECODE", None)  # Measure with bytecode caches, as a deployed image has them
+
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=directory, env=env, capture_output=True, text=True,
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+
+    packages, main_ms, error = {}, None, None
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if not match:
+            if line.strip():
+                error = line.strip()  # The last non-importtime line is the exception, if any
+            continue
+        self_us, cumulative_us, _, module = match.groups()
+        if module == "main":
+            main_ms = int(cumulative_us) / 1000
+            continue
+        package = module.split(".")[0]
+        packages[package] = packages.get(package, 0) + int(self_us) / 1000
+
+    return {
+        "stage": os.path.basename(directory),
+        "import_ms": round(main_ms, 1) if main_ms is not None else None,
+        "process_ms": round(wall_ms, 1),
+        "packages": {name: round(ms, 1) for name, ms in sorted(packages.items(), key=lambda item: -item[1])},
+        "error": error if result.returncode != 0 else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("stages", nargs="*", help="Stage directories (e.g. 4jpeg_to_text_claude, or . inside an image)")
+    parser.add_argument("--all", action="store_true", help="Profile every stage in the repository")
+    parser.add_argument("--top", type=int, default=10, help="Packages to list per stage")
+    parser.add_argument("--budget-ms", type=float, help="Exit 1 if a stage's import time is over this")
+    parser.add_argument("--json", action="store_true", help="Print the full results as JSON")
+    args = parser.parse_args()
+
+    directories = [os.path.join(REPO_ROOT, name) for name in stage_directories()] if args.all else args.stages
+    if not directories:
+        parser.error("name at least one stage directory, or --all")
+
+    results = [profile_stage(directory) for directory in directories]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print(f"{result['stage']}: import {result['import_ms']} ms, interpreter + import {result['process_ms']} ms")
+            if result["error"]:
+                print(f"  failed: {result['error']}")
+            for name, ms in list(result["packages"].items())[:args.top]:
+                print(f"  {ms:8.1f} ms  {name}")
+
+    over = [r["stage"] for r in results if args.budget_ms and (r["import_ms"] is None or r["import_ms"] > args.budget_ms)]
+    if over:
+        print(f"Over the {args.budget_ms:.0f} ms import budget (or failed to import): {', '.join(over)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
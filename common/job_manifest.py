@@ -0,0 +1,109 @@
+"""
+Per-job page manifests.
+
+The rasterizer writes manifest.json into a job's image prefix only after every page upload
+has finished. A single object write is atomic, so the manifest's existence is the
+"all pages present" marker: downstream stages act on the manifest event alone and ignore
+the per-page events that precede it.
+
+OCR does the same for its output: responses.json is written once every response part is
+uploaded and lists the parts in page order, so assembly runs once per job.
+
+A job can mix image pages with text pages, pages whose text was read straight from the
+document. Text pages are listed under "text_pages" with their page numbers, and the image
+pages in "subfolders" fill the remaining numbers in order. OCR only transcribes the image
+pages and lists the text pages among its parts as they are. A job of text pages alone
+skips OCR: its producer writes responses.json itself.
+"""
+import json
+import os
+import re
+import time
+
+MANIFEST_NAME = "manifest.json"
+RESPONSES_MANIFEST_NAME = "responses.json"
+PAGES_PER_SUBFOLDER = 10
+
+def manifest_blob_name(job_prefix):
+    """Blob name of the manifest for a job prefix such as attachments/images/<job>/."""
+    return os.path.join(job_prefix, MANIFEST_NAME)
+
+def is_manifest(blob_name):
+    return os.path.basename(blob_name) == MANIFEST_NAME
+
+def job_prefix_of(manifest_name):
+    """The job prefix (with trailing slash) a manifest blob belongs to."""
+    return os.path.dirname(manifest_name) + "/"
+
+def natural_key(path):
+    """Sort key that orders image_9 before image_10 (names are zero-padded to two digits only)."""
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", path)]
+
+def page_subfolder(page_number):
+    """10 pages per subfolder."""
+    return f"subfolder_{(page_number - 1) // PAGES_PER_SUBFOLDER + 1:02d}"
+
+def page_relative_path(page_number):
+    """Path of a page's JPEG relative to the job prefix."""
+    return os.path.join(page_subfolder(page_number), f"image_{page_number:02d}.jpeg")
+
+def text_page_path(page_number):
+    """Path of a text page relative to the job prefix, where its image would otherwise be."""
+    return os.path.join(page_subfolder(page_number), f"text_{page_number:02d}.txt")
+
+def build_manifest(job_id, page_paths, text_pages=None):
+    """
+    Builds the manifest for a job from its page paths, relative to the job prefix
+    (e.g. subfolder_01/image_01.jpeg). Pages are listed in page order and grouped by subfolder.
+    text_pages maps page numbers to text page paths for a job with text pages.
+    """
+    page_paths = sorted(page_paths, key=natural_key)
+    subfolders = {}
+    for path in page_paths:
+        subfolders.setdefault(os.path.dirname(path), []).append(path)
+
+    text_pages = text_pages or {}
+    return {
+        "job_id": job_id,
+        "created": time.time(),
+        "page_count": len(page_paths) + len(text_pages),
+        "subfolders": [{"name": name, "pages": pages} for name, pages in subfolders.items()],
+        "text_pages": [{"number": number, "path": path} for number, path in sorted(text_pages.items())],
+    }
+
+def image_page_numbers(manifest):
+    """The page numbers of a job's image pages, in the order the subfolders list them."""
+    text_numbers = {page["number"] for page in manifest.get("text_pages", [])}
+    return [number for number in range(1, manifest["page_count"] + 1) if number not in text_numbers]
+
+def write_manifest(transfer, job_prefix, job_id, page_paths, text_pages=None):
+    """
+    Marks a job complete. Call only after every page upload has succeeded (transfer.wait()).
+    """
+    manifest = build_manifest(job_id, page_paths, text_pages)
+    transfer.wait([transfer.upload_bytes(json.dumps(manifest).encode("utf-8"), manifest_blob_name(job_prefix), content_type="application/json")])
+    return manifest
+
+def read_manifest(bucket, manifest_name):
+    return json.loads(bucket.blob(manifest_name).download_as_bytes())
+
+def responses_manifest_blob_name(job_prefix):
+    return os.path.join(job_prefix, RESPONSES_MANIFEST_NAME)
+
+def is_responses_manifest(blob_name):
+    return os.path.basename(blob_name) == RESPONSES_MANIFEST_NAME
+
+def write_responses_manifest(transfer, job_prefix, job_id, parts, failed=()):
+    """
+    Marks a job's OCR output complete. parts are the response blob names relative to the job
+    prefix, in page order; failed are the page ranges ("12-18") that have no response.
+    Call only after every part upload has succeeded (transfer.wait()).
+    """
+    manifest = {
+        "job_id": job_id,
+        "created": time.time(),
+        "parts": list(parts),
+        "failed": list(failed),
+    }
+    transfer.wait([transfer.upload_bytes(json.dumps(manifest).encode("utf-8"), responses_manifest_blob_name(job_prefix), content_type="application/json")])
+    return manifest
@@ -0,0 +1,202 @@
+"""
+Checkpointed job state and once-only event delivery.
+
+Storage triggers are delivered at least once, and a function that times out on a large job
+is retried from the top. Two things keep a retry from redoing (and re-billing) finished work:
+
+- once(): an event's ID is its idempotency key. The first delivery leases the key; a
+  duplicate delivered while it runs, or after it finished, is a no-op. A delivery that fails
+  gives the lease back so the platform's retry runs, and a lease left by an instance that
+  died (a timeout) expires at the deadline written into it: EVENT_LEASE_SECONDS, the function
+  timeout, after the delivery started.
+- JobState: a per-job record of completed units (pages rendered, OCR batches written, PDF
+  members uploaded). A retried job loads it and only does what is missing. The record is
+  tied to the source object's generation, so a re-uploaded file starts over.
+
+Both live under job_state/ in the bucket:
+
+    job_state/<stage>/events/<event key>.json
+    job_state/<stage>/jobs/<job id>.json
+
+The event markers are never read again once their retries are over; a lifecycle rule on
+job_state/ can expire them after a few days.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import datetime
+import threading
+from contextlib import contextmanager
+
+STATE_FOLDER = "job_state"
+# The longest a delivery can run: the function timeout, which deploys set as FUNCTION_TIMEOUT_SEC
+EVENT_LEASE_SECONDS = int(os.getenv('EVENT_LEASE_SECONDS', os.getenv('FUNCTION_TIMEOUT_SEC', '540')))
+STATE_FLUSH_SECONDS = float(os.getenv('JOB_STATE_FLUSH_SECONDS', '5'))  # Checkpoint at most this often while units complete
+LEASE_ATTEMPTS = 3  # Creates of an event marker that was released while this delivery looked at it
+
+def precondition_failed():
+    try:
+        from google.api_core.exceptions import PreconditionFailed
+    except ImportError:
+        from common.local_storage import PreconditionFailed
+    return PreconditionFailed
+
+def event_key(event, context=None):
+    """
+    The delivery's idempotency key: the event ID (context.event_id, or a CloudEvent's "id"),
+    else the object name and generation, which identify one finalize just as well.
+    """
+    event_id = getattr(context, "event_id", None)
+    if event_id is None and hasattr(event, "data"):
+        event_id = event["id"]
+    if event_id is None:
+        data = getattr(event, "data", event) or {}
+        if not data.get("generation"):
+            return None
+        event_id = f"{data.get('bucket')}/{data.get('name')}#{data['generation']}"
+    return hashlib.sha256(str(event_id).encode("utf-8")).hexdigest()[:32]
+
+def source_generation(event):
+    """The generation of the object that triggered the event, or None if the event doesn't say."""
+    data = getattr(event, "data", event) or {}
+    return data.get("generation")
+
+def _age_seconds(blob):
+    if blob.updated is None:
+        return 0.0
+    return (datetime.datetime.now(datetime.timezone.utc) - blob.updated).total_seconds()
+
+@contextmanager
+def once(bucket, stage, event, context=None):
+    """
+    Runs the body of the with statement once per event:
+
+        with job_state.once(bucket, "ocr", event, context) as first:
+            if not first:
+                return
+            ...
+
+    first is False for a duplicate delivery. The event is recorded as done when the body
+    completes; if it raises, the lease is released and the exception propagates for a retry.
+    """
+    key = event_key(event, context)
+    if key is None:
+        yield True  # Nothing to key on (e.g. a hand-made event): always run
+        return
+
+    marker = bucket.blob(f"{STATE_FOLDER}/{stage}/events/{key}.json")
+    started = time.time()
+    running = json.dumps({"status": "running", "started": started, "deadline": started + EVENT_LEASE_SECONDS})
+    for _ in range(LEASE_ATTEMPTS):
+        try:
+            marker.upload_from_string(running, content_type="application/json", if_generation_match=0)
+            break
+        except precondition_failed():
+            existing = bucket.get_blob(marker.name)
+        if existing is None:
+            # Released (a failed attempt gave it back) between the create and the read: lease it again
+            continue
+        lease = json.loads(existing.download_as_bytes())
+        # The deadline is the leasing delivery's own timeout; markers written before it had one age out
+        deadline = lease.get("deadline", time.time() - _age_seconds(existing) + EVENT_LEASE_SECONDS)
+        if lease.get("status") == "done" or time.time() < deadline:
+            logging.info(f"Skipping duplicate delivery of event {key} to {stage} ({lease.get('status')})")
+            yield False
+            return
+        logging.warning(f"Taking over event {key} for {stage}: its lease expired {time.time() - deadline:.0f}s ago")
+        marker.upload_from_string(running, content_type="application/json")
+        break
+    else:
+        # Another delivery keeps leasing and releasing it; let the platform retry this one later
+        raise RuntimeError(f"Could not lease event {key} for {stage} after {LEASE_ATTEMPTS} attempts")
+
+    try:
+        yield True
+    except BaseException:
+        try:
+            marker.delete()
+        except Exception as e:
+            logging.warning(f"Could not release event {key} for {stage}: {e}")
+        raise
+    marker.upload_from_string(json.dumps({"status": "done", "finished": time.time()}), content_type="application/json")
+
+def claim(bucket, marker_name, stale_seconds):
+    """
+    Reserves something (a document to convert, a report to send) for this invocation by creating
+    marker_name only if it doesn't exist yet. A marker older than stale_seconds was left by a
+    dead instance and is taken over.
+    """
+    marker = bucket.blob(marker_name)
+    try:
+        marker.upload_from_string(b"", if_generation_match=0)
+        return True
+    except precondition_failed():
+        pass
+
+    existing = bucket.get_blob(marker_name)
+    if existing is None or existing.updated is None:
+        return False
+    age = _age_seconds(existing)
+    if age < stale_seconds:
+        return False
+    logging.warning(f"Taking over the claim {marker_name} left {age:.0f}s ago")
+    marker.upload_from_string(b"")
+    return True
+
+def release(bucket, marker_name):
+    try:
+        bucket.blob(marker_name).delete()
+    except Exception as e:
+        logging.warning(f"Could not release the claim {marker_name}: {e}")
+
+class JobState:
+    """
+    Completed units of one job, checkpointed to the bucket as they complete. Safe to update
+    from upload callbacks and worker threads.
+    """
+
+    def __init__(self, bucket, stage, job_id, source=None):
+        self.bucket = bucket
+        self.blob_name = f"{STATE_FOLDER}/{stage}/jobs/{job_id}.json"
+        self.source = source
+        self.units = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._flushed_at = 0.0
+
+        blob = bucket.get_blob(self.blob_name)
+        if blob is not None:
+            stored = json.loads(blob.download_as_bytes())
+            if stored.get("source") == source:
+                self.units = stored.get("units", {})
+                logging.info(f"Resuming {stage} job {job_id}: {len(self.units)} units already done")
+            else:
+                logging.info(f"Starting {stage} job {job_id} over: its source changed since the last attempt")
+
+    def done(self, unit):
+        with self._lock:
+            return unit in self.units
+
+    def get(self, unit, default=None):
+        with self._lock:
+            return self.units.get(unit, default)
+
+    def complete(self, unit, value=True):
+        """Records a unit as done; the record is written at most every STATE_FLUSH_SECONDS."""
+        with self._lock:
+            self.units[unit] = value
+            self._dirty = True
+            due = time.monotonic() - self._flushed_at >= STATE_FLUSH_SECONDS
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps({"source": self.source, "updated": time.time(), "units": self.units})
+            self._dirty = False
+            self._flushed_at = time.monotonic()
+            self.bucket.blob(self.blob_name).upload_from_string(data, content_type="application/json")
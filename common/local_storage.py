@@ -0,0 +1,196 @@
+"""
+Local-directory storage backend with the subset of the google.cloud.storage client API the
+stages use, so a stage runs unchanged against a directory once it is installed with
+clients.use_storage_client().
+
+Objects live at <root>/<bucket>/<object name>; metadata and content types are kept in a
+sidecar tree under <root>/.metadata. Every finalized write calls on_finalize(bucket, name),
+which is how the pipeline runner stands in for Cloud Storage triggers.
+"""
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+
+try:
+    from google.api_core.exceptions import PreconditionFailed
+except ImportError:  # Same name as the Cloud Storage error, so callers catch one type either way
+    class PreconditionFailed(Exception):
+        pass
+
+METADATA_DIR = ".metadata"
+
+class LocalBlobWriter(io.BufferedIOBase):
+    """Buffers writes in a temporary file and publishes the object on close, like a finalized resumable upload."""
+
+    def __init__(self, blob, content_type=None):
+        self.blob = blob
+        self.content_type = content_type
+        self._file = tempfile.NamedTemporaryFile(dir=blob.bucket.path, prefix=".upload-", delete=False)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self._file.write(data)
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+            self.blob._publish(self._file.name, self.content_type)
+        super().close()
+
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.content_type = None
+        self.metadata = None
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.path, self.name)
+
+    @property
+    def _metadata_path(self):
+        return os.path.join(self.bucket.client.root, METADATA_DIR, self.bucket.name, self.name + ".json")
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    @property
+    def generation(self):
+        # Changes on every write of the object, like a Cloud Storage generation
+        return str(os.stat(self.path).st_mtime_ns)
+
+    @property
+    def updated(self):
+        return datetime.datetime.fromtimestamp(os.path.getmtime(self.path), tz=datetime.timezone.utc)
+
+    def _load_metadata(self):
+        try:
+            with open(self._metadata_path) as f:
+                stored = json.load(f)
+        except (FileNotFoundError, ValueError):
+            stored = {}
+        self.content_type = stored.get("content_type")
+        self.metadata = stored.get("metadata")
+        return self
+
+    def _save_metadata(self):
+        os.makedirs(os.path.dirname(self._metadata_path), exist_ok=True)
+        with open(self._metadata_path, "w") as f:
+            json.dump({"content_type": self.content_type, "metadata": self.metadata}, f)
+
+    def _publish(self, temp_path, content_type=None, if_generation_match=None):
+        """
+        Moves a fully written temporary file into place (atomically) and fires the finalize callback.
+        if_generation_match=0 only creates the object if it does not exist yet, as in Cloud Storage.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if if_generation_match == 0:
+            try:
+                os.link(temp_path, self.path)  # Fails if the object exists, without a check-then-write race
+            except FileExistsError:
+                raise PreconditionFailed(f"Object already exists: {self.bucket.name}/{self.name}") from None
+            finally:
+                os.remove(temp_path)
+        else:
+            os.replace(temp_path, self.path)
+        self.content_type = content_type or self.content_type
+        self._save_metadata()
+        self.bucket._finalized(self.name)
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with tempfile.NamedTemporaryFile(dir=self.bucket.path, prefix=".upload-", delete=False) as f:
+            f.write(data)
+        self._publish(f.name, content_type, if_generation_match)
+
+    def upload_from_filename(self, filename, content_type=None, if_generation_match=None):
+        with tempfile.NamedTemporaryFile(dir=self.bucket.path, prefix=".upload-", delete=False) as f:
+            pass
+        shutil.copyfile(filename, f.name)
+        self._publish(f.name, content_type, if_generation_match)
+
+    def download_as_bytes(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def download_as_string(self):
+        return self.download_as_bytes()
+
+    def download_as_text(self, encoding="utf-8"):
+        return self.download_as_bytes().decode(encoding)
+
+    def download_to_filename(self, filename):
+        shutil.copyfile(self.path, filename)
+
+    def open(self, mode="rb", chunk_size=None, content_type=None, **kwargs):
+        if mode == "rb":
+            return open(self.path, "rb")
+        if mode == "wb":
+            return LocalBlobWriter(self, content_type)
+        raise ValueError(f"Unsupported mode for a local blob: {mode}")
+
+    def compose(self, sources):
+        with tempfile.NamedTemporaryFile(dir=self.bucket.path, prefix=".upload-", delete=False) as out:
+            for source in sources:
+                with open(source.path, "rb") as f:
+                    shutil.copyfileobj(f, out)
+        self._publish(out.name, self.content_type)
+
+    def patch(self):
+        self._save_metadata()
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def delete(self):
+        if not self.exists():
+            raise FileNotFoundError(f"No such object: {self.bucket.name}/{self.name}")
+        os.remove(self.path)
+        if os.path.exists(self._metadata_path):
+            os.remove(self._metadata_path)
+
+class LocalBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.path = os.path.join(client.root, name)
+        os.makedirs(self.path, exist_ok=True)
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def get_blob(self, name):
+        blob = LocalBlob(self, name)
+        return blob._load_metadata() if blob.exists() else None
+
+    def list_blobs(self, prefix=""):
+        names = []
+        for directory, _, files in os.walk(self.path):
+            for file_name in files:
+                name = os.path.relpath(os.path.join(directory, file_name), self.path).replace(os.sep, "/")
+                if name.startswith(prefix) and not os.path.basename(name).startswith(".upload-"):
+                    names.append(name)
+        return [LocalBlob(self, name)._load_metadata() for name in sorted(names)]
+
+    def _finalized(self, name):
+        if self.client.on_finalize is not None:
+            self.client.on_finalize(self.name, name)
+
+class LocalStorageClient:
+    """Stand-in for google.cloud.storage.Client; bucket(name) is the directory <root>/<name>."""
+
+    def __init__(self, root, on_finalize=None):
+        self.root = os.path.abspath(root)
+        self.on_finalize = on_finalize
+        os.makedirs(self.root, exist_ok=True)
+
+    def bucket(self, name):
+        return LocalBucket(self, name)
@@ -0,0 +1,230 @@
+"""
+Content-addressed cache of OCR results.
+
+Entries are pages: the key is a hash of one page's image payload exactly as sent to the model,
+the system and user prompts and the model name, so a resent intake form or score sheet hits the
+cache whichever pages it is sent with, while any prompt or model change misses it. Stores are
+pluggable: local directory or SQLite (local runs, benchmarks) and a bucket prefix (production).
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+
+OCR_CACHE_BACKEND = os.getenv('OCR_CACHE_BACKEND', 'gcs')  # gcs, sqlite, disk or none
+OCR_CACHE_PREFIX = os.getenv('OCR_CACHE_PREFIX', 'ocr_cache/')
+OCR_CACHE_PATH = os.getenv('OCR_CACHE_PATH', '/tmp/ocr_cache')
+OCR_CACHE_TTL_SECONDS = int(os.getenv('OCR_CACHE_TTL_DAYS', '30')) * 24 * 3600
+OCR_CACHE_MAX_ENTRIES = int(os.getenv('OCR_CACHE_MAX_ENTRIES', '50000'))
+OCR_CACHE_TOUCH_SECONDS = int(os.getenv('OCR_CACHE_TOUCH_HOURS', '24')) * 3600  # How stale a GCS entry's access time gets before a hit updates it
+
+def prompt_version(prompt):
+    """Short hash standing in for a prompt's version: any edit to the prompt changes it."""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+def cache_key(image_payloads, system_prompt, user_prompt, model):
+    """
+    Cache key for OCR of image_payloads, the encoded images exactly as sent (already normalized
+    to model resolution by the rasterizer), in page order; 4jpeg keys each page on its own.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{model}\n{prompt_version(system_prompt)}\n{prompt_version(user_prompt)}\n".encode("utf-8"))
+    for payload in image_payloads:
+        if isinstance(payload, str):
+            payload = payload.encode("ascii")
+        digest.update(hashlib.sha256(payload).digest())
+    return digest.hexdigest()
+
+class DiskCacheStore:
+    """One JSON file per entry. Reads touch the file's mtime, which doubles as the LRU clock."""
+
+    def __init__(self, path=OCR_CACHE_PATH, ttl_seconds=OCR_CACHE_TTL_SECONDS, max_entries=OCR_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self._file(key), encoding="utf-8") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if time.time() - entry["created"] > self.ttl_seconds:
+            self.delete(key)
+            return None
+        os.utime(self._file(key))
+        return entry["value"]
+
+    def put(self, key, value):
+        tmp_file = self._file(key) + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"created": time.time(), "value": value}, f)
+        os.replace(tmp_file, self._file(key))
+        return self.evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """Drops least recently used entries above max_entries; returns how many were removed."""
+        entries = [os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith(".json")]
+        excess = len(entries) - self.max_entries
+        if excess <= 0:
+            return 0
+        for file in sorted(entries, key=os.path.getmtime)[:excess]:
+            os.remove(file)
+        return excess
+
+class SQLiteCacheStore:
+    """Single-file store with explicit created/accessed columns for TTL and LRU."""
+
+    def __init__(self, path=OCR_CACHE_PATH + ".sqlite", ttl_seconds=OCR_CACHE_TTL_SECONDS, max_entries=OCR_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS ocr_cache (key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS ocr_cache_accessed ON ocr_cache (accessed)")
+        self._db.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, created FROM ocr_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl_seconds:
+                self._db.execute("DELETE FROM ocr_cache WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+            self._db.execute("UPDATE ocr_cache SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            return row[0]
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO ocr_cache VALUES (?, ?, ?, ?)", (key, value, now, now))
+            self._db.commit()
+        return self.evict()
+
+    def evict(self):
+        with self._lock:
+            excess = self._db.execute("SELECT COUNT(*) FROM ocr_cache").fetchone()[0] - self.max_entries
+            if excess <= 0:
+                return 0
+            self._db.execute("DELETE FROM ocr_cache WHERE key IN (SELECT key FROM ocr_cache ORDER BY accessed LIMIT ?)", (excess,))
+            self._db.commit()
+            return excess
+
+class GCSCacheStore:
+    """
+    One object per entry under a bucket prefix. Creation and last-access times live in the
+    object metadata; eviction lists the prefix, so it only runs every evict_every writes.
+    A hit only rewrites the access time once it is touch_seconds old: metadata writes stay rare
+    on hot entries (GCS limits how often one object can be updated), at the cost of an LRU order
+    that is only accurate to touch_seconds.
+    """
+
+    def __init__(self, bucket, prefix=OCR_CACHE_PREFIX, ttl_seconds=OCR_CACHE_TTL_SECONDS, max_entries=OCR_CACHE_MAX_ENTRIES, evict_every=100, touch_seconds=OCR_CACHE_TOUCH_SECONDS):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.touch_seconds = touch_seconds
+        self._writes = 0
+
+    def get(self, key):
+        blob = self.bucket.get_blob(self.prefix + key)
+        if blob is None:
+            return None
+        metadata = blob.metadata or {}
+        if time.time() - float(metadata.get("created", 0)) > self.ttl_seconds:
+            blob.delete()
+            return None
+        value = blob.download_as_bytes().decode("utf-8")
+        now = time.time()
+        if now - float(metadata.get("accessed", 0)) > self.touch_seconds:
+            blob.metadata = {**metadata, "accessed": str(now)}
+            blob.patch()
+        return value
+
+    def put(self, key, value):
+        blob = self.bucket.blob(self.prefix + key)
+        now = str(time.time())
+        blob.metadata = {"created": now, "accessed": now}
+        blob.upload_from_string(value, content_type="text/plain")
+        self._writes += 1
+        return self.evict() if self._writes % self.evict_every == 0 else 0
+
+    def evict(self):
+        blobs = list(self.bucket.list_blobs(prefix=self.prefix))
+        excess = len(blobs) - self.max_entries
+        if excess <= 0:
+            return 0
+        blobs.sort(key=lambda b: float((b.metadata or {}).get("accessed", 0)))
+        for blob in blobs[:excess]:
+            blob.delete()
+        return excess
+
+class OCRCache:
+    """A cache store plus hit/miss counters. Store errors are logged and treated as misses."""
+
+    def __init__(self, store):
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    def get(self, key):
+        try:
+            value = self.store.get(key) if self.store else None
+        except Exception as e:
+            logging.warning(f"OCR cache read failed, treating as a miss: {e}")
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if not self.store:
+            return
+        try:
+            self.evictions += self.store.put(key, value)
+            self.writes += 1
+        except Exception as e:
+            logging.warning(f"OCR cache write failed: {e}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+def cache_from_env(bucket=None):
+    """Builds the cache configured by OCR_CACHE_BACKEND; 'gcs' needs the bucket."""
+    if OCR_CACHE_BACKEND == "gcs" and bucket is not None:
+        return OCRCache(GCSCacheStore(bucket))
+    if OCR_CACHE_BACKEND == "sqlite":
+        return OCRCache(SQLiteCacheStore())
+    if OCR_CACHE_BACKEND == "disk":
+        return OCRCache(DiskCacheStore())
+    return OCRCache(None)
@@ -0,0 +1,175 @@
+"""
+Office documents to PDF on warm LibreOffice workers.
+
+Each worker is a unoserver process in front of one headless soffice, started on first use and
+kept for the life of the instance, so a document costs its conversion alone instead of an
+office start-up. Documents go straight from their own format (doc, docx, xls, xlsx, odt, rtf)
+to PDF, so tables and layout survive, and nothing leaves the instance.
+
+Without the unoserver client installed, a batch falls back to one soffice --convert-to run for
+all of its files: still one office start per batch rather than one per file.
+"""
+import os
+import time
+import queue
+import shlex
+import socket
+import atexit
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from unoserver.client import UnoClient
+except ImportError:  # Batches fall back to the soffice command line
+    UnoClient = None
+
+OFFICE_SUFFIXES = ('.doc', '.docx', '.xls', '.xlsx', '.odt', '.rtf')
+OFFICE_WORKERS = int(os.getenv('OFFICE_WORKERS', '2'))
+OFFICE_SERVER_COMMAND = os.getenv('OFFICE_SERVER_COMMAND', 'unoserver')
+SOFFICE_BINARY = os.getenv('SOFFICE_BINARY', 'soffice')
+OFFICE_BASE_PORT = int(os.getenv('OFFICE_BASE_PORT', '2003'))  # Worker i listens on base + 2i, its soffice on base + 2i + 1
+OFFICE_PROFILE_ROOT = os.getenv('OFFICE_PROFILE_ROOT', '/tmp/office_profiles')  # One LibreOffice user profile per worker
+OFFICE_START_TIMEOUT_SECONDS = float(os.getenv('OFFICE_START_TIMEOUT_SECONDS', '60'))
+OFFICE_CONVERT_TIMEOUT_SECONDS = float(os.getenv('OFFICE_CONVERT_TIMEOUT_SECONDS', '120'))
+
+def is_office_document(name):
+    return name.lower().endswith(OFFICE_SUFFIXES)
+
+def pdf_name(path):
+    return os.path.splitext(os.path.basename(path))[0] + ".pdf"
+
+class OfficeWorker:
+    """One unoserver + soffice pair, restarted if it dies or a conversion hangs."""
+
+    def __init__(self, index):
+        self.index = index
+        self.port = OFFICE_BASE_PORT + 2 * index
+        self.uno_port = self.port + 1
+        self.profile_dir = os.path.join(OFFICE_PROFILE_ROOT, f"worker_{index}")
+        self.process = None
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        command = shlex.split(OFFICE_SERVER_COMMAND) + [
+            "--interface", "127.0.0.1",
+            "--port", str(self.port),
+            "--uno-port", str(self.uno_port),
+            "--executable", SOFFICE_BINARY,
+            "--user-installation", self.profile_dir,
+        ]
+        started = time.monotonic()
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+        # Ready once the XML-RPC port accepts connections, which unoserver opens after soffice is up
+        while time.monotonic() - started < OFFICE_START_TIMEOUT_SECONDS:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Office worker {self.index} exited during start-up ({self.process.returncode})")
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                logging.info(f"Office worker {self.index} ready in {time.monotonic() - started:.1f}s")
+                return
+            except OSError:
+                time.sleep(0.2)
+        self.stop()
+        raise TimeoutError(f"Office worker {self.index} did not start within {OFFICE_START_TIMEOUT_SECONDS:.0f}s")
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            os.killpg(self.process.pid, 9)  # unoserver and the soffice it started
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+        self.process = None
+
+    def convert(self, input_path, output_path):
+        """Converts one document to PDF. A conversion over the timeout kills the worker, which fails the call."""
+        if not self.is_running():
+            self.start()
+        watchdog = threading.Timer(OFFICE_CONVERT_TIMEOUT_SECONDS, self.stop)
+        watchdog.start()
+        try:
+            UnoClient("127.0.0.1", str(self.port)).convert(inpath=input_path, outpath=output_path, convert_to="pdf")
+        except Exception:
+            self.stop()  # Start afresh for the next document rather than reuse a worker in an unknown state
+            raise
+        finally:
+            watchdog.cancel()
+        return output_path
+
+class OfficePool:
+    """Warm workers shared by every conversion on the instance; each takes one document at a time."""
+
+    def __init__(self, workers=OFFICE_WORKERS):
+        self.workers = [OfficeWorker(i) for i in range(workers)]
+        self._idle = queue.Queue()
+        for worker in self.workers:
+            self._idle.put(worker)
+
+    def convert(self, input_path, output_dir):
+        worker = self._idle.get()
+        try:
+            return worker.convert(input_path, os.path.join(output_dir, pdf_name(input_path)))
+        finally:
+            self._idle.put(worker)
+
+    def convert_batch(self, input_paths, output_dir):
+        """Converts documents on all workers at once. Returns the PDF path or the exception for each input, in order."""
+        def convert(path):
+            try:
+                return self.convert(path, output_dir)
+            except Exception as e:
+                logging.error(f"Converting {os.path.basename(path)} failed: {e}")
+                return e
+
+        with ThreadPoolExecutor(max_workers=len(self.workers)) as executor:
+            return list(executor.map(convert, input_paths))
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+
+def convert_batch_cli(input_paths, output_dir):
+    """Fallback without unoserver: one soffice run converts the whole batch."""
+    profile = os.path.join(OFFICE_PROFILE_ROOT, "cli")
+    command = [
+        SOFFICE_BINARY, "--headless", "--norestore", f"-env:UserInstallation=file://{profile}",
+        "--convert-to", "pdf", "--outdir", output_dir,
+    ] + list(input_paths)
+    try:
+        subprocess.run(command, check=True, capture_output=True, timeout=OFFICE_CONVERT_TIMEOUT_SECONDS * len(input_paths))
+    except (OSError, subprocess.SubprocessError) as e:
+        return [e] * len(input_paths)
+
+    results = []
+    for path in input_paths:
+        output_path = os.path.join(output_dir, pdf_name(path))
+        results.append(output_path if os.path.exists(output_path) else RuntimeError(f"soffice produced no PDF for {os.path.basename(path)}"))
+    return results
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """The instance's worker pool, created on first use and stopped at exit."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = OfficePool()
+            atexit.register(_pool.close)
+    return _pool
+
+def convert_documents(input_paths, output_dir):
+    """Converts a batch of office documents to PDFs in output_dir; returns a PDF path or exception per input."""
+    os.makedirs(output_dir, exist_ok=True)
+    if not input_paths:
+        return []
+    if UnoClient is None:
+        return convert_batch_cli(input_paths, output_dir)
+    return get_pool().convert_batch(input_paths, output_dir)
@@ -0,0 +1,303 @@
+"""
+Text straight out of born-digital office files, without rendering them.
+
+A .docx or spreadsheet already holds its text, so rasterizing it and reading it back with
+vision OCR is the most expensive way to get it. extract_document() reads paragraphs, tables
+and sheet cells from the file itself and returns them in document order together with the
+document's embedded images, the only part that still needs OCR:
+
+    [("text", "Report for ..."), ("image", b"<png bytes>"), ("text", "Scores | 12 | 14"), ...]
+
+docx and odt are parsed from their XML directly; xlsx needs openpyxl and xls needs xlrd.
+Formats (or files) it can't read return None, and the caller converts them to PDF instead.
+"""
+import io
+import os
+import logging
+import posixpath
+import zipfile
+import datetime
+import xml.etree.ElementTree as ET
+
+EXTRACTABLE_SUFFIXES = ('.docx', '.xlsx', '.xls', '.odt')
+CELL_SEPARATOR = " | "
+MIN_IMAGE_EDGE = int(os.getenv('OFFICE_MIN_IMAGE_EDGE', '100'))  # Smaller images are icons and logos, not content
+IMAGE_MAX_EDGE = 1568  # Longest image edge Claude accepts without downscaling
+JPEG_QUALITY = int(os.getenv('JPEG_QUALITY', '85'))
+
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+A = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+R = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+V = "{urn:schemas-microsoft-com:vml}"
+MC = "{http://schemas.openxmlformats.org/markup-compatibility/2006}"
+PACKAGE_RELS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+TEXT = "{urn:oasis:names:tc:opendocument:xmlns:text:1.0}"
+TABLE = "{urn:oasis:names:tc:opendocument:xmlns:table:1.0}"
+DRAW = "{urn:oasis:names:tc:opendocument:xmlns:drawing:1.0}"
+OFFICE = "{urn:oasis:names:tc:opendocument:xmlns:office:1.0}"
+XLINK = "{http://www.w3.org/1999/xlink}"
+
+def is_extractable(name):
+    return name.lower().endswith(EXTRACTABLE_SUFFIXES)
+
+class Items:
+    """Collects text and images in order, merging consecutive text into one item."""
+
+    def __init__(self):
+        self.items = []
+        self._lines = []
+
+    def text(self, line):
+        if line.strip():
+            self._lines.append(line.rstrip())
+
+    def image(self, data):
+        if data:
+            self.flush()
+            self.items.append(("image", data))
+
+    def flush(self):
+        if self._lines:
+            self.items.append(("text", "\n".join(self._lines)))
+            self._lines = []
+
+    def result(self):
+        self.flush()
+        return self.items
+
+# docx
+
+def _docx_walk(element):
+    """Yields the element's descendants in document order, skipping the fallback copies of AlternateContent."""
+    for child in element:
+        if child.tag == MC + "Fallback":
+            continue
+        yield child
+        yield from _docx_walk(child)
+
+def _docx_paragraph(paragraph, media):
+    """A paragraph's text and the images anchored in it."""
+    text, images = [], []
+    for element in _docx_walk(paragraph):
+        if element.tag == W + "t":
+            text.append(element.text or "")
+        elif element.tag == W + "tab":
+            text.append("\t")
+        elif element.tag in (W + "br", W + "cr"):
+            text.append("\n")
+        elif element.tag == A + "blip":
+            images.append(media.get(element.get(R + "embed")))
+        elif element.tag == V + "imagedata":
+            images.append(media.get(element.get(R + "id")))
+    return "".join(text), images
+
+def _docx_paragraphs(element):
+    """The outermost paragraphs under element (a text box's paragraphs are part of the one holding it)."""
+    for child in element:
+        if child.tag == W + "p":
+            yield child
+        elif child.tag != MC + "Fallback":
+            yield from _docx_paragraphs(child)
+
+def _docx_cell_text(cell, media, images):
+    parts = []
+    for paragraph in _docx_paragraphs(cell):
+        text, cell_images = _docx_paragraph(paragraph, media)
+        parts.append(text.strip())
+        images += cell_images
+    return " ".join(part for part in parts if part)
+
+def _docx_blocks(container, media, items):
+    for child in container:
+        if child.tag == W + "p":
+            text, images = _docx_paragraph(child, media)
+            items.text(text)
+            for data in images:
+                items.image(data)
+        elif child.tag == W + "tbl":
+            images = []
+            for row in child.findall(W + "tr"):  # Nested tables are read as part of their cell
+                cells = [_docx_cell_text(cell, media, images) for cell in row.findall(W + "tc")]
+                items.text(CELL_SEPARATOR.join(cells))
+            for data in images:  # Images in a table follow the table
+                items.image(data)
+        elif child.tag == W + "sdt":
+            content = child.find(W + "sdtContent")
+            if content is not None:
+                _docx_blocks(content, media, items)
+
+def _docx_media(archive):
+    """Relationship ID -> image bytes for the main document part."""
+    try:
+        rels = ET.fromstring(archive.read("word/_rels/document.xml.rels"))
+    except KeyError:
+        return {}
+    media = {}
+    for rel in rels.iter(PACKAGE_RELS + "Relationship"):
+        if rel.get("TargetMode") == "External" or not rel.get("Type", "").endswith("/image"):
+            continue
+        target = posixpath.normpath(posixpath.join("word", rel.get("Target", "")))
+        try:
+            media[rel.get("Id")] = archive.read(target)
+        except KeyError:
+            pass
+    return media
+
+def extract_docx(path):
+    with zipfile.ZipFile(path) as archive:
+        media = _docx_media(archive)
+        body = ET.fromstring(archive.read("word/document.xml")).find(W + "body")
+    items = Items()
+    if body is not None:
+        _docx_blocks(body, media, items)
+    return items.result()
+
+# odt
+
+def _odt_text(element, media, images):
+    """Text of a paragraph or heading, with ODF's encoded spaces, tabs and line breaks."""
+    text = [element.text or ""]
+    for child in element:
+        if child.tag == TEXT + "s":
+            text.append(" " * int(child.get(TEXT + "c", "1")))
+        elif child.tag == TEXT + "tab":
+            text.append("\t")
+        elif child.tag == TEXT + "line-break":
+            text.append("\n")
+        elif child.tag == DRAW + "image":
+            images.append(media.get(child.get(XLINK + "href")))
+        elif child.tag != TEXT + "note":  # Footnote bodies would land mid-sentence
+            text.append(_odt_text(child, media, images))
+        text.append(child.tail or "")
+    return "".join(text)
+
+def _odt_blocks(container, media, items):
+    for child in container:
+        if child.tag in (TEXT + "p", TEXT + "h"):
+            images = []
+            items.text(_odt_text(child, media, images))
+            for data in images:
+                items.image(data)
+        elif child.tag == TABLE + "table":
+            images = []
+            for row in child.iter(TABLE + "table-row"):
+                cells = [" ".join(_odt_text(p, media, images).strip() for p in cell.iter(TEXT + "p")) for cell in row.findall(TABLE + "table-cell")]
+                while cells and not cells[-1]:
+                    cells.pop()  # Sheets pad rows out to the table width
+                items.text(CELL_SEPARATOR.join(cells))
+            for data in images:
+                items.image(data)
+        else:  # Lists, sections and the like
+            _odt_blocks(child, media, items)
+
+def extract_odt(path):
+    with zipfile.ZipFile(path) as archive:
+        media = {name: archive.read(name) for name in archive.namelist() if name.startswith("Pictures/")}
+        body = ET.fromstring(archive.read("content.xml")).find(f"{OFFICE}body/{OFFICE}text")
+    items = Items()
+    if body is not None:
+        _odt_blocks(body, media, items)
+    return items.result()
+
+# Spreadsheets
+
+def format_cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime.datetime) and value.time() == datetime.time(0):
+        return value.date().isoformat()
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value).strip()
+
+def _sheet_rows(items, title, rows):
+    items.text(f"Sheet: {title}")
+    for row in rows:
+        cells = [format_cell(value) for value in row]
+        while cells and not cells[-1]:
+            cells.pop()
+        items.text(CELL_SEPARATOR.join(cells))
+
+def extract_xlsx(path):
+    try:
+        import openpyxl
+    except ImportError:
+        logging.debug("openpyxl is not installed, not extracting .xlsx text")
+        return None
+    items = Items()
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            _sheet_rows(items, sheet.title, sheet.iter_rows(values_only=True))
+    finally:
+        workbook.close()
+    with zipfile.ZipFile(path) as archive:
+        for name in sorted(archive.namelist()):
+            if name.startswith("xl/media/"):
+                items.image(archive.read(name))
+    return items.result()
+
+def extract_xls(path):
+    try:
+        import xlrd
+    except ImportError:
+        logging.debug("xlrd is not installed, not extracting .xls text")
+        return None
+    items = Items()
+    workbook = xlrd.open_workbook(path, on_demand=True)
+    try:
+        for index in range(workbook.nsheets):
+            sheet = workbook.sheet_by_index(index)
+            rows = []
+            for row in range(sheet.nrows):
+                values = []
+                for cell in sheet.row(row):
+                    if cell.ctype == xlrd.XL_CELL_DATE:
+                        values.append(xlrd.xldate.xldate_as_datetime(cell.value, workbook.datemode))
+                    else:
+                        values.append(cell.value if cell.ctype != xlrd.XL_CELL_EMPTY else None)
+                rows.append(values)
+            _sheet_rows(items, sheet.name, rows)
+            workbook.unload_sheet(index)
+    finally:
+        workbook.release_resources()
+    return items.result()
+
+EXTRACTORS = {".docx": extract_docx, ".odt": extract_odt, ".xlsx": extract_xlsx, ".xls": extract_xls}
+
+def extract_document(path):
+    """
+    The document's text and embedded images in document order, or None when it has to be
+    converted to PDF instead: a format without an extractor, a file the extractor can't
+    parse, or one with neither text nor images (content in shapes or fields we don't read).
+    """
+    extractor = EXTRACTORS.get(os.path.splitext(path)[1].lower())
+    if extractor is None:
+        return None
+    try:
+        items = extractor(path)
+    except Exception as e:
+        logging.warning(f"Could not extract text from {os.path.basename(path)}: {e}")
+        return None
+    return items or None
+
+def image_to_jpeg(data, max_edge=IMAGE_MAX_EDGE, min_edge=MIN_IMAGE_EDGE):
+    """
+    An embedded image as a model-ready JPEG, or None for images too small to hold content
+    and formats Pillow can't decode (EMF/WMF drawings).
+    """
+    from PIL import Image
+
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            if max(img.size) < min_edge:
+                return None
+            img.thumbnail((max_edge, max_edge))
+            buffered = io.BytesIO()
+            img.convert("RGB").save(buffered, "JPEG", quality=JPEG_QUALITY)
+            return buffered.getvalue()
+    except Exception as e:
+        logging.debug(f"Skipping an embedded image Pillow can't read: {e}")
+        return None
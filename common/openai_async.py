@@ -0,0 +1,87 @@
+"""
+Concurrent OpenAI chat completions on asyncio (openai 0.27 API), with bounded concurrency,
+token-bucket rate limiting, jittered backoff on rate limits and transient errors, and
+per-request timeouts.
+"""
+import os
+import asyncio
+import logging
+
+import aiohttp
+import openai
+
+from common import tracing
+from common.rate_limit import RateLimiter, backoff_delay, retry_after_seconds
+
+OPENAI_CONCURRENCY = int(os.getenv('OPENAI_CONCURRENCY', '4'))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv('OPENAI_TIMEOUT_SECONDS', '300'))
+OPENAI_MAX_ATTEMPTS = int(os.getenv('OPENAI_MAX_ATTEMPTS', '6'))
+OPENAI_REQUESTS_PER_MINUTE = int(os.getenv('OPENAI_REQUESTS_PER_MINUTE', '500'))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv('OPENAI_TOKENS_PER_MINUTE', '200000'))
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+
+def estimate_request_tokens(request):
+    """Rough token cost of a request (prompt plus max_tokens, as OpenAI counts it against the limit)."""
+    prompt = sum(len(message["content"]) for message in request["messages"]) // 4
+    return prompt + request.get("max_tokens", 0)
+
+async def create_chat_completion(limiter, semaphore, request, api_key, label=""):
+    """Sends one chat completion, retrying retryable failures with jittered backoff."""
+    for attempt in range(OPENAI_MAX_ATTEMPTS):
+        last_attempt = attempt == OPENAI_MAX_ATTEMPTS - 1
+        await limiter.acquire(estimate_request_tokens(request))
+        try:
+            async with semaphore:
+                with tracing.span("chat.completions.create", request=label) as span:
+                    completion = await asyncio.wait_for(
+                        openai.ChatCompletion.acreate(api_key=api_key, request_timeout=OPENAI_TIMEOUT_SECONDS, **request),
+                        timeout=OPENAI_TIMEOUT_SECONDS,
+                    )
+                    span.update(input_tokens=completion.usage.prompt_tokens, output_tokens=completion.usage.completion_tokens)
+                return completion
+        except RETRYABLE_ERRORS as e:
+            limiter.update_from_openai_headers(e.headers)
+            if last_attempt:
+                raise
+            delay = retry_after_seconds(e.headers) or backoff_delay(attempt)
+            if isinstance(e, openai.error.RateLimitError):
+                limiter.pause(delay)
+            logging.warning(f"OpenAI request {label} failed ({type(e).__name__}), retrying in {delay:.1f}s")
+        except asyncio.TimeoutError:
+            if last_attempt:
+                raise
+            delay = backoff_delay(attempt)
+            logging.warning(f"OpenAI request {label} timed out, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+async def create_chat_completions(requests, api_key, concurrency=OPENAI_CONCURRENCY, labels=None):
+    """
+    Sends all requests concurrently and returns their results in the same order as the
+    requests. A request that ultimately fails yields its exception instead of a completion.
+    """
+    labels = labels or [str(i) for i in range(len(requests))]
+    limiter = RateLimiter(OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    # One HTTP session for the whole batch instead of one per request
+    async with aiohttp.ClientSession() as session:
+        openai.aiosession.set(session)
+        try:
+            return await asyncio.gather(
+                *(create_chat_completion(limiter, semaphore, request, api_key, label) for request, label in zip(requests, labels)),
+                return_exceptions=True,
+            )
+        finally:
+            openai.aiosession.set(None)
+
+def run_chat_completions(requests, api_key, concurrency=OPENAI_CONCURRENCY, labels=None):
+    """Blocking entry point for the (synchronous) Cloud Function handlers."""
+    return asyncio.run(create_chat_completions(requests, api_key, concurrency=concurrency, labels=labels))
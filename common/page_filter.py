@@ -0,0 +1,87 @@
+"""
+Pre-OCR page filter: finds blank pages and near-duplicate pages so they are not sent to the model.
+
+Each page is decoded once at low resolution (JPEG draft mode, so the full image is never decoded)
+into a grayscale NumPy array, from which we take:
+  - ink coverage: the share of pixels clearly darker than the page background
+  - a 256-bit difference hash of a 17x16 thumbnail, compared by Hamming distance
+Near-duplicates must match on both, so two different letters on the same letterhead
+(same hash neighbourhood, different amount of text) are kept apart.
+"""
+import os
+import logging
+
+import numpy as np
+from PIL import Image
+
+PAGE_FILTER_ENABLED = os.getenv('PAGE_FILTER', '1') == '1'
+BLANK_INK_THRESHOLD = float(os.getenv('BLANK_INK_THRESHOLD', '0.002'))  # Ink share below which a page is blank
+DUPLICATE_MAX_DISTANCE = int(os.getenv('DUPLICATE_MAX_DISTANCE', '6'))  # Differing hash bits (of 256) for a near-duplicate
+DUPLICATE_INK_TOLERANCE = float(os.getenv('DUPLICATE_INK_TOLERANCE', '0.05'))  # Allowed relative ink difference
+ANALYSIS_SIZE = 256  # Longest edge of the grayscale array the metrics are computed on
+HASH_SIZE = 16
+INK_CONTRAST = 80  # How much darker than the background a pixel must be to count as ink
+
+def load_grayscale(path, size=ANALYSIS_SIZE):
+    """Downsampled grayscale array of a page. For JPEGs, draft() decodes at reduced scale directly."""
+    with Image.open(path) as img:
+        img.draft("L", (size, size))
+        img = img.convert("L")
+        img.thumbnail((size, size))
+        return np.asarray(img, dtype=np.int16)
+
+def ink_coverage(gray):
+    # The background is the brightest common level, which tolerates grey scanner paper
+    background = np.percentile(gray, 90)
+    return float(np.mean(gray < background - INK_CONTRAST))
+
+def difference_hash(gray, hash_size=HASH_SIZE):
+    """Horizontal gradient signs of a (hash_size + 1) x hash_size thumbnail, packed into bits."""
+    thumb = Image.fromarray(gray.astype(np.uint8)).resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = np.asarray(thumb, dtype=np.int16)
+    return np.packbits(pixels[:, 1:] > pixels[:, :-1])
+
+def page_signature(path):
+    gray = load_grayscale(path)
+    return ink_coverage(gray), difference_hash(gray)
+
+def classify_pages(paths, blank_threshold=BLANK_INK_THRESHOLD, max_distance=DUPLICATE_MAX_DISTANCE, ink_tolerance=DUPLICATE_INK_TOLERANCE):
+    """
+    Returns one decision per page, in order: None to send the page, "blank", or the 0-based
+    index of the earlier page it duplicates. The first occurrence is always the one sent.
+    """
+    decisions = []
+    kept_hashes, kept_ink, kept_index = [], [], []
+    for index, path in enumerate(paths):
+        ink, page_hash = page_signature(path)
+        if ink < blank_threshold:
+            decisions.append("blank")
+            continue
+
+        if kept_hashes:
+            distances = np.unpackbits(np.bitwise_xor(np.stack(kept_hashes), page_hash), axis=1).sum(axis=1)
+            ink_close = np.abs(np.array(kept_ink) - ink) <= ink_tolerance * max(ink, 1e-6)
+            matches = np.flatnonzero((distances <= max_distance) & ink_close)
+            if matches.size:
+                decisions.append(kept_index[matches[0]])
+                continue
+
+        kept_hashes.append(page_hash)
+        kept_ink.append(ink)
+        kept_index.append(index)
+        decisions.append(None)
+    return decisions
+
+def summarize(decisions):
+    """Per-job counts of sent and skipped pages."""
+    blank = sum(1 for d in decisions if d == "blank")
+    duplicate = sum(1 for d in decisions if isinstance(d, int))
+    return {"pages": len(decisions), "sent": len(decisions) - blank - duplicate, "blank": blank, "duplicate": duplicate}
+
+def filter_pages(paths):
+    """classify_pages with the configured thresholds, or all pages kept when the filter is off."""
+    if not PAGE_FILTER_ENABLED:
+        return [None] * len(paths)
+    decisions = classify_pages(paths)
+    logging.info(f"Page filter: {summarize(decisions)}")
+    return decisions
@@ -0,0 +1,113 @@
+"""
+PDF pages to JPEGs with poppler (pdf2image), for the unzip and pdf_to_jpeg stages.
+
+Pages are rendered in windows sized so the decoded pages of one window fit PAGE_MEMORY_BUDGET_MB,
+and each page is encoded and handed on as soon as it is rendered, so a long document never
+sits decoded in memory. Pages land at page_relative_path() (common/job_manifest.py), the
+layout the OCR stage reads.
+"""
+import os
+import io
+import logging
+from pdf2image import convert_from_path, pdfinfo_from_path
+
+from common import tracing
+from common.job_manifest import page_relative_path
+
+PAGE_MEMORY_BUDGET_MB = int(os.getenv('PDF_PAGE_MEMORY_BUDGET_MB', '256'))  # Peak decoded-page memory per render window
+MODEL_MAX_EDGE = 1568  # Longest image edge Claude accepts without downscaling
+JPEG_QUALITY = int(os.getenv('JPEG_QUALITY', '85'))
+
+# 'model' renders straight into the model's pixel box so the OCR stage can send pages untouched,
+# 'full' keeps the full-DPI render for archival copies
+RASTER_OUTPUT_MODE = os.getenv('RASTER_OUTPUT_MODE', 'model')
+RASTER_MAX_EDGE = MODEL_MAX_EDGE if RASTER_OUTPUT_MODE == 'model' else None
+
+def estimate_page_bytes(pdf_info, dpi, max_edge=None):
+    """
+    Estimates the decoded RGB size of one rendered page from the pdfinfo page size (in points).
+    With max_edge, the page is scaled to fit a max_edge x max_edge box instead of rendered at dpi.
+    """
+    width_pts, height_pts = 612.0, 792.0  # Letter, if pdfinfo doesn't report a size
+    page_size = pdf_info.get("Page size", "")
+    try:
+        dims = page_size.split(" pts")[0].split(" x ")
+        width_pts, height_pts = float(dims[0]), float(dims[1])
+    except (IndexError, ValueError):
+        logging.debug(f"Could not parse page size '{page_size}', assuming letter")
+
+    scale = dpi / 72
+    if max_edge:
+        scale = max_edge / max(width_pts, height_pts)
+    width_px = int(width_pts * scale)
+    height_px = int(height_pts * scale)
+    return width_px * height_px * 3
+
+def page_window_size(pdf_info, dpi, memory_budget_mb, max_edge=None):
+    """
+    Number of pages that can be held decoded at once without exceeding the memory budget.
+    """
+    page_bytes = estimate_page_bytes(pdf_info, dpi, max_edge=max_edge)
+    return max(1, (memory_budget_mb * 1024 * 1024) // page_bytes)
+
+def page_windows(page_numbers, window):
+    """
+    Splits page numbers into (first_page, last_page) ranges of consecutive pages, at most
+    window pages each.
+    """
+    windows = []
+    for number in page_numbers:
+        if windows and number == windows[-1][1] + 1 and number - windows[-1][0] < window:
+            windows[-1][1] = number
+        else:
+            windows.append([number, number])
+    return [tuple(pages) for pages in windows]
+
+def iter_pdf_pages(pdf_path, dpi=200, memory_budget_mb=PAGE_MEMORY_BUDGET_MB, max_edge=None, pages=None):
+    """
+    Renders a PDF in fixed-size page windows and yields (page_number, image) one page at a time.
+    Only one window of decoded pages is held in memory, however long the document is.
+    With max_edge, poppler scales each page to fit a max_edge x max_edge box while rendering.
+    pages restricts rendering to those page numbers (ascending); by default every page is rendered.
+    """
+    pdf_info = pdfinfo_from_path(pdf_path)
+    page_count = int(pdf_info["Pages"])
+    window = page_window_size(pdf_info, dpi, memory_budget_mb, max_edge=max_edge)
+    pages = pages or range(1, page_count + 1)
+    logging.debug(f"Rendering {len(pages)} of {page_count} pages from {pdf_path} in windows of {window}")
+
+    for first_page, last_page in page_windows(pages, window):
+        with tracing.span("convert_from_path", pdf=os.path.basename(pdf_path), first_page=first_page, pages=last_page - first_page + 1):
+            images = convert_from_path(pdf_path, dpi=dpi, first_page=first_page, last_page=last_page, size=max_edge)
+        for offset, image in enumerate(images):
+            yield first_page + offset, image
+            image.close()
+        del images
+
+def iter_jpeg_pages(pdf_path, dpi=200, memory_budget_mb=PAGE_MEMORY_BUDGET_MB, max_edge=RASTER_MAX_EDGE, pages=None):
+    """
+    Yields (relative_path, jpeg_bytes) for each page, encoding in memory as soon as it is rendered.
+    """
+    for page_number, image in iter_pdf_pages(pdf_path, dpi=dpi, memory_budget_mb=memory_budget_mb, max_edge=max_edge, pages=pages):
+        with tracing.span("encode_jpeg", page=page_number) as span:
+            buffered = io.BytesIO()
+            image.save(buffered, "JPEG", quality=JPEG_QUALITY)
+            span["bytes"] = buffered.tell()
+        yield page_relative_path(page_number), buffered.getvalue()
+
+def pdf_to_jpeg(pdf_path, output_folder, dpi=200, memory_budget_mb=PAGE_MEMORY_BUDGET_MB, on_page=None, max_edge=RASTER_MAX_EDGE, pages=None):
+    """
+    Converts a PDF to JPEG, puts them in subfolders within the output_folder.
+    Pages are rendered in windows bounded by memory_budget_mb, and on_page(image_path) is
+    called as soon as each JPEG is written. Returns the JPEG paths in page order.
+    """
+    image_paths = []
+    for relative_path, data in iter_jpeg_pages(pdf_path, dpi=dpi, memory_budget_mb=memory_budget_mb, max_edge=max_edge, pages=pages):
+        image_path = os.path.join(output_folder, relative_path)
+        os.makedirs(os.path.dirname(image_path), exist_ok=True)
+        with open(image_path, "wb") as f:
+            f.write(data)
+        image_paths.append(image_path)
+        if on_page:
+            on_page(image_path)
+    return image_paths
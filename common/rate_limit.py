@@ -0,0 +1,132 @@
+"""
+Client-side rate limiting for the model APIs: async token buckets that are re-synced from the
+provider's rate-limit response headers, plus jittered exponential backoff.
+"""
+import asyncio
+import random
+import re
+import time
+from datetime import datetime, timezone
+
+class TokenBucket:
+    """
+    Async token bucket. It starts from a configured per-minute rate and is corrected from
+    the provider's view (limit / remaining / reset) after every response.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.refill_per_second = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        # Waiters queue on the lock, so tokens are handed out first come, first served
+        async with self._lock:
+            while True:
+                self._refill()
+                wait = self.blocked_until - time.monotonic()
+                if wait <= 0:
+                    if self.tokens >= amount:
+                        self.tokens -= amount
+                        return
+                    wait = (amount - self.tokens) / self.refill_per_second
+                await asyncio.sleep(wait)
+
+    def observe(self, limit=None, remaining=None, reset_in=None):
+        self._refill()
+        if limit:
+            self.capacity = limit
+            self.refill_per_second = limit / 60.0
+        if remaining is not None:
+            self.tokens = min(self.tokens, remaining)
+            if remaining <= 0 and reset_in:
+                self.block_for(reset_in)
+
+    def block_for(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+def _header_number(headers, name):
+    value = headers.get(name)
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def _seconds_until(timestamp):
+    """Seconds until an RFC 3339 timestamp, as sent in anthropic-ratelimit-*-reset."""
+    if not timestamp:
+        return None
+    try:
+        reset_at = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return max(0.0, (reset_at - datetime.now(timezone.utc)).total_seconds())
+
+def _duration_seconds(value):
+    """Seconds in a Go-style duration such as "6m0s", "1.5s" or "20ms", as sent in x-ratelimit-reset-*."""
+    if not value:
+        return None
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+def retry_after_seconds(headers):
+    """The server's retry-after hint in seconds, if it sent one."""
+    return _header_number(headers, "retry-after")
+
+def backoff_delay(attempt, base_seconds=1.0, max_seconds=60.0):
+    """Exponential backoff with full jitter, so retrying clients don't move in lockstep."""
+    return random.uniform(0, min(max_seconds, base_seconds * (2 ** attempt)))
+
+class RateLimiter:
+    """Request and input-token buckets for one model API."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    async def acquire(self, tokens):
+        await self.requests.acquire(1)
+        await self.tokens.acquire(tokens)
+
+    def update_from_headers(self, headers):
+        prefix = "anthropic-ratelimit-"
+        self.requests.observe(
+            limit=_header_number(headers, prefix + "requests-limit"),
+            remaining=_header_number(headers, prefix + "requests-remaining"),
+            reset_in=_seconds_until(headers.get(prefix + "requests-reset")),
+        )
+        # Newer responses report input tokens separately; older ones only the combined bucket
+        token_prefix = prefix + ("input-tokens-" if headers.get(prefix + "input-tokens-limit") else "tokens-")
+        self.tokens.observe(
+            limit=_header_number(headers, token_prefix + "limit"),
+            remaining=_header_number(headers, token_prefix + "remaining"),
+            reset_in=_seconds_until(headers.get(token_prefix + "reset")),
+        )
+
+    def update_from_openai_headers(self, headers):
+        self.requests.observe(
+            limit=_header_number(headers, "x-ratelimit-limit-requests"),
+            remaining=_header_number(headers, "x-ratelimit-remaining-requests"),
+            reset_in=_duration_seconds(headers.get("x-ratelimit-reset-requests")),
+        )
+        self.tokens.observe(
+            limit=_header_number(headers, "x-ratelimit-limit-tokens"),
+            remaining=_header_number(headers, "x-ratelimit-remaining-tokens"),
+            reset_in=_duration_seconds(headers.get("x-ratelimit-reset-tokens")),
+        )
+
+    def pause(self, seconds):
+        """Stops all new requests for a while, e.g. after a 429."""
+        self.requests.block_for(seconds)
@@ -0,0 +1,52 @@
+"""
+Index of the reports waiting to be emailed, by recipient.
+
+7email sends a recipient's recent reports in one message. Finding them by listing the report
+folders would cost more with every report ever written, so the report stage records each report
+it finishes under its recipient instead, and 7email lists only that recipient's entries:
+
+    job_state/email/pending/<recipient hash>/<report name>
+
+An entry is removed once its report is sent. One left behind (its report went out on its own
+event before the entry was written, or was never sent) is dropped the next time the recipient's
+entries are listed, so the listing stays the size of what is actually pending.
+"""
+import os
+import re
+import hashlib
+import logging
+
+from common.tracing import SENDER_METADATA_KEY
+
+REPORT_INDEX_FOLDER = "job_state/email/pending/"
+EMAIL_ADDRESS = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+
+def recipient_for(file_name, metadata=None):
+    """
+    The original sender: the "sender" metadata set on the upload and carried to the report, else
+    an email address in the report's file name. None if neither says.
+    """
+    sender = (metadata or {}).get(SENDER_METADATA_KEY)
+    if sender:
+        return sender
+    match = EMAIL_ADDRESS.search(os.path.basename(file_name))
+    return match.group(0) if match else None
+
+def index_prefix(recipient):
+    # Hashed, so addresses don't show up in object names
+    return f"{REPORT_INDEX_FOLDER}{hashlib.sha256(recipient.strip().lower().encode('utf-8')).hexdigest()[:16]}/"
+
+def add(bucket, report_name, recipient):
+    """Records a finished report as waiting to be sent to recipient."""
+    bucket.blob(index_prefix(recipient) + report_name).upload_from_string(b"")
+
+def remove(bucket, report_name, recipient):
+    try:
+        bucket.blob(index_prefix(recipient) + report_name).delete()
+    except Exception as e:
+        logging.debug(f"Could not remove {report_name} from the report index: {e}")
+
+def pending(bucket, recipient):
+    """(report name, index entry blob) for every report waiting to be sent to recipient."""
+    prefix = index_prefix(recipient)
+    return [(entry.name[len(prefix):], entry) for entry in bucket.list_blobs(prefix=prefix)]
@@ -0,0 +1,72 @@
+"""
+Process setup shared by the stages, done as late as possible.
+
+Every bucket event fires every stage, and most invocations return at the first name check,
+so whatever a main.py does at import time is paid on each cold start whether the event is
+used or not. setup() only does the cheap part (logging, .env). Service-account credentials
+are loaded on first use and kept for the life of the instance, and heavy SDKs (anthropic,
+openai, googleapiclient, documentai, pubsub) are imported inside the functions that use
+them, as the factories in clients.py already do.
+
+Measure a stage's import cost with:
+
+    python -m common.import_profile 4jpeg_to_text_claude
+"""
+import os
+import logging
+import threading
+
+DEFAULT_SCOPES = ('https://www.googleapis.com/auth/cloud-platform',)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG').upper()
+LOG_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_credentials = {}  # scopes -> credentials (None for application default credentials)
+_lock = threading.Lock()
+_configured = False
+
+def setup():
+    """Configures logging and loads .env. Called at the top of each main.py; later calls do nothing."""
+    global _configured
+    if _configured:
+        return
+    _configured = True
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT, datefmt=LOG_DATE_FORMAT)
+
+    try:
+        from dotenv import load_dotenv
+    except ImportError:  # Not every stage ships python-dotenv; the platform sets the environment
+        return
+    logging.debug("Loading environment variables from .env file")
+    load_dotenv()
+
+def _load_credentials(scopes):
+    service_account_file = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
+    logging.debug(f"Service Account File: {service_account_file}")
+    logging.debug(f"Scopes: {list(scopes)}")
+
+    if not service_account_file:
+        # Application default credentials; also lets a stage run with no GCP at all (pipeline/runner.py)
+        logging.debug("No service account file set, using application default credentials")
+        return None
+
+    from google.oauth2 import service_account
+    try:
+        loaded = service_account.Credentials.from_service_account_file(service_account_file, scopes=list(scopes))
+    except Exception as e:
+        logging.error(f"Error loading service account credentials: {e}")
+        raise
+    logging.debug("Service account credentials loaded successfully")
+    return loaded
+
+def credentials(scopes=DEFAULT_SCOPES):
+    """
+    Service-account credentials from GOOGLE_APPLICATION_CREDENTIALS for the given scopes,
+    loaded on first use and reused afterwards, or None for application default credentials.
+    """
+    scopes = tuple(scopes)
+    if scopes not in _credentials:
+        with _lock:
+            if scopes not in _credentials:
+                _credentials[scopes] = _load_credentials(scopes)
+    return _credentials[scopes]
@@ -0,0 +1,169 @@
+"""
+Scratch space on local disk, shared by the stages.
+
+/tmp on Cloud Functions is memory: every byte a stage leaves there stays charged to the
+instance, and a warm instance that leaks a little per event is eventually OOM-killed. Fixed
+names (/tmp/<file name>) also let two jobs with the same file name overwrite each other.
+Stages take their local files from here instead:
+
+    with scratch.workspace("pdf_to_jpeg", job_id) as ws:
+        ws.reserve(pdf_bytes)  # Waits while other workspaces hold the budget
+        path = ws.join("input.pdf")
+        ...
+
+- workspace() is a directory unique to the invocation, removed when the with block exits,
+  on error as well, so an instance returns to the same baseline after every event;
+- bytes are reserved against SCRATCH_BUDGET_MB before they are written. reserve() waits for
+  other workspaces to release theirs (and raises ScratchFull after SCRATCH_WAIT_SECONDS, so
+  the event is retried); available() lets a stage that is short of space switch to streaming
+  instead, as the OCR stage does by transcribing a large job in windows of pages;
+- workspaces left by an instance that crashed mid-event are removed on first use.
+"""
+import os
+import re
+import time
+import uuid
+import shutil
+import logging
+import threading
+from contextlib import contextmanager
+
+SCRATCH_ROOT = os.getenv('SCRATCH_ROOT', '/tmp/scratch')
+SCRATCH_BUDGET_BYTES = int(os.getenv('SCRATCH_BUDGET_MB', '512')) * 1024 * 1024  # Share of the instance memory /tmp may use
+SCRATCH_WAIT_SECONDS = float(os.getenv('SCRATCH_WAIT_SECONDS', '60'))  # How long reserve() waits for space
+SCRATCH_ORPHAN_SECONDS = 3600  # An older workspace that no live invocation owns was left by a crash
+
+class ScratchFull(Exception):
+    """Raised by reserve() when the budget doesn't free up in time."""
+
+def directory_bytes(path):
+    total = 0
+    for folder, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(folder, name))
+            except OSError:
+                pass  # Removed while walking
+    return total
+
+class Workspace:
+    """One invocation's scratch directory and the bytes it has reserved."""
+
+    def __init__(self, scratch, path):
+        self.scratch = scratch
+        self.path = path
+        self.reserved = 0
+        self._lock = threading.Lock()  # Stages release from their upload threads
+
+    def join(self, *parts):
+        """A path inside the workspace; parent directories are created."""
+        path = os.path.join(self.path, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def available(self):
+        return self.scratch.available()
+
+    def reserve(self, nbytes, timeout=None):
+        self.scratch.reserve(nbytes, timeout)
+        with self._lock:
+            self.reserved += nbytes
+
+    def release(self, nbytes):
+        with self._lock:
+            nbytes = min(nbytes, self.reserved)
+            self.reserved -= nbytes
+        self.scratch.release(nbytes)
+
+class Scratch:
+    """The instance's scratch root and budget. Thread-safe."""
+
+    def __init__(self, root=SCRATCH_ROOT, budget_bytes=SCRATCH_BUDGET_BYTES):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        self.reserved = 0
+        self.peak = 0
+        self._live = set()
+        self._condition = threading.Condition()
+        self._swept = False
+
+    def available(self):
+        with self._condition:
+            return max(0, self.budget_bytes - self.reserved)
+
+    def reserve(self, nbytes, timeout=None):
+        """
+        Reserves nbytes, waiting up to timeout (SCRATCH_WAIT_SECONDS by default) for other
+        workspaces to release space. More than the whole budget is granted only when nothing
+        else is reserved, so an oversized job runs on its own rather than never.
+        """
+        timeout = SCRATCH_WAIT_SECONDS if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self.reserved and self.reserved + nbytes > self.budget_bytes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ScratchFull(f"Needed {nbytes / 1048576:.0f} MB of scratch space, {(self.budget_bytes - self.reserved) / 1048576:.0f} MB free after {timeout:.0f}s")
+                self._condition.wait(remaining)
+            if nbytes > self.budget_bytes:
+                logging.warning(f"Reserving {nbytes / 1048576:.0f} MB of scratch space, over the {self.budget_bytes / 1048576:.0f} MB budget")
+            self.reserved += nbytes
+            self.peak = max(self.peak, self.reserved)
+
+    def release(self, nbytes):
+        with self._condition:
+            self.reserved = max(0, self.reserved - nbytes)
+            self._condition.notify_all()
+
+    def sweep(self):
+        """Removes workspaces that no live invocation owns and that are older than SCRATCH_ORPHAN_SECONDS."""
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(self.root, name)
+            try:
+                age = time.time() - os.path.getmtime(path)
+            except OSError:
+                continue
+            if path not in self._live and age > SCRATCH_ORPHAN_SECONDS:
+                logging.warning(f"Removing scratch workspace {name} left behind {age:.0f}s ago ({directory_bytes(path) / 1048576:.1f} MB)")
+                shutil.rmtree(path, ignore_errors=True)
+
+    @contextmanager
+    def workspace(self, stage, job=None):
+        if not self._swept:
+            self._swept = True
+            self.sweep()
+        label = re.sub(r"[^\w.-]", "_", f"{stage}-{job}" if job else stage)[:80]
+        path = os.path.join(self.root, f"{label}-{uuid.uuid4().hex[:8]}")
+        os.makedirs(path)
+        workspace = Workspace(self, path)
+        with self._condition:
+            self._live.add(path)
+        try:
+            yield workspace
+        finally:
+            used = directory_bytes(workspace.path)
+            shutil.rmtree(workspace.path, ignore_errors=True)
+            workspace.release(workspace.reserved)
+            with self._condition:
+                self._live.discard(path)
+            logging.debug(f"Removed scratch workspace {os.path.basename(path)} ({used / 1048576:.1f} MB on disk at exit, instance peak {self.peak / 1048576:.1f} MB reserved)")
+
+_scratch = None
+_lock = threading.Lock()
+
+def get_scratch():
+    """The instance's Scratch, created on first use."""
+    global _scratch
+    if _scratch is None:
+        with _lock:
+            if _scratch is None:
+                _scratch = Scratch()
+    return _scratch
+
+def workspace(stage, job=None):
+    """A scratch workspace for one invocation of stage on job; see the module docstring."""
+    return get_scratch().workspace(stage, job)
@@ -0,0 +1,61 @@
+"""
+TTL cache for Secret Manager payloads that lives for the life of a warm instance.
+
+A value is served from memory until it expires. Inside the refresh window before that, the
+cached value is still returned and a single background thread fetches the new one, so a
+request only waits on Secret Manager on a cold start or after a long idle period.
+"""
+import os
+import time
+import logging
+import threading
+
+from common.clients import secret_manager_client
+
+SECRET_TTL_SECONDS = int(os.getenv('SECRET_TTL_SECONDS', '600'))
+SECRET_REFRESH_SECONDS = int(os.getenv('SECRET_REFRESH_SECONDS', '120'))  # Refresh this long before expiry
+LOCAL_SECRETS_DIR = os.getenv('LOCAL_SECRETS_DIR')  # Read secrets from <dir>/<secret_id> files instead (local runs)
+
+_entries = {}  # name -> (payload, fetched_at)
+_refreshing = set()
+_lock = threading.Lock()
+
+def _fetch(name, credentials):
+    response = secret_manager_client(credentials).access_secret_version(request={"name": name})
+    payload = response.payload.data.decode("UTF-8")
+    with _lock:
+        _entries[name] = (payload, time.monotonic())
+    return payload
+
+def _refresh_in_background(name, credentials):
+    def refresh():
+        try:
+            _fetch(name, credentials)
+        except Exception as e:
+            logging.warning(f"Background refresh of {name} failed, keeping the cached value: {e}")
+        finally:
+            with _lock:
+                _refreshing.discard(name)
+
+    with _lock:
+        if name in _refreshing:
+            return
+        _refreshing.add(name)
+    threading.Thread(target=refresh, daemon=True).start()
+
+def get_secret(project_id, secret_id, version_id="latest", credentials=None):
+    """Returns the secret payload, from the cache when it is fresh enough."""
+    if LOCAL_SECRETS_DIR:
+        with open(os.path.join(LOCAL_SECRETS_DIR, secret_id), encoding="utf-8") as f:
+            return f.read().strip()
+
+    name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
+    entry = _entries.get(name)
+    if entry is not None:
+        payload, fetched_at = entry
+        age = time.monotonic() - fetched_at
+        if age < SECRET_TTL_SECONDS:
+            if age >= SECRET_TTL_SECONDS - SECRET_REFRESH_SECONDS:
+                _refresh_in_background(name, credentials)
+            return payload
+    return _fetch(name, credentials)
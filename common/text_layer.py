@@ -0,0 +1,114 @@
+"""
+Per-page text-layer detection for PDFs.
+
+Exported reports and score printouts carry their text, so rendering those pages and reading
+them back with vision OCR costs an API call for text we already have. classify_pages()
+reads every page's text layer with one pdftotext run, and each page is classified by it:
+
+- enough characters (TEXT_LAYER_MIN_CHARS) to be the page's content rather than a header
+  or page number over a scan;
+- glyph sanity: few replacement, private-use or control characters (fonts without a usable
+  Unicode mapping extract as those), and mostly word-like tokens (broken mappings that do
+  produce letters produce gibberish);
+- little of the page covered by images (pdfimages -list), so a scan with a hidden OCR
+  layer, or a chart the text doesn't describe, still goes to the model.
+
+Pages that pass keep their extracted text; the rest are rasterized. Without poppler's tools,
+or on any error, every page is rasterized as before.
+"""
+import os
+import logging
+import subprocess
+import unicodedata
+
+TEXT_LAYER_MIN_CHARS = int(os.getenv('TEXT_LAYER_MIN_CHARS', '200'))
+TEXT_LAYER_MAX_BAD_GLYPHS = float(os.getenv('TEXT_LAYER_MAX_BAD_GLYPHS', '0.02'))  # Share of non-space characters
+TEXT_LAYER_MIN_WORD_RATIO = float(os.getenv('TEXT_LAYER_MIN_WORD_RATIO', '0.6'))  # Share of tokens that look like words
+TEXT_LAYER_MAX_IMAGE_COVERAGE = float(os.getenv('TEXT_LAYER_MAX_IMAGE_COVERAGE', '0.5'))  # Share of the page area
+TEXT_LAYER_TIMEOUT_SECONDS = 120
+
+def page_texts(pdf_path):
+    """Each page's text layer, in page order (pdftotext ends every page with a form feed)."""
+    result = subprocess.run(
+        ["pdftotext", "-layout", "-enc", "UTF-8", pdf_path, "-"],
+        check=True, capture_output=True, timeout=TEXT_LAYER_TIMEOUT_SECONDS,
+    )
+    return result.stdout.decode("utf-8", errors="replace").split("\f")[:-1]
+
+def page_size_points(pdf_info):
+    """Page width and height in points from pdfinfo, letter if it doesn't report a size."""
+    try:
+        dims = pdf_info.get("Page size", "").split(" pts")[0].split(" x ")
+        return float(dims[0]), float(dims[1])
+    except (IndexError, ValueError):
+        return 612.0, 792.0
+
+def image_coverage(pdf_path, page_width_pts, page_height_pts):
+    """
+    Page number -> share of the page area covered by embedded images, from each image's pixel
+    size and resolution. Uses one page size for the whole document, as pdfinfo reports it.
+    """
+    result = subprocess.run(
+        ["pdfimages", "-list", pdf_path],
+        check=True, capture_output=True, timeout=TEXT_LAYER_TIMEOUT_SECONDS,
+    )
+    page_area = page_width_pts * page_height_pts
+    coverage = {}
+    for line in result.stdout.decode("utf-8", errors="replace").splitlines()[2:]:  # Header and rule
+        columns = line.split()
+        try:
+            page, image_type, width, height = int(columns[0]), columns[2], int(columns[3]), int(columns[4])
+            x_ppi, y_ppi = float(columns[12]), float(columns[13])
+        except (IndexError, ValueError):
+            continue
+        if image_type != "image" or not x_ppi or not y_ppi:
+            continue  # Soft masks and stencils repeat an image's area
+        area = (width / x_ppi * 72) * (height / y_ppi * 72)
+        coverage[page] = min(1.0, coverage.get(page, 0.0) + area / page_area)
+    return coverage
+
+def is_bad_glyph(char):
+    if char == "\ufffd":
+        return True
+    category = unicodedata.category(char)
+    return category == "Co" or (category == "Cc" and char not in "\t\n\r")
+
+def is_word(token):
+    alphanumeric = sum(char.isalnum() for char in token)
+    return alphanumeric and alphanumeric / len(token) >= 0.5 and len(token) <= 30
+
+def classify_text(text, coverage=0.0):
+    """Why a page's text layer can't stand in for OCR, or None if it can."""
+    characters = [char for char in text if not char.isspace()]
+    if len(characters) < TEXT_LAYER_MIN_CHARS:
+        return "too little text"
+    if sum(is_bad_glyph(char) for char in characters) / len(characters) > TEXT_LAYER_MAX_BAD_GLYPHS:
+        return "unmapped glyphs"
+    tokens = text.split()
+    if sum(bool(is_word(token)) for token in tokens) / len(tokens) < TEXT_LAYER_MIN_WORD_RATIO:
+        return "not word-like"
+    if coverage > TEXT_LAYER_MAX_IMAGE_COVERAGE:
+        return "mostly image"
+    return None
+
+def classify_pages(pdf_path, pdf_info):
+    """
+    One entry per page: {"number", "text", "reason"}. "text" is the page's cleaned-up text layer
+    when it is usable and None when the page has to be rasterized, in which case "reason" says why.
+    """
+    page_count = int(pdf_info["Pages"])
+    try:
+        texts = page_texts(pdf_path)
+        coverage = image_coverage(pdf_path, *page_size_points(pdf_info))
+    except (OSError, subprocess.SubprocessError) as e:
+        logging.warning(f"Could not read the text layer of {os.path.basename(pdf_path)}, rasterizing every page: {e}")
+        return [{"number": number, "text": None, "reason": "no text layer"} for number in range(1, page_count + 1)]
+
+    pages = []
+    for number in range(1, page_count + 1):
+        text = texts[number - 1] if number <= len(texts) else ""
+        reason = classify_text(text, coverage.get(number, 0.0))
+        if reason is None:
+            text = "\n".join(line.rstrip() for line in text.strip("\n").splitlines())
+        pages.append({"number": number, "text": None if reason else text, "reason": reason})
+    return pages
@@ -0,0 +1,136 @@
+"""
+Job tracing across the stages.
+
+A job's trace ID is created where the job enters the pipeline (1unzip, or the first stage that
+sees an object without one) and travels in the custom metadata of every object the stages write,
+so each finalize event hands it to the next stage. The job's tenant and sender, set as "tenant"
+and "sender" metadata on the upload (fair scheduling in common/work_queue.py, and who 7email
+sends the report to), travel the same way. Within a handler, named spans (download,
+convert_from_path, read_and_resize_image, messages.create, upload, ...) record their duration
+and byte counts and are printed as one JSON line each, which Cloud Logging indexes as fields.
+Every handler also records a "trigger" span: the time from its input object's creation to the
+handler starting, i.e. the queueing between stages.
+
+    trace = tracing.start_trace("ocr", event, job=job_id)
+    with tracing.span("download", objects=len(pages)) as span:
+        ...
+        span["bytes"] = total
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+TRACE_SPANS = os.getenv('TRACE_SPANS', '1') == '1'  # 0 keeps the trace IDs flowing but prints no spans
+TRACE_METADATA_KEY = "trace-id"
+TENANT_METADATA_KEY = "tenant"
+SENDER_METADATA_KEY = "sender"
+
+# Spans get their own logger and a bare-message handler so each line stays valid JSON.
+# logging re-creates handler locks after fork, so process pool workers can emit spans too.
+_logger = logging.getLogger("trace")
+_logger.propagate = False
+_handler = logging.StreamHandler(sys.stdout)
+_handler.setFormatter(logging.Formatter("%(message)s"))
+_logger.addHandler(_handler)
+_logger.setLevel(logging.INFO)
+
+# The invocation being traced. A context variable, so a worker running several jobs on threads
+# keeps their traces apart; common.gcs_transfer runs its tasks in the submitting job's context.
+_current = contextvars.ContextVar("trace", default=None)
+
+class Trace:
+    def __init__(self, stage, trace_id=None, job=None, tenant=None, sender=None):
+        self.stage = stage
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.job = job
+        self.tenant = tenant
+        self.sender = sender
+
+def trace_id_from_event(event):
+    """The trace ID in a finalize event's object metadata, if the object carries one."""
+    return (event.get("metadata") or {}).get(TRACE_METADATA_KEY)
+
+def event_age_seconds(event):
+    """Seconds since the event's object was created, from the event's timeCreated."""
+    created = event.get("timeCreated")
+    if not created:
+        return None
+    try:
+        created = datetime.fromisoformat(created.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return max(0.0, (datetime.now(timezone.utc) - created).total_seconds())
+
+def start_trace(stage, event=None, job=None, trace_id=None):
+    """
+    Starts tracing one handler invocation: continues the trace of the event's object, or starts
+    a new trace when the object has none (or there is no event, as for an archive upload).
+    """
+    metadata = (event or {}).get("metadata") or {}
+    trace = Trace(stage, trace_id or trace_id_from_event(event or {}), job, metadata.get(TENANT_METADATA_KEY), metadata.get(SENDER_METADATA_KEY))
+    _current.set(trace)
+    age = event_age_seconds(event or {})
+    if age is not None:
+        record("trigger", age, object=event.get("name"))
+    return trace
+
+def current_trace():
+    return _current.get()
+
+def object_metadata(metadata=None):
+    """Custom metadata for an object written by the current invocation, carrying its trace ID, tenant and sender."""
+    metadata = dict(metadata or {})
+    trace = _current.get()
+    if trace is not None:
+        metadata[TRACE_METADATA_KEY] = trace.trace_id
+        if trace.tenant:
+            metadata[TENANT_METADATA_KEY] = trace.tenant
+        if trace.sender:
+            metadata[SENDER_METADATA_KEY] = trace.sender
+    return metadata or None
+
+def tag_blob(blob):
+    """Sets the trace ID on a blob before it is uploaded, composed or opened for writing."""
+    metadata = object_metadata(blob.metadata)
+    if metadata:
+        blob.metadata = metadata
+    return blob
+
+def record(name, seconds, **attributes):
+    """Emits a span that was timed elsewhere (e.g. time to first token)."""
+    if not TRACE_SPANS:
+        return
+    trace = _current.get()
+    entry = {
+        "severity": "ERROR" if attributes.get("error") else "INFO",
+        "message": f"span {name} {seconds * 1000:.0f}ms",
+        "trace_id": trace.trace_id if trace else None,
+        "stage": trace.stage if trace else None,
+        "job": trace.job if trace else None,
+        "span": name,
+        "duration_ms": round(seconds * 1000, 1),
+        "pid": os.getpid(),
+    }
+    entry.update(attributes)
+    _logger.info(json.dumps(entry, default=str))
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times the block as a span. The yielded dict holds the span's attributes; add to it (bytes,
+    pages, status) before the block ends. An exception is recorded on the span and re-raised.
+    """
+    started = time.perf_counter()
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes["error"] = type(e).__name__
+        raise
+    finally:
+        record(name, time.perf_counter() - started, **attributes)
@@ -0,0 +1,433 @@
+"""
+Work queue for jobs and page batches, with priorities, per-tenant fair share and backpressure.
+
+Storage events fan out with no concurrency control of their own: a clinic that uploads fifty
+files at once takes every instance and the whole model rate limit, and everyone else's
+three-page job waits behind it. Work goes through a queue instead:
+
+- priority: lower numbers run first. Later stages get lower numbers, so jobs already under
+  way finish before new ones start.
+- fair share: among the tenants with ready work at the best priority, the next item goes to
+  the tenant with the least cost in flight, then to the one served least recently. A tenant
+  alone uses the whole capacity and gets an even share as soon as others queue work.
+- a global cap on the cost in flight. An item's cost is the number of model requests it
+  makes (its page batches), and the cap defaults to what the model rate limit sustains
+  (max_in_flight_for_rate_limit). lease() returns nothing while the cap is reached, so
+  workers wait instead of collecting 429s.
+- backpressure: put() raises QueueFull once the queue, or one tenant's part of it, reaches
+  its depth limit. A storage trigger that gets it fails and is redelivered later.
+
+A leased item that isn't acked within its lease (the worker died) is handed out again, and a
+failed one is retried with backoff up to WORK_QUEUE_MAX_ATTEMPTS. MemoryQueue serves one
+process (the local runner, benchmarks, a worker); SQLiteQueue is shared by the worker processes
+on a host and survives restarts.
+
+    queue = queue_from_env()
+    queue.put(WorkItem("ocr", {"name": manifest_name}, tenant="clinic-a", cost=4))
+    drain(queue, handle, workers=4)
+
+In production the storage trigger publishes the item instead (publish_item) and a long-running
+worker pulls the subscription into its queue and drains it (subscribe); the OCR stage runs
+that way when OCR_WORK_TOPIC is set (4jpeg_to_text_claude/main.py). Each Pub/Sub message is
+acked once its item is handled, so a worker that dies loses nothing: the messages it held are
+redelivered.
+"""
+import os
+import json
+import time
+import uuid
+import logging
+import sqlite3
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from common import clients
+from common.rate_limit import backoff_delay
+from common.tracing import TENANT_METADATA_KEY, TRACE_METADATA_KEY
+
+WORK_QUEUE_BACKEND = os.getenv('WORK_QUEUE_BACKEND', 'memory')  # memory or sqlite
+WORK_QUEUE_PATH = os.getenv('WORK_QUEUE_PATH', '/tmp/work_queue.sqlite')
+WORK_QUEUE_MAX_DEPTH = int(os.getenv('WORK_QUEUE_MAX_DEPTH', '1000'))
+WORK_QUEUE_TENANT_MAX_DEPTH = int(os.getenv('WORK_QUEUE_TENANT_MAX_DEPTH', '200'))
+WORK_QUEUE_LEASE_SECONDS = float(os.getenv('WORK_QUEUE_LEASE_SECONDS', '600'))  # Longer than a stage can run
+WORK_QUEUE_MAX_ATTEMPTS = int(os.getenv('WORK_QUEUE_MAX_ATTEMPTS', '5'))
+WORK_QUEUE_RETRY_SECONDS = float(os.getenv('WORK_QUEUE_RETRY_SECONDS', '5'))  # Base of the backoff between attempts
+WORK_TOPIC_PROJECT = os.getenv('WORK_TOPIC_PROJECT', 'alligator-snapper')
+
+# The same settings common/claude_async.py limits its requests with
+CLAUDE_REQUESTS_PER_MINUTE = int(os.getenv('CLAUDE_REQUESTS_PER_MINUTE', '50'))
+CLAUDE_SECONDS_PER_REQUEST = float(os.getenv('CLAUDE_SECONDS_PER_REQUEST', '30'))  # Typical time to transcribe one page batch
+PAGES_PER_REQUEST = int(os.getenv('WORK_PAGES_PER_REQUEST', '9'))  # What 4jpeg's planner fits in one response (8192 x 0.8 / 700 tokens)
+
+DEFAULT_TENANT = "default"
+DEFAULT_PRIORITY = 5
+
+class QueueFull(Exception):
+    """Raised by put() when the queue, or the tenant's part of it, is at its depth limit."""
+
+def max_in_flight_for_rate_limit(requests_per_minute=CLAUDE_REQUESTS_PER_MINUTE, seconds_per_request=CLAUDE_SECONDS_PER_REQUEST):
+    """
+    Model requests that can be in flight without outrunning the rate limit (Little's law:
+    in flight = arrival rate x time in system). More just queue up inside the rate limiter.
+    """
+    return max(1, int(requests_per_minute * seconds_per_request / 60))
+
+WORK_QUEUE_MAX_IN_FLIGHT = int(os.getenv('WORK_QUEUE_MAX_IN_FLIGHT', '0')) or max_in_flight_for_rate_limit()
+
+def page_batches(page_count):
+    """The model requests a job of page_count image pages makes: the cost of its OCR item."""
+    return max(1, -(-int(page_count) // PAGES_PER_REQUEST))
+
+def tenant_of(metadata):
+    """
+    The tenant an object's work is accounted to: the "tenant" metadata set on the upload and
+    carried by every object the stages write, else its trace (one per job), else the default.
+    """
+    metadata = metadata or {}
+    return metadata.get(TENANT_METADATA_KEY) or metadata.get(TRACE_METADATA_KEY) or DEFAULT_TENANT
+
+class WorkItem:
+    """One unit of work: a stage run on an object, or a batch of pages."""
+
+    def __init__(self, kind, payload, tenant=DEFAULT_TENANT, priority=DEFAULT_PRIORITY, cost=1, item_id=None, enqueued=None, attempts=0, not_before=0.0):
+        self.kind = kind
+        self.payload = payload
+        self.tenant = tenant or DEFAULT_TENANT
+        self.priority = priority
+        self.cost = max(1, int(cost))
+        self.item_id = item_id or uuid.uuid4().hex
+        self.enqueued = enqueued if enqueued is not None else time.time()
+        self.attempts = attempts
+        self.not_before = not_before
+
+    def __repr__(self):
+        return f"WorkItem({self.kind}, tenant={self.tenant}, priority={self.priority}, cost={self.cost})"
+
+def fair_choice(heads, in_flight, last_served):
+    """
+    Picks the next item from each waiting tenant's first item (all at the same priority): the
+    tenant with the least cost in flight, then the one served least recently, then the oldest.
+    """
+    return min(heads, key=lambda item: (in_flight.get(item.tenant, 0), last_served.get(item.tenant, 0.0), item.enqueued))
+
+def _check_depth(depth, tenant_depth, item, max_depth, tenant_max_depth):
+    if depth >= max_depth:
+        raise QueueFull(f"Work queue is full ({depth} items)")
+    if tenant_depth >= tenant_max_depth:
+        raise QueueFull(f"Tenant {item.tenant} already has {tenant_depth} items queued")
+
+class MemoryQueue:
+    """The queue in this process's memory. Thread-safe."""
+
+    def __init__(self, max_in_flight=WORK_QUEUE_MAX_IN_FLIGHT, max_depth=WORK_QUEUE_MAX_DEPTH, tenant_max_depth=WORK_QUEUE_TENANT_MAX_DEPTH, lease_seconds=WORK_QUEUE_LEASE_SECONDS):
+        self.max_in_flight = max_in_flight
+        self.max_depth = max_depth
+        self.tenant_max_depth = tenant_max_depth
+        self.lease_seconds = lease_seconds
+        self._ready = {}  # tenant -> [item]
+        self._leased = {}  # item_id -> (item, lease expiry)
+        self._served = {}  # tenant -> when it was last handed an item
+        self._lock = threading.Lock()
+
+    def put(self, item, backpressure=True):
+        """
+        Queues an item. With backpressure, raises QueueFull at the depth limits; follow-on work
+        of a job already in the pipeline is queued with backpressure=False so the job can finish.
+        """
+        with self._lock:
+            if backpressure:
+                tenant_depth = len(self._ready.get(item.tenant, [])) + sum(1 for leased, _ in self._leased.values() if leased.tenant == item.tenant)
+                _check_depth(self._depth(), tenant_depth, item, self.max_depth, self.tenant_max_depth)
+            self._ready.setdefault(item.tenant, []).append(item)
+        return item
+
+    def _depth(self):
+        return sum(len(items) for items in self._ready.values()) + len(self._leased)
+
+    def _expire(self, now):
+        for item_id, (item, expires) in list(self._leased.items()):
+            if expires <= now:
+                logging.warning(f"Lease on {item} expired after {self.lease_seconds:.0f}s, queueing it again")
+                del self._leased[item_id]
+                self._ready.setdefault(item.tenant, []).append(item)
+
+    def lease(self):
+        """The next item to run, or None if nothing is ready or the in-flight cap is reached."""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            heads = []
+            for items in self._ready.values():
+                ready = [item for item in items if item.not_before <= now]
+                if ready:
+                    heads.append(min(ready, key=lambda item: (item.priority, item.enqueued)))
+            if not heads:
+                return None
+            best = min(item.priority for item in heads)
+            in_flight = {}
+            for leased, _ in self._leased.values():
+                in_flight[leased.tenant] = in_flight.get(leased.tenant, 0) + leased.cost
+            item = fair_choice([item for item in heads if item.priority == best], in_flight, self._served)
+            total = sum(in_flight.values())
+            if total and total + item.cost > self.max_in_flight:
+                return None  # An item bigger than the cap still runs, on its own
+
+            self._ready[item.tenant].remove(item)
+            if not self._ready[item.tenant]:
+                del self._ready[item.tenant]
+            item.attempts += 1
+            self._leased[item.item_id] = (item, now + self.lease_seconds)
+            self._served[item.tenant] = now
+            return item
+
+    def ack(self, item):
+        with self._lock:
+            self._leased.pop(item.item_id, None)
+
+    def nack(self, item, delay=0.0):
+        """Returns a leased item to the queue, to be leased again after delay seconds."""
+        with self._lock:
+            if self._leased.pop(item.item_id, None) is None:
+                return
+            item.not_before = time.time() + delay
+            self._ready.setdefault(item.tenant, []).append(item)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "ready": sum(len(items) for items in self._ready.values()),
+                "leased": len(self._leased),
+                "in_flight": sum(item.cost for item, _ in self._leased.values()),
+                "tenants": len(set(self._ready) | {item.tenant for item, _ in self._leased.values()}),
+            }
+
+class SQLiteQueue:
+    """
+    The queue in a SQLite file, shared by every process that opens it. Each lease is one
+    IMMEDIATE transaction, so two workers never take the same item.
+    """
+
+    def __init__(self, path=WORK_QUEUE_PATH, max_in_flight=WORK_QUEUE_MAX_IN_FLIGHT, max_depth=WORK_QUEUE_MAX_DEPTH, tenant_max_depth=WORK_QUEUE_TENANT_MAX_DEPTH, lease_seconds=WORK_QUEUE_LEASE_SECONDS):
+        self.max_in_flight = max_in_flight
+        self.max_depth = max_depth
+        self.tenant_max_depth = tenant_max_depth
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS work_items (item_id TEXT PRIMARY KEY, kind TEXT, payload TEXT, tenant TEXT, "
+            "priority INTEGER, cost INTEGER, enqueued REAL, attempts INTEGER, not_before REAL, leased_until REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS work_items_ready ON work_items (leased_until, priority, enqueued)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS work_tenants (tenant TEXT PRIMARY KEY, served REAL)")
+
+    def _item(self, row):
+        item_id, kind, payload, tenant, priority, cost, enqueued, attempts, not_before = row
+        return WorkItem(kind, json.loads(payload), tenant, priority, cost, item_id, enqueued, attempts, not_before)
+
+    def put(self, item, backpressure=True):
+        """Queues an item; see MemoryQueue.put."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                if backpressure:
+                    depth, tenant_depth = self._db.execute(
+                        "SELECT COUNT(*), COALESCE(SUM(tenant = ?), 0) FROM work_items", (item.tenant,)
+                    ).fetchone()
+                    _check_depth(depth, tenant_depth, item, self.max_depth, self.tenant_max_depth)
+                self._db.execute(
+                    "INSERT INTO work_items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)",
+                    (item.item_id, item.kind, json.dumps(item.payload), item.tenant, item.priority, item.cost, item.enqueued, item.attempts, item.not_before),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return item
+
+    def lease(self):
+        """The next item to run, or None; see MemoryQueue.lease."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                expired = self._db.execute("UPDATE work_items SET leased_until = NULL WHERE leased_until <= ?", (now,)).rowcount
+                if expired:
+                    logging.warning(f"{expired} work item lease(s) expired, queueing them again")
+
+                rows = self._db.execute(
+                    "SELECT item_id, kind, payload, tenant, priority, cost, enqueued, attempts, not_before FROM work_items "
+                    "WHERE leased_until IS NULL AND not_before <= ? AND priority = "
+                    "(SELECT MIN(priority) FROM work_items WHERE leased_until IS NULL AND not_before <= ?) ORDER BY enqueued",
+                    (now, now),
+                ).fetchall()
+                heads = {}
+                for row in rows:
+                    heads.setdefault(row[3], row)  # Each tenant's oldest item
+                if not heads:
+                    self._db.execute("COMMIT")
+                    return None
+
+                in_flight = dict(self._db.execute("SELECT tenant, SUM(cost) FROM work_items WHERE leased_until IS NOT NULL GROUP BY tenant").fetchall())
+                served = dict(self._db.execute("SELECT tenant, served FROM work_tenants").fetchall())
+                item = fair_choice([self._item(row) for row in heads.values()], in_flight, served)
+                total = sum(in_flight.values())
+                if total and total + item.cost > self.max_in_flight:
+                    self._db.execute("COMMIT")
+                    return None
+
+                item.attempts += 1
+                self._db.execute("UPDATE work_items SET leased_until = ?, attempts = ? WHERE item_id = ?", (now + self.lease_seconds, item.attempts, item.item_id))
+                self._db.execute("INSERT OR REPLACE INTO work_tenants VALUES (?, ?)", (item.tenant, now))
+                self._db.execute("COMMIT")
+                return item
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def ack(self, item):
+        with self._lock:
+            self._db.execute("DELETE FROM work_items WHERE item_id = ?", (item.item_id,))
+
+    def nack(self, item, delay=0.0):
+        with self._lock:
+            self._db.execute(
+                "UPDATE work_items SET leased_until = NULL, not_before = ? WHERE item_id = ? AND leased_until IS NOT NULL",
+                (time.time() + delay, item.item_id),
+            )
+
+    def stats(self):
+        with self._lock:
+            ready, leased, in_flight, tenants = self._db.execute(
+                "SELECT COALESCE(SUM(leased_until IS NULL), 0), COALESCE(SUM(leased_until IS NOT NULL), 0), "
+                "COALESCE(SUM(CASE WHEN leased_until IS NOT NULL THEN cost END), 0), COUNT(DISTINCT tenant) FROM work_items"
+            ).fetchone()
+        return {"ready": ready, "leased": leased, "in_flight": in_flight, "tenants": tenants}
+
+def publish(topic_id, message, project_id=WORK_TOPIC_PROJECT, **attributes):
+    """
+    Publishes a message through the instance's shared, batching PublisherClient and returns its
+    future. Attributes (tenant, priority, cost) let a subscriber queue it without reading it.
+    """
+    publisher = clients.publisher_client()
+    topic_path = publisher.topic_path(project_id, topic_id)
+    return publisher.publish(topic_path, message.encode("utf-8"), **{key: str(value) for key, value in attributes.items()})
+
+def publish_item(topic_id, item, project_id=WORK_TOPIC_PROJECT):
+    """Publishes a WorkItem for subscribe(): the payload as JSON, the scheduling fields as attributes."""
+    return publish(topic_id, json.dumps(item.payload), project_id, kind=item.kind, tenant=item.tenant, priority=item.priority, cost=item.cost)
+
+def item_from_message(message):
+    """The WorkItem a message from publish_item() describes; the message ID is its item ID."""
+    attributes = message.attributes
+    return WorkItem(
+        attributes.get("kind", ""), json.loads(message.data),
+        tenant=attributes.get("tenant"), priority=int(attributes.get("priority", DEFAULT_PRIORITY)),
+        cost=int(attributes.get("cost", 1)), item_id=message.message_id,
+    )
+
+def queue_from_env(**kwargs):
+    """Builds the queue configured by WORK_QUEUE_BACKEND."""
+    if WORK_QUEUE_BACKEND == "sqlite":
+        return SQLiteQueue(**kwargs)
+    return MemoryQueue(**kwargs)
+
+def drain(queue, handle, workers=1, refill=None, max_attempts=WORK_QUEUE_MAX_ATTEMPTS, idle_seconds=0.05):
+    """
+    Runs handle(item) on a pool of workers until the queue is empty and nothing is in flight.
+    refill(), if given, is called before every lease to queue newly arrived work (the local
+    runner queues the events its stages produced). A failed item is retried with backoff and
+    dropped, with an error, after max_attempts. Returns the number of items handled.
+    """
+    handled = 0
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            if refill:
+                refill()
+            item = queue.lease() if len(running) < workers else None
+            if item is not None:
+                running[executor.submit(handle, item)] = item
+                continue
+            if not running:
+                if not queue.stats()["ready"]:
+                    return handled
+                time.sleep(idle_seconds)  # Everything ready is waiting out a retry delay
+                continue
+
+            done, _ = wait(running, timeout=idle_seconds, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = running.pop(future)
+                handled += 1
+                error = future.exception()
+                if error is None:
+                    queue.ack(item)
+                elif item.attempts >= max_attempts:
+                    logging.error(f"Giving up on {item} after {item.attempts} attempts: {error}")
+                    queue.ack(item)
+                else:
+                    delay = backoff_delay(item.attempts, base_seconds=WORK_QUEUE_RETRY_SECONDS)
+                    logging.warning(f"{item} failed (attempt {item.attempts}), retrying in {delay:.1f}s: {error}")
+                    queue.nack(item, delay)
+
+
+def subscribe(subscription_id, handle, queue=None, workers=1, project_id=WORK_TOPIC_PROJECT, max_attempts=WORK_QUEUE_MAX_ATTEMPTS, idle_seconds=1.0):
+    """
+    Pulls the items published with publish_item() from a Pub/Sub subscription into queue
+    (queue_from_env() by default) and drains it with handle(item) on workers threads, until the
+    stream fails or the process is stopped. The client extends the ack deadlines of the messages
+    it holds, so an item can wait its turn in the queue. A message is acked once its item is
+    handled, or nacked, for Pub/Sub's own retry and dead-letter policy, when the queue turns
+    it away (QueueFull) or its item fails max_attempts times.
+    """
+    from google.cloud import pubsub_v1
+
+    queue = queue or queue_from_env()
+    messages = {}  # item ID -> the message it came in
+    lock = threading.Lock()
+
+    def receive(message):
+        with lock:
+            if message.message_id in messages:
+                # Redelivered while its item is still queued: only the newest delivery can be acked
+                messages[message.message_id] = message
+                return
+        item = item_from_message(message)
+        try:
+            queue.put(item)
+        except QueueFull as e:
+            logging.info(f"Returning {item} to the subscription: {e}")
+            message.nack()
+            return
+        with lock:
+            messages[item.item_id] = message
+
+    def settle(item, ack):
+        with lock:
+            message = messages.pop(item.item_id, None)
+        if message is not None:
+            message.ack() if ack else message.nack()
+
+    def run(item):
+        try:
+            handle(item)
+        except Exception:
+            if item.attempts >= max_attempts:
+                settle(item, ack=False)
+            raise
+        settle(item, ack=True)
+
+    subscriber = pubsub_v1.SubscriberClient()
+    subscription_path = subscriber.subscription_path(project_id, subscription_id)
+    flow_control = pubsub_v1.types.FlowControl(max_messages=queue.max_depth)
+    stream = subscriber.subscribe(subscription_path, callback=receive, flow_control=flow_control)
+    logging.info(f"Pulling work from {subscription_path} with {workers} workers")
+    try:
+        while not stream.done():
+            drain(queue, run, workers=workers, max_attempts=max_attempts)
+            time.sleep(idle_seconds)
+        stream.result()  # Raises whatever closed the stream
+    finally:
+        stream.cancel()
+        subscriber.close()
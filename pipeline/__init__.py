@@ -0,0 +1,5 @@
+"""
+Runs the pipeline stages in one process against local storage, for backfills and for running
+everything on one machine without GCP. Run from the repository root, e.g.
+python -m pipeline.runner --root /tmp/pipeline report.pdf
+"""
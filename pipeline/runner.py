@@ -0,0 +1,252 @@
+"""
+In-process pipeline runner.
+
+Each stage's handler is imported from its directory and called directly. Stages are wired
+as a DAG by the objects they consume: when a stage finalizes an object in storage, the
+object's event is queued and handed to every stage that accepts it. There are no cold starts
+and no network hops between stages. Stage runs go through a common.work_queue queue, as they
+would on a shared worker: later stages first, then fair share between tenants, so one
+tenant's batch of uploads doesn't hold up everyone else's jobs; inputs over the queue's depth
+limits wait, like redelivered triggers, until it drains. Storage is pluggable through
+clients.use_storage_client(); the runner installs common.local_storage.LocalStorageClient,
+so the objects stay in a local directory you can inspect afterwards.
+
+Stages hand work to each other through those local objects, not through in-memory return
+values. Every handler reads its input from the bucket and writes its output back, and the
+job state, manifests and trace metadata they rely on live in those objects; handing outputs
+over in memory would take a second code path in every stage, and the runner would no longer
+run the code that runs in production. What the hand-off costs here is a local file write and
+read: no cold start, no download or upload, and an interrupted backfill resumes from the
+objects already written.
+
+    python -m pipeline.runner --root /tmp/pipeline --secrets-dir ./secrets report.pdf notes.docx
+
+Inputs are stored under --prefix (attachments/ by default) in --bucket and run to
+completion; a JSON summary of every stage run is printed at the end. External APIs
+(Anthropic, OpenAI, Document AI, Gmail) are still called; point their base URLs at the
+fakes in bench/ (GMAIL_API_ENDPOINT for Gmail) for a fully offline run.
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+
+from common import clients
+from common.local_storage import LocalStorageClient
+from common.work_queue import MemoryQueue, QueueFull, WorkItem, drain, page_batches, tenant_of
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BUCKET = "bonesjustice"
+FINALIZE_EVENT_TYPE = "google.cloud.storage.object.v1.finalized"
+
+class Stage:
+    """A pipeline stage: its directory, handler and the objects it is triggered by."""
+
+    def __init__(self, name, directory, entry_point, prefix, suffixes, cloud_event=False):
+        self.name = name
+        self.directory = directory
+        self.entry_point = entry_point
+        self.prefix = prefix
+        self.suffixes = suffixes
+        self.cloud_event = cloud_event  # CloudEvent signature instead of (event, context)
+
+    def accepts(self, blob_name):
+        return blob_name.startswith(self.prefix) and blob_name.lower().endswith(self.suffixes)
+
+# In pipeline order; the prefixes and suffixes mirror each handler's own trigger check
+STAGES = [
+    Stage("unzip", "1unzip", "process_archive", "", (".zip", ".7z", ".gzip", ".gz", ".tgz", ".tar"), cloud_event=True),
+    Stage("docx", "2docx", "process_attachments", "attachments/", (".doc", ".docx", ".xls", ".xlsx", ".odt", ".rtf")),
+    Stage("pdf_to_jpeg", "3pdf_to_jpeg", "process_pdfs_in_cloud_storage", "attachments/", (".pdf",)),
+    Stage("ocr", "4jpeg_to_text_claude", "process_jpegs_in_cloud_storage", "attachments/images/", ("/manifest.json",)),
+    Stage("concatenate", "5cat_file", "concatenate_text_files", "attachments/images/", ("/responses.json",)),
+    Stage("report", "6wizard", "process_text_files_in_cloud_storage", "concatenated_text/", (".txt",)),
+    Stage("email", "7email", "email_generated_html", ("chatgpt_output/", "claude_output/"), (".html",)),
+]
+
+class LocalContext:
+    """The fields of google.cloud.functions.Context the handlers log."""
+
+    def __init__(self, event_id, resource):
+        self.event_id = event_id
+        self.event_type = FINALIZE_EVENT_TYPE
+        self.timestamp = datetime.now(timezone.utc).isoformat()
+        self.resource = resource
+
+    def __repr__(self):
+        return f"LocalContext(event_id={self.event_id!r}, resource={self.resource!r})"
+
+class LocalCloudEvent:
+    """Minimal CloudEvent: attributes by subscript, payload in .data."""
+
+    def __init__(self, attributes, data):
+        self.attributes = attributes
+        self.data = data
+
+    def __getitem__(self, key):
+        return self.attributes[key]
+
+class PipelineRunner:
+    def __init__(self, root, stages=STAGES, queue=None):
+        self.storage = LocalStorageClient(root, on_finalize=self._enqueue)
+        self.stages = stages
+        self.queue = queue or MemoryQueue()
+        self.runs = []
+        self.objects_written = 0
+        self._events = deque()  # Appended from transfer threads too; deque appends are thread-safe
+        self._inputs = set()  # (bucket, name) of submitted inputs, the only events subject to backpressure
+        self._held = []  # Inputs the queue turned away, queued again once it drains
+        self._handlers = {}
+
+    def _enqueue(self, bucket_name, blob_name):
+        self.objects_written += 1
+        self._events.append((bucket_name, blob_name))
+
+    def handler(self, stage):
+        """Imports a stage's main.py (once) and returns its entry point."""
+        if stage.name not in self._handlers:
+            path = os.path.join(REPO_ROOT, stage.directory, "main.py")
+            spec = importlib.util.spec_from_file_location(f"pipeline_stage_{stage.name}", path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            self._handlers[stage.name] = getattr(module, stage.entry_point)
+        return self._handlers[stage.name]
+
+    def submit(self, local_path, blob_name, bucket_name=DEFAULT_BUCKET, tenant=None, sender=None):
+        """Stores an input file; its event is queued like any upload. tenant and sender are set as its metadata."""
+        self._inputs.add((bucket_name, blob_name))
+        blob = self.storage.bucket(bucket_name).blob(blob_name)
+        metadata = {key: value for key, value in (("tenant", tenant), ("sender", sender)) if value}
+        blob.metadata = metadata or None
+        blob.upload_from_filename(local_path)
+
+    def _cost(self, stage, blob):
+        """Model requests the stage run makes: the OCR stage's page batches, else 1."""
+        if stage.name != "ocr" or blob is None:
+            return 1
+        try:
+            manifest = json.loads(blob.download_as_bytes())
+            return page_batches(manifest["page_count"] - len(manifest.get("text_pages", {})))
+        except (ValueError, KeyError):
+            return 1
+
+    def _schedule(self):
+        """Turns the events stored so far into work items, one per stage that accepts the object."""
+        held, self._held = self._held, []
+        for item in held:
+            try:
+                self.queue.put(item)
+            except QueueFull:
+                self._held.append(item)
+        while self._events:
+            bucket_name, blob_name = self._events.popleft()
+            blob = None
+            for index, stage in enumerate(self.stages):
+                if not stage.accepts(blob_name):
+                    continue
+                blob = blob or self.storage.bucket(bucket_name).get_blob(blob_name)
+                item = WorkItem(
+                    stage.name, {"bucket": bucket_name, "name": blob_name},
+                    tenant=tenant_of(blob.metadata if blob else None),
+                    priority=len(self.stages) - index,  # Later stages first: finish the jobs under way
+                    cost=self._cost(stage, blob),
+                )
+                try:
+                    self.queue.put(item, backpressure=(bucket_name, blob_name) in self._inputs)
+                except QueueFull as e:
+                    logging.info(f"Holding {blob_name} back: {e}")
+                    self._held.append(item)
+
+    def _handle(self, item):
+        stage = next(stage for stage in self.stages if stage.name == item.kind)
+        bucket_name, blob_name = item.payload["bucket"], item.payload["name"]
+        logging.info(f"Running {stage.name} on {bucket_name}/{blob_name} for {item.tenant}")
+        started = time.perf_counter()
+        error = None
+        try:
+            self._call(stage, bucket_name, blob_name)
+        except Exception as e:
+            # One failed stage run doesn't stop the others, as with separate functions
+            error = f"{type(e).__name__}: {e}"
+            logging.exception(f"Stage {stage.name} failed on {blob_name}")
+        self.runs.append({
+            "stage": stage.name,
+            "object": blob_name,
+            "tenant": item.tenant,
+            "seconds": round(time.perf_counter() - started, 3),
+            "error": error,
+        })
+
+    def _call(self, stage, bucket_name, blob_name):
+        blob = self.storage.bucket(bucket_name).get_blob(blob_name)
+        event = {
+            "bucket": bucket_name,
+            "name": blob_name,
+            "contentType": blob.content_type if blob else None,
+            "size": str(blob.size) if blob else "0",
+            "generation": blob.generation if blob else None,
+            "metadata": blob.metadata if blob else None,  # Carries the trace ID (common/tracing.py)
+            "timeCreated": datetime.now(timezone.utc).isoformat(),
+        }
+        event_id = uuid.uuid4().hex
+        handler = self.handler(stage)
+        if stage.cloud_event:
+            handler(LocalCloudEvent({"id": event_id, "type": FINALIZE_EVENT_TYPE, "source": f"local/{bucket_name}"}, event))
+        else:
+            handler(event, LocalContext(event_id, f"projects/_/buckets/{bucket_name}/objects/{blob_name}"))
+
+    def run(self):
+        """
+        Delivers queued events, including the ones stages produce, until the pipeline is idle.
+        One stage runs at a time, so the runs and their summary come out in a repeatable order;
+        the stages spread their own work out (rasterizing in a process pool, model requests and
+        transfers concurrently), which is where a run spends its time.
+        """
+        clients.use_storage_client(self.storage)
+        try:
+            drain(self.queue, self._handle, workers=1, refill=self._schedule)
+        finally:
+            clients.use_storage_client(None)
+        return self.runs
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+", help="Local files to run through the pipeline")
+    parser.add_argument("--root", default="pipeline_data", help="Directory that holds the local buckets")
+    parser.add_argument("--bucket", default=DEFAULT_BUCKET)
+    parser.add_argument("--prefix", default="attachments/", help="Object prefix the inputs are stored under")
+    parser.add_argument("--tenant", help="Tenant the inputs are submitted for (fair scheduling); each input's own job by default")
+    parser.add_argument("--sender", help="Address the reports are emailed to (set GMAIL_API_ENDPOINT to a fake to stay offline)")
+    parser.add_argument("--secrets-dir", help="Directory of <secret_id> files used instead of Secret Manager")
+    parser.add_argument("--output", help="Also write the JSON summary to this file")
+    args = parser.parse_args()
+
+    # Stages read these at import time, so they are set before any stage is loaded
+    os.environ.setdefault("CLOUD_STORAGE_BUCKET", args.bucket)
+    os.environ.setdefault("WORK_TOPIC", "")  # The runner's own queue schedules the stages; no Pub/Sub
+    if args.secrets_dir:
+        os.environ["LOCAL_SECRETS_DIR"] = os.path.abspath(args.secrets_dir)
+
+    runner = PipelineRunner(args.root)
+    for path in args.inputs:
+        runner.submit(path, args.prefix + os.path.basename(path), args.bucket, args.tenant, args.sender)
+
+    started = time.perf_counter()
+    runs = runner.run()
+    summary = {
+        "seconds": round(time.perf_counter() - started, 3),
+        "runs": runs,
+        "failed": sum(1 for run in runs if run["error"]),
+    }
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+if __name__ == "__main__":
+    main()
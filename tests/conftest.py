@@ -0,0 +1,26 @@
+import os
+import sys
+import importlib.util
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The stages import common/ and bench/ from the repository root
+sys.path.insert(0, ROOT)
+
+def load_stage(folder):
+    """
+    A stage's main.py, imported by path: the stage folders aren't packages. It is registered
+    under its module name so a process pool can pickle the stage's functions.
+    """
+    name = f"stage_{folder}"
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, folder, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture(scope="session")
+def ocr_stage():
+    return load_stage("4jpeg_to_text_claude")
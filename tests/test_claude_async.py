@@ -0,0 +1,48 @@
+import pytest
+
+pytest.importorskip("anthropic")
+
+from bench.fake_anthropic import FakeAnthropicServer
+from common import claude_async
+
+def page_request(label):
+    return {
+        "model": "claude-3-5-sonnet-20240620",
+        "max_tokens": 1024,
+        "messages": [{"role": "user", "content": [
+            {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": "AAAA"}},
+            {"type": "text", "text": label},
+        ]}],
+    }
+
+@pytest.fixture
+def anthropic_server(monkeypatch):
+    # Latencies vary more than tenfold, so requests finish out of order
+    server = FakeAnthropicServer(latency_seconds=(0.01, 0.15), error_rate=0.2, seed=1).start()
+    monkeypatch.setenv("ANTHROPIC_BASE_URL", server.url)
+    yield server
+    server.stop()
+
+def test_results_come_back_in_page_order(anthropic_server):
+    labels = [f"subfolder_{i:02d}" for i in range(1, 13)]
+    finished = []
+    results = claude_async.run_messages(
+        [page_request(label) for label in labels], "fake", concurrency=6, labels=labels,
+        on_result=lambda index, result: finished.append(index),
+    )
+    assert anthropic_server.errors > 0
+    assert [message.content[0].text for message in results] == [f"1 images. {label}" for label in labels]
+    assert sorted(finished) == list(range(len(labels)))
+    assert finished != sorted(finished)
+
+def test_streamed_results_come_back_in_page_order(anthropic_server, tmp_path):
+    labels = [f"subfolder_{i:02d}" for i in range(1, 7)]
+    paths = [tmp_path / f"{label}.txt" for label in labels]
+    results = claude_async.run_streamed_messages(
+        [page_request(label) for label in labels],
+        [lambda path=path: open(path, "wb") for path in paths],
+        "fake", concurrency=3, labels=labels,
+    )
+    assert [message.content[0].text for message, _ in results] == [f"1 images. {label}" for label in labels]
+    # Each page's text went to its own writer
+    assert [path.read_text() for path in paths] == [f"1 images. {label}" for label in labels]
@@ -0,0 +1,23 @@
+import pytest
+
+from common.gcs_transfer import BulkTransfer
+from common.local_storage import LocalStorageClient
+
+@pytest.fixture
+def bucket(tmp_path):
+    bucket = LocalStorageClient(str(tmp_path / "storage")).bucket("uploads")
+    bucket.blob("present.txt").upload_from_string(b"present")
+    return bucket
+
+def test_a_handled_failure_is_not_raised_again(bucket, tmp_path):
+    with BulkTransfer(bucket, retries=0) as transfer:
+        missing = transfer.download_file("missing.txt", str(tmp_path / "missing.txt"))
+        transfer.download_file("present.txt", str(tmp_path / "present.txt"))
+        with pytest.raises(Exception):
+            transfer.wait([missing])
+        assert transfer.wait() == [str(tmp_path / "present.txt")]
+
+def test_wait_raises_failures_nobody_waited_for(bucket, tmp_path):
+    with pytest.raises(Exception):
+        with BulkTransfer(bucket, retries=0) as transfer:
+            transfer.download_file("missing.txt", str(tmp_path / "missing.txt"))
@@ -0,0 +1,59 @@
+import pytest
+
+pytest.importorskip("googleapiclient")
+pytest.importorskip("httplib2")
+
+from bench.fake_gmail import FakeGmailServer
+from common import gmail_delivery
+
+# With this seed the first sends are answered 503, then 429, then 200
+@pytest.fixture
+def gmail(monkeypatch):
+    server = FakeGmailServer(latency_seconds=(0.001, 0.005), error_rate=0.5, seed=10).start()
+    monkeypatch.setattr(gmail_delivery, "GMAIL_API_ENDPOINT", server.url + "/")
+    monkeypatch.setattr(gmail_delivery, "GMAIL_INLINE_MAX_BYTES", 1000)
+    yield server
+    server.stop()
+
+def test_outbox_sends_one_message_per_recipient_through_errors(gmail):
+    outbox = gmail_delivery.Outbox(window_seconds=0.2, workers=1)
+    small = outbox.submit("a@example.com", "chatgpt_output/1/small.html", b"<p>small</p>")
+    large = outbox.submit("a@example.com", "chatgpt_output/2/large.html", b"<p>" + b"x" * 2000 + b"</p>")
+    other = outbox.submit("b@example.com", "chatgpt_output/3/other.html", b"<p>other</p>")
+    assert small is large
+
+    message_id, names = small.result(timeout=60)
+    assert names == ["chatgpt_output/1/small.html", "chatgpt_output/2/large.html"]
+    assert other.result(timeout=60)[1] == ["chatgpt_output/3/other.html"]
+    outbox.close()
+
+    # Both recipients got their message although some sends were answered 429 or 503
+    assert gmail.errors >= 2
+    assert gmail.calls == len(gmail.messages) + gmail.errors
+    sent = {message["to"]: message for message in gmail.messages}
+    assert sorted(sent) == ["a@example.com", "b@example.com"]
+
+    # The small report is inlined, the one over GMAIL_INLINE_MAX_BYTES attached compressed
+    assert sent["a@example.com"]["parts"] == [
+        ("text/plain", None),
+        ("text/html", None),
+        ("application/gzip", "large.html.gz"),
+    ]
+    assert sent["b@example.com"]["parts"] == [("text/html", None)]
+    assert sent["a@example.com"]["subject"].endswith("(2 reports)")
+
+def test_outbox_adds_gathered_reports(gmail):
+    gathered = []
+    def gather(recipient, names):
+        gathered.append((recipient, names))
+        return [("chatgpt_output/0/earlier.html", b"<p>earlier</p>")]
+
+    outbox = gmail_delivery.Outbox(window_seconds=60, workers=1, gather=gather)
+    future = outbox.submit("a@example.com", "chatgpt_output/1/report.html", b"<p>report</p>")
+    outbox.flush()
+    _, names = future.result(timeout=60)
+    outbox.close()
+
+    assert gathered == [("a@example.com", ["chatgpt_output/1/report.html"])]
+    assert names == ["chatgpt_output/1/report.html", "chatgpt_output/0/earlier.html"]
+    assert gmail.messages[-1]["parts"] == [("text/html", None), ("text/html", None)]
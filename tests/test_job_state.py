@@ -0,0 +1,80 @@
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from common import job_state
+from common.local_storage import LocalStorageClient
+
+@pytest.fixture
+def bucket(tmp_path):
+    return LocalStorageClient(str(tmp_path / "storage")).bucket("uploads")
+
+def event(generation=1):
+    return {"bucket": "uploads", "name": "attachments/report.pdf", "generation": generation}
+
+def set_clock(monkeypatch, now):
+    monkeypatch.setattr(job_state, "time", SimpleNamespace(time=lambda: now, monotonic=time.monotonic))
+
+def deliver(bucket, event):
+    """Runs a delivery through once(); returns whether its body ran."""
+    with job_state.once(bucket, "ocr", event) as first:
+        return first
+
+def test_a_job_resumes_from_its_checkpoint(bucket):
+    state = job_state.JobState(bucket, "ocr", "report", source=1)
+    state.complete("part:1-10", [1, 10])
+    state.complete("part:11-20", [11, 20])
+    state.flush()
+
+    resumed = job_state.JobState(bucket, "ocr", "report", source=1)
+    assert resumed.done("part:1-10") and resumed.done("part:11-20")
+    assert resumed.get("part:11-20") == [11, 20]
+    assert not resumed.done("part:21-30")
+
+def test_a_changed_source_starts_over(bucket):
+    state = job_state.JobState(bucket, "ocr", "report", source=1)
+    state.complete("part:1-10", [1, 10])
+    state.flush()
+    assert job_state.JobState(bucket, "ocr", "report", source=2).units == {}
+
+def test_checkpoints_are_batched(bucket, monkeypatch):
+    monkeypatch.setattr(job_state, "STATE_FLUSH_SECONDS", 3600)
+    state = job_state.JobState(bucket, "ocr", "report")
+    state.complete("part:1-10")  # The first completion is written straight away
+    state.complete("part:11-20")
+    assert job_state.JobState(bucket, "ocr", "report").units == {"part:1-10": True}
+    state.flush()
+    assert job_state.JobState(bucket, "ocr", "report").units == {"part:1-10": True, "part:11-20": True}
+
+def test_a_duplicate_delivery_is_skipped(bucket):
+    assert deliver(bucket, event()) is True
+    assert deliver(bucket, event()) is False
+    assert deliver(bucket, event(generation=2)) is True
+
+def test_a_delivery_still_running_is_not_run_twice(bucket):
+    with job_state.once(bucket, "ocr", event()) as first:
+        assert first
+        assert deliver(bucket, event()) is False
+
+def test_a_failed_delivery_gives_its_lease_back(bucket):
+    with pytest.raises(RuntimeError):
+        with job_state.once(bucket, "ocr", event()):
+            raise RuntimeError("timed out")
+    assert deliver(bucket, event()) is True
+
+def test_an_expired_lease_is_taken_over(bucket, monkeypatch):
+    # The first delivery's instance dies once its (short) function timeout is up
+    monkeypatch.setattr(job_state, "EVENT_LEASE_SECONDS", 60)
+    dead = job_state.once(bucket, "ocr", event())
+    assert dead.__enter__() is True
+    marker = next(blob for blob in bucket.list_blobs(prefix="job_state/ocr/events/"))
+    lease = json.loads(marker.download_as_bytes())
+    assert lease["deadline"] == lease["started"] + 60
+
+    set_clock(monkeypatch, lease["started"] + 30)
+    assert deliver(bucket, event()) is False
+    set_clock(monkeypatch, lease["started"] + 61)
+    assert deliver(bucket, event()) is True
+    assert json.loads(marker.download_as_bytes())["status"] == "done"
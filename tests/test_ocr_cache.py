@@ -0,0 +1,103 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from common import ocr_cache
+from common.local_storage import LocalStorageClient
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+        time.sleep(0.01)  # The disk store's LRU order is the files' real mtimes
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ocr_cache, "time", SimpleNamespace(time=clock.time))
+    return clock
+
+def disk_store(tmp_path, **limits):
+    return ocr_cache.DiskCacheStore(str(tmp_path / "disk"), **limits)
+
+def sqlite_store(tmp_path, **limits):
+    return ocr_cache.SQLiteCacheStore(str(tmp_path / "cache.sqlite"), **limits)
+
+def gcs_store(tmp_path, **limits):
+    bucket = LocalStorageClient(str(tmp_path / "gcs")).bucket("b")
+    return ocr_cache.GCSCacheStore(bucket, evict_every=1, touch_seconds=0, **limits)
+
+STORES = [disk_store, sqlite_store, gcs_store]
+
+@pytest.mark.parametrize("make_store", STORES)
+def test_entries_expire_after_the_ttl(make_store, tmp_path, clock):
+    store = make_store(tmp_path, ttl_seconds=100, max_entries=10)
+    store.put("page", "text")
+    clock.advance(60)
+    assert store.get("page") == "text"
+    # The TTL runs from the write; the hit above doesn't extend it
+    clock.advance(41)
+    assert store.get("page") is None
+    store.put("page", "new text")
+    assert store.get("page") == "new text"
+
+@pytest.mark.parametrize("make_store", STORES)
+def test_least_recently_used_entry_is_evicted(make_store, tmp_path, clock):
+    store = make_store(tmp_path, ttl_seconds=1000, max_entries=2)
+    assert store.put("a", "A") == 0
+    clock.advance(1)
+    assert store.put("b", "B") == 0
+    clock.advance(1)
+    assert store.get("a") == "A"
+    clock.advance(1)
+    assert store.put("c", "C") == 1
+    assert store.get("b") is None
+    assert (store.get("a"), store.get("c")) == ("A", "C")
+
+def test_gcs_hit_updates_the_access_time_only_once_it_is_stale(tmp_path, clock):
+    bucket = LocalStorageClient(str(tmp_path / "gcs")).bucket("b")
+    store = ocr_cache.GCSCacheStore(bucket, ttl_seconds=10_000, touch_seconds=3600)
+    store.put("page", "text")
+    accessed = lambda: bucket.get_blob(store.prefix + "page").metadata["accessed"]
+    written = accessed()
+    clock.advance(60)
+    assert store.get("page") == "text"
+    assert accessed() == written
+    clock.advance(3600)
+    assert store.get("page") == "text"
+    assert float(accessed()) == clock.now
+
+def test_cache_counts_and_treats_store_errors_as_misses(tmp_path):
+    cache = ocr_cache.OCRCache(disk_store(tmp_path))
+    cache.put("page", "text")
+    assert cache.get("page") == "text"
+    assert cache.get("other") is None
+
+    broken = ocr_cache.OCRCache(SimpleNamespace(get=lambda key: 1 / 0, put=lambda key, value: 1 / 0))
+    assert broken.get("page") is None
+    broken.put("page", "text")
+    assert cache.stats() == {"hits": 1, "misses": 1, "writes": 1, "evictions": 0, "hit_rate": 0.5}
+    assert broken.stats()["misses"] == 1 and broken.stats()["writes"] == 0
+
+def test_key_changes_with_the_prompts_and_model_only():
+    key = ocr_cache.cache_key(["AAAA"], "system", "user", "model")
+    assert key == ocr_cache.cache_key([b"AAAA"], "system", "user", "model")
+    assert key != ocr_cache.cache_key(["AAAB"], "system", "user", "model")
+    assert key != ocr_cache.cache_key(["AAAA"], "system v2", "user", "model")
+    assert key != ocr_cache.cache_key(["AAAA"], "system", "user v2", "model")
+    assert key != ocr_cache.cache_key(["AAAA"], "system", "user", "other model")
+
+def test_split_page_texts_by_labels(ocr_stage):
+    group = [{"number": number, "skip": False} for number in (7, 8, 9)]
+    text = "Image 1:\nfirst page\n\n**Image 2:**\nsecond\n## Image 3:\nthird"
+    assert ocr_stage.split_page_texts(group, text) == {1: "first page", 2: "second", 3: "third"}
+    # Labels out of order or past the group's pages: nothing can be attributed, so nothing is cached
+    assert ocr_stage.split_page_texts(group, "Image 2:\nb\nImage 1:\na") == {}
+    assert ocr_stage.split_page_texts(group, "Image 4:\nd") == {}
+    assert ocr_stage.split_page_texts(group[:1], "unlabelled") == {1: "unlabelled"}
@@ -0,0 +1,95 @@
+import io
+import zipfile
+
+import pytest
+from PIL import Image
+
+from common import office_text
+
+DOCX_NS = (
+    'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" '
+    'xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"'
+)
+
+def png(size=(400, 300)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, "white").save(buffer, "PNG")
+    return buffer.getvalue()
+
+def paragraph(text):
+    return f"<w:p><w:r><w:t>{text}</w:t></w:r></w:p>"
+
+def picture(rel_id):
+    return f'<w:p><w:r><w:drawing><a:graphic><a:graphicData><a:blip r:embed="{rel_id}"/></a:graphicData></a:graphic></w:drawing></w:r></w:p>'
+
+def table(rows):
+    cells = "".join(
+        "<w:tr>" + "".join(f"<w:tc>{paragraph(cell)}</w:tc>" for cell in row) + "</w:tr>"
+        for row in rows
+    )
+    return f"<w:tbl>{cells}</w:tbl>"
+
+def write_docx(path, body, media):
+    rels = "".join(
+        f'<Relationship Id="{rel_id}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/image" Target="media/{rel_id}.png"/>'
+        for rel_id in media
+    )
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("word/document.xml", f"<w:document {DOCX_NS}><w:body>{body}</w:body></w:document>")
+        archive.writestr("word/_rels/document.xml.rels", f'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">{rels}</Relationships>')
+        for rel_id, data in media.items():
+            archive.writestr(f"word/media/{rel_id}.png", data)
+    return str(path)
+
+def test_docx_text_tables_and_images_in_document_order(tmp_path):
+    image = png()
+    body = paragraph("Report for Alex") + paragraph("Scores below") + picture("rId5") + table([["Reading", "12"], ["Maths", "14"]])
+    path = write_docx(tmp_path / "report.docx", body, {"rId5": image})
+    assert office_text.extract_document(path) == [
+        ("text", "Report for Alex\nScores below"),
+        ("image", image),
+        ("text", "Reading | 12\nMaths | 14"),
+    ]
+
+def test_a_docx_with_nothing_usable_is_converted_instead(tmp_path):
+    assert office_text.extract_document(write_docx(tmp_path / "empty.docx", paragraph(" "), {})) is None
+
+def test_unreadable_and_unsupported_files_are_converted_instead(tmp_path):
+    broken = tmp_path / "broken.docx"
+    broken.write_bytes(b"not a zip")
+    assert office_text.extract_document(str(broken)) is None
+    assert office_text.extract_document(str(tmp_path / "letter.doc")) is None
+
+def test_odt_text_and_images(tmp_path):
+    image = png()
+    content = (
+        '<office:document-content xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+        'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+        'xmlns:draw="urn:oasis:names:tc:opendocument:xmlns:drawing:1.0" '
+        'xmlns:xlink="http://www.w3.org/1999/xlink"><office:body><office:text>'
+        '<text:h>Summary</text:h><text:p>Two<text:s text:c="2"/>spaces</text:p>'
+        '<text:p><draw:frame><draw:image xlink:href="Pictures/chart.png"/></draw:frame></text:p>'
+        '</office:text></office:body></office:document-content>'
+    )
+    path = tmp_path / "summary.odt"
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("content.xml", content)
+        archive.writestr("Pictures/chart.png", image)
+    assert office_text.extract_document(str(path)) == [("text", "Summary\nTwo  spaces"), ("image", image)]
+
+def test_xlsx_sheets(tmp_path):
+    openpyxl = pytest.importorskip("openpyxl")
+    workbook = openpyxl.Workbook()
+    workbook.active.title = "Scores"
+    workbook.active.append(["Reading", 12.0, None])
+    workbook.active.append(["Maths", 14.5])
+    path = str(tmp_path / "scores.xlsx")
+    workbook.save(path)
+    assert office_text.extract_document(path) == [("text", "Sheet: Scores\nReading | 12\nMaths | 14.5")]
+
+def test_small_images_are_dropped_and_large_ones_fit_the_model():
+    assert office_text.image_to_jpeg(png((40, 40))) is None
+    assert office_text.image_to_jpeg(b"not an image") is None
+    with Image.open(io.BytesIO(office_text.image_to_jpeg(png((3000, 1000))))) as jpeg:
+        assert jpeg.format == "JPEG" and max(jpeg.size) == office_text.IMAGE_MAX_EDGE
@@ -0,0 +1,50 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+from PIL import Image, ImageDraw
+
+from common import page_filter
+
+def page(path, lines=(), background=255, quality=85, letterhead=True):
+    """A JPEG page: an optional dark letterhead band and text-like bars of the given widths."""
+    img = Image.new("L", (850, 1100), background)
+    draw = ImageDraw.Draw(img)
+    if letterhead:
+        draw.rectangle((60, 40, 790, 120), fill=30)
+    for row, width in enumerate(lines):
+        top = 180 + row * 40
+        draw.rectangle((80, top, 80 + width, top + 14), fill=20)
+    img.save(path, "JPEG", quality=quality)
+    return str(path)
+
+def test_blank_pages(tmp_path):
+    paths = [
+        page(tmp_path / "white.jpeg", letterhead=False),
+        page(tmp_path / "grey.jpeg", background=215, letterhead=False),  # Grey scanner paper
+        page(tmp_path / "text.jpeg", lines=[600] * 10),
+    ]
+    assert page_filter.classify_pages(paths) == ["blank", "blank", None]
+
+def test_rescanned_page_is_a_duplicate_of_the_first(tmp_path):
+    lines = [700, 650, 690, 300, 720, 710, 500]
+    paths = [
+        page(tmp_path / "a.jpeg", lines=lines, quality=90),
+        page(tmp_path / "other.jpeg", lines=[200, 700, 150, 680] * 4, letterhead=False),
+        page(tmp_path / "a_again.jpeg", lines=lines, quality=60),
+    ]
+    assert page_filter.classify_pages(paths) == [None, None, 0]
+
+def test_same_letterhead_with_different_text_is_kept(tmp_path):
+    paths = [
+        page(tmp_path / "short.jpeg", lines=[700, 400]),
+        page(tmp_path / "long.jpeg", lines=[700, 400, 700, 700, 650, 700, 300]),
+    ]
+    assert page_filter.classify_pages(paths) == [None, None]
+    # The ink difference alone keeps them apart, however close the hashes
+    assert page_filter.classify_pages(paths, max_distance=256) == [None, None]
+
+def test_summarize_and_disabled_filter(tmp_path, monkeypatch):
+    assert page_filter.summarize([None, "blank", 0, None, 3]) == {"pages": 5, "sent": 2, "blank": 1, "duplicate": 2}
+    monkeypatch.setattr(page_filter, "PAGE_FILTER_ENABLED", False)
+    assert page_filter.filter_pages([page(tmp_path / "white.jpeg", letterhead=False)]) == [None]
@@ -0,0 +1,39 @@
+def pages(numbers, tokens=1600, payload_bytes=200_000, **fields):
+    return [dict({"number": number, "skip": False, "tokens": tokens, "payload_bytes": payload_bytes}, **fields) for number in numbers]
+
+def numbers(groups):
+    return [[page["number"] for page in group] for group in groups]
+
+def test_expected_output_limits_the_pages_per_request(ocr_stage):
+    # 9 transcripts of OUTPUT_TOKENS_PER_PAGE fit in 80% of 8192 output tokens, 10 don't
+    groups = ocr_stage.plan_requests(pages(range(1, 21)), prompt_tokens=500, max_tokens=8192)
+    assert [len(group) for group in groups] == [9, 9, 2]
+
+def test_image_count_limit(ocr_stage, monkeypatch):
+    monkeypatch.setattr(ocr_stage, "MAX_IMAGES_PER_REQUEST", 4)
+    groups = ocr_stage.plan_requests(pages(range(1, 11)), prompt_tokens=500, max_tokens=64000)
+    assert [len(group) for group in groups] == [4, 4, 2]
+
+def test_payload_size_limit(ocr_stage):
+    groups = ocr_stage.plan_requests(pages(range(1, 6), payload_bytes=12 * 1024 * 1024), prompt_tokens=500)
+    assert numbers(groups) == [[1, 2], [3, 4], [5]]
+
+def test_input_budget_limit(ocr_stage):
+    # 200k context - 8192 max tokens - 500 prompt leaves room for two 90k-token pages
+    groups = ocr_stage.plan_requests(pages(range(1, 4), tokens=90_000), prompt_tokens=500)
+    assert numbers(groups) == [[1, 2], [3]]
+
+def test_gap_in_page_numbers_starts_a_request(ocr_stage):
+    groups = ocr_stage.plan_requests(pages([1, 2, 4, 5]), prompt_tokens=500)
+    assert numbers(groups) == [[1, 2], [4, 5]]
+
+def test_cached_pages_are_grouped_apart(ocr_stage):
+    planned = pages([1, 2]) + pages([3, 4], cached="text") + pages([5])
+    groups = ocr_stage.plan_requests(planned, prompt_tokens=500)
+    assert numbers(groups) == [[1, 2], [3, 4], [5]]
+
+def test_skipped_pages_are_not_counted_as_images(ocr_stage, monkeypatch):
+    monkeypatch.setattr(ocr_stage, "MAX_IMAGES_PER_REQUEST", 2)
+    planned = pages([1]) + pages([2], skip=True, tokens=0, payload_bytes=0) + pages([3])
+    groups = ocr_stage.plan_requests(planned, prompt_tokens=500)
+    assert numbers(groups) == [[1, 2, 3]]
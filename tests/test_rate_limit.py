@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+from common.rate_limit import RateLimiter, TokenBucket, _duration_seconds
+
+def elapsed(coroutine):
+    start = time.monotonic()
+    asyncio.run(coroutine)
+    return time.monotonic() - start
+
+def test_bucket_spends_its_burst_then_refills_at_the_per_minute_rate():
+    async def run():
+        bucket = TokenBucket(600)  # 10 a second
+        await bucket.acquire(600)
+        for _ in range(3):
+            await bucket.acquire()
+    assert 0.25 <= elapsed(run()) < 1.0
+
+def test_concurrent_waiters_share_the_rate():
+    async def run():
+        bucket = TokenBucket(1200)  # 20 a second
+        await bucket.acquire(1200)
+        await asyncio.gather(*(bucket.acquire() for _ in range(6)))
+    assert 0.25 <= elapsed(run()) < 1.0
+
+def test_acquire_more_than_capacity_takes_the_whole_bucket():
+    async def run():
+        bucket = TokenBucket(60)
+        await asyncio.wait_for(bucket.acquire(1000), timeout=1)
+        return bucket.tokens
+    assert asyncio.run(run()) < 1
+
+def test_exhausted_bucket_waits_for_the_reset():
+    async def run():
+        bucket = TokenBucket(6000)
+        bucket.observe(remaining=0, reset_in=0.3)
+        await bucket.acquire()
+    assert elapsed(run()) >= 0.3
+
+def test_headers_resync_the_buckets():
+    limiter = RateLimiter(50, 40000)
+    limiter.update_from_headers({
+        "anthropic-ratelimit-requests-limit": "120",
+        "anthropic-ratelimit-requests-remaining": "5",
+        "anthropic-ratelimit-input-tokens-limit": "60000",
+        "anthropic-ratelimit-input-tokens-remaining": "100",
+    })
+    assert limiter.requests.capacity == 120 and limiter.requests.refill_per_second == 2
+    assert limiter.requests.tokens <= 5
+    assert limiter.tokens.capacity == 60000 and limiter.tokens.tokens <= 100
+
+def test_openai_headers_and_durations():
+    limiter = RateLimiter(50, 40000)
+    limiter.update_from_openai_headers({
+        "x-ratelimit-limit-requests": "500",
+        "x-ratelimit-remaining-requests": "0",
+        "x-ratelimit-reset-requests": "1.5s",
+    })
+    assert limiter.requests.capacity == 500 and limiter.requests.tokens == 0
+    assert limiter.requests.blocked_until > time.monotonic() + 1
+    assert _duration_seconds("6m0s") == 360
+    assert _duration_seconds("20ms") == 0.02
+
+def test_pause_holds_new_requests():
+    async def run():
+        limiter = RateLimiter(600, 100000)
+        limiter.pause(0.3)
+        await limiter.acquire(10)
+    assert elapsed(run()) >= 0.3
@@ -0,0 +1,72 @@
+import shutil
+import textwrap
+
+import pytest
+from PIL import Image
+
+from common import text_layer
+
+LETTER = {"Page size": "612 x 792 pts"}
+PROSE = (
+    "The pupil reads fluently and answers questions about the passage in full sentences. "
+    "Spelling of common words is secure, and handwriting is joined and legible throughout. "
+    "Next steps are to use a wider range of punctuation and to plan longer pieces of writing."
+)
+
+def text_pdf(path, page_texts):
+    """A PDF whose pages carry their text as Helvetica text objects, wrapped at 60 characters."""
+    pages = len(page_texts)
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{4 + 2 * i} 0 R" for i in range(pages))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for i, text in enumerate(page_texts):
+        lines = textwrap.wrap(text, 60)
+        stream = "BT /F1 11 Tf 14 TL 72 720 Td " + " ".join(f"({line}) Tj T*" for line in lines) + " ET"
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>")
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+
+    pdf, offsets = b"%PDF-1.4\n", []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    pdf += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("latin-1")
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    path.write_bytes(pdf)
+    return str(path)
+
+@pytest.fixture
+def poppler():
+    if not (shutil.which("pdftotext") and shutil.which("pdfimages")):
+        pytest.skip("poppler-utils is not installed")
+
+@pytest.mark.parametrize("text, coverage, reason", [
+    (PROSE, 0.0, None),
+    ("Page 3 of 12", 0.0, "too little text"),
+    ("\ue000\ue001\ue002 " * 100, 0.0, "unmapped glyphs"),
+    ("x7#q/ %$&k9 ;;;; " * 40, 0.0, "not word-like"),
+    (PROSE, 0.9, "mostly image"),
+])
+def test_classify_text(text, coverage, reason):
+    assert text_layer.classify_text(text, coverage) == reason
+
+def test_without_poppler_every_page_is_rasterized(tmp_path, monkeypatch):
+    def missing(*args, **kwargs):
+        raise FileNotFoundError("pdftotext")
+    monkeypatch.setattr(text_layer.subprocess, "run", missing)
+    pages = text_layer.classify_pages(str(tmp_path / "report.pdf"), dict(LETTER, Pages="2"))
+    assert [(page["number"], page["text"]) for page in pages] == [(1, None), (2, None)]
+
+def test_pages_with_a_usable_text_layer_keep_their_text(tmp_path, poppler):
+    path = text_pdf(tmp_path / "report.pdf", [PROSE, "Page 2 of 2"])
+    first, second = text_layer.classify_pages(path, dict(LETTER, Pages="2"))
+    assert first["reason"] is None and first["text"].startswith("The pupil reads fluently")
+    assert second["text"] is None and second["reason"] == "too little text"
+
+def test_a_scan_is_rasterized(tmp_path, poppler):
+    path = tmp_path / "scan.pdf"
+    Image.new("RGB", (850, 1100), "white").save(path, "PDF", resolution=100)
+    pages = text_layer.classify_pages(str(path), dict(LETTER, Pages="1"))
+    assert pages == [{"number": 1, "text": None, "reason": "too little text"}]
@@ -0,0 +1,152 @@
+import gzip
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+pytest.importorskip("functions_framework")
+pytest.importorskip("pdf2image")
+from PIL import Image
+
+from conftest import load_stage
+from common import clients, job_state, rasterize, scratch
+from common.local_storage import LocalStorageClient
+
+PAGES_PER_MEMBER = 2
+
+@pytest.fixture(scope="module")
+def unzip_stage():
+    return load_stage("1unzip")
+
+@pytest.fixture
+def bucket(tmp_path):
+    client = LocalStorageClient(str(tmp_path / "storage"))
+    clients.use_storage_client(client)
+    yield client.bucket("uploads")
+    clients.reset()
+
+@pytest.fixture
+def budget(monkeypatch, tmp_path):
+    """A small scratch budget, so a few hundred bytes of members fill it."""
+    def install(budget_bytes):
+        instance = scratch.Scratch(root=str(tmp_path / "scratch"), budget_bytes=budget_bytes)
+        monkeypatch.setattr(scratch, "_scratch", instance)
+        monkeypatch.setattr(scratch, "SCRATCH_WAIT_SECONDS", 5)
+        return instance
+    return install
+
+@pytest.fixture
+def fake_render(monkeypatch, unzip_stage):
+    """Renders every "PDF" as PAGES_PER_MEMBER blank pages without poppler."""
+    def plan_render_tasks(pdf_path, output_dir, pages_per_task=None):
+        return [(pdf_path, output_dir, 1, PAGES_PER_MEMBER)]
+
+    def iter_pdf_pages(pdf_path, pages=None, **kwargs):
+        for page_number in pages or range(1, PAGES_PER_MEMBER + 1):
+            yield page_number, Image.new("RGB", (8, 8))
+
+    monkeypatch.setattr(unzip_stage, "plan_render_tasks", plan_render_tasks)
+    monkeypatch.setattr(rasterize, "iter_pdf_pages", iter_pdf_pages)
+
+def zip_bytes(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+def tar_bytes(members, mode="w"):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as archive:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+def seven_zip_bytes(members):
+    py7zr = pytest.importorskip("py7zr")
+    buffer = io.BytesIO()
+    with py7zr.SevenZipFile(buffer, "w") as archive:  # Solid: every member in one block
+        for name, data in members.items():
+            archive.writestr(data, name)
+    return buffer.getvalue()
+
+ARCHIVES = {"job_batch.zip": zip_bytes, "job_batch.tar": tar_bytes, "job_batch.7z": seven_zip_bytes}
+
+def extract(unzip_stage, tmp_path, file_name, data, **kwargs):
+    """{member path relative to the work dir: content} of every PDF member, in order."""
+    work_dir = str(tmp_path / "work")
+    members = {}
+    for pdf_path, output_dir in unzip_stage.iter_archive_pdfs(io.BytesIO(data), file_name, work_dir, **kwargs):
+        assert output_dir == os.path.join(os.path.dirname(pdf_path), "image")
+        with open(pdf_path, "rb") as f:
+            members[os.path.relpath(pdf_path, work_dir)] = f.read()
+    return members
+
+@pytest.mark.parametrize("member_name, relative_path", [
+    ("docs/a.pdf", "docs/a.pdf"),
+    ("/abs/a.pdf", "abs/a.pdf"),
+    ("docs\\a.pdf", "docs/a.pdf"),
+    ("../a.pdf", None),
+    ("docs/../../a.pdf", None),
+    ("..\\a.pdf", None),
+])
+def test_member_paths_stay_inside_the_work_dir(unzip_stage, member_name, relative_path):
+    expected = None if relative_path is None else os.path.join("/work", relative_path)
+    assert unzip_stage.safe_member_path("/work", member_name) == expected
+
+@pytest.mark.parametrize("file_name", ARCHIVES)
+def test_only_pdf_members_are_extracted(unzip_stage, tmp_path, file_name):
+    data = ARCHIVES[file_name]({"a.pdf": b"first", "notes.txt": b"skip", "sub/b.PDF": b"second"})
+    assert extract(unzip_stage, tmp_path, file_name, data) == {"a.pdf": b"first", "sub/b.PDF": b"second"}
+
+@pytest.mark.parametrize("file_name", ARCHIVES)
+def test_members_already_done_are_skipped(unzip_stage, tmp_path, file_name):
+    data = ARCHIVES[file_name]({"a.pdf": b"first", "b.pdf": b"second"})
+    skip = lambda member_path: member_path.endswith("a.pdf")
+    assert extract(unzip_stage, tmp_path, file_name, data, skip=skip) == {"b.pdf": b"second"}
+
+@pytest.mark.parametrize("file_name", ARCHIVES)
+@pytest.mark.parametrize("limit, value", [
+    ("MAX_ARCHIVE_MEMBERS", 1),
+    ("MAX_MEMBER_BYTES", 150),
+    ("MAX_ARCHIVE_TOTAL_BYTES", 300),
+])
+def test_archive_limits(unzip_stage, tmp_path, monkeypatch, file_name, limit, value):
+    monkeypatch.setattr(unzip_stage, limit, value)
+    data = ARCHIVES[file_name]({"a.pdf": b"%" * 200, "b.pdf": b"%" * 200})
+    with pytest.raises(unzip_stage.ArchiveLimitError):
+        extract(unzip_stage, tmp_path, file_name, data)
+
+def test_a_truncated_tarball_is_an_error(unzip_stage, tmp_path):
+    data = tar_bytes({"a.pdf": b"%" * 600, "b.pdf": b"%" * 6000}, mode="w:gz")
+    truncated = gzip.compress(gzip.decompress(data)[:4096])  # Breaks off inside b.pdf
+    pdfs = unzip_stage.iter_archive_pdfs(io.BytesIO(truncated), "job_batch.tar.gz", str(tmp_path))
+    assert next(pdfs)[0].endswith("a.pdf")
+    with pytest.raises(tarfile.ReadError):
+        next(pdfs)
+
+def test_a_single_gzipped_pdf(unzip_stage, tmp_path):
+    data = gzip.compress(b"%PDF-1.4 single")
+    assert extract(unzip_stage, tmp_path, "job_report.pdf.gz", data) == {"job_report.pdf": b"%PDF-1.4 single"}
+
+def upload(bucket, name, data):
+    bucket.blob(name).upload_from_string(data)
+    return name
+
+def test_pool_frees_earlier_members_for_the_next_one(unzip_stage, bucket, budget, fake_render, monkeypatch):
+    # Each member takes more than half the budget: the second only fits once the first is uploaded
+    instance = budget(1000)
+    monkeypatch.setattr(unzip_stage, "RASTER_WORKERS", 2)
+    name = upload(bucket, "job_batch.zip", zip_bytes({"a.pdf": b"%" * 600, "b.pdf": b"%" * 600}))
+    state = job_state.JobState(bucket, "unzip", "job")
+
+    unzip_stage.unpack_archive(bucket, name, "job", state)
+
+    pages = sorted(blob.name for blob in bucket.list_blobs(prefix="job_images/") if blob.name.endswith(".jpeg"))
+    assert len(pages) == 2 * PAGES_PER_MEMBER
+    assert state.done("member:a.pdf") and state.done("member:b.pdf")
+    assert instance.reserved == 0
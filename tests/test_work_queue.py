@@ -0,0 +1,104 @@
+import time
+
+import pytest
+
+from common import work_queue
+from common.work_queue import MemoryQueue, QueueFull, SQLiteQueue, WorkItem
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_queue(request, tmp_path):
+    def make(**kwargs):
+        if request.param == "sqlite":
+            return SQLiteQueue(str(tmp_path / "queue.sqlite"), **kwargs)
+        return MemoryQueue(**kwargs)
+    return make
+
+def put(queue, tenant, count, **fields):
+    for i in range(count):
+        queue.put(WorkItem("ocr", {"name": f"{tenant}-{i}"}, tenant=tenant, **fields))
+
+def lease_tenants(queue, count):
+    leased = [queue.lease() for _ in range(count)]
+    return [item.tenant if item else None for item in leased]
+
+def test_tenants_share_capacity_whoever_queued_first(make_queue):
+    queue = make_queue(max_in_flight=100)
+    put(queue, "big", 6)
+    put(queue, "small", 2)
+    assert lease_tenants(queue, 7) == ["big", "small", "big", "small", "big", "big", "big"]
+
+def test_fair_share_counts_the_cost_in_flight(make_queue):
+    queue = make_queue(max_in_flight=100)
+    put(queue, "heavy", 2, cost=4)
+    put(queue, "light", 6)
+    assert lease_tenants(queue, 7) == ["heavy", "light", "light", "light", "light", "heavy", "light"]
+
+def test_priority_comes_before_fair_share(make_queue):
+    queue = make_queue(max_in_flight=100)
+    put(queue, "a", 1)
+    put(queue, "b", 1, priority=1)
+    assert lease_tenants(queue, 2) == ["b", "a"]
+
+def test_in_flight_cap(make_queue):
+    queue = make_queue(max_in_flight=3)
+    put(queue, "a", 2, cost=2)
+    first = queue.lease()
+    assert queue.lease() is None
+    queue.ack(first)
+    second = queue.lease()
+    assert second is not None
+
+    # An item over the cap still runs, once nothing else is in flight
+    put(queue, "a", 1, cost=5)
+    assert queue.lease() is None
+    queue.ack(second)
+    assert queue.lease().cost == 5
+
+def test_backpressure(make_queue):
+    queue = make_queue(max_depth=3, tenant_max_depth=2)
+    put(queue, "a", 2)
+    with pytest.raises(QueueFull):
+        put(queue, "a", 1)
+    put(queue, "b", 1)
+    with pytest.raises(QueueFull):
+        put(queue, "c", 1)
+    # Follow-on work of a job already under way is always accepted
+    queue.put(WorkItem("ocr", {}, tenant="a"), backpressure=False)
+    assert queue.stats()["ready"] == 4
+
+def test_nack_delays_the_retry_and_expired_leases_come_back(make_queue):
+    queue = make_queue(lease_seconds=0.2)
+    put(queue, "a", 1)
+    item = queue.lease()
+    queue.nack(item, delay=0.2)
+    assert queue.lease() is None
+    time.sleep(0.25)
+    item = queue.lease()
+    assert item.attempts == 2
+
+    # Never acked: handed out again once its lease runs out
+    assert queue.lease() is None
+    time.sleep(0.25)
+    assert queue.lease().attempts == 3
+
+def test_drain_retries_failures_up_to_max_attempts(make_queue, monkeypatch):
+    monkeypatch.setattr(work_queue, "WORK_QUEUE_RETRY_SECONDS", 0.01)
+    queue = make_queue(max_in_flight=100)
+    put(queue, "a", 3)
+    put(queue, "b", 1, priority=9)
+    calls = []
+
+    def handle(item):
+        calls.append(item.payload["name"])
+        if item.tenant == "b":
+            raise RuntimeError("boom")
+
+    handled = work_queue.drain(queue, handle, workers=2, max_attempts=3, idle_seconds=0.01)
+    assert sorted(calls) == ["a-0", "a-1", "a-2", "b-0", "b-0", "b-0"]
+    assert handled == 6
+    assert queue.stats()["ready"] == 0 and queue.stats()["leased"] == 0
+
+def test_cost_and_cap_from_the_rate_limit():
+    assert work_queue.page_batches(0) == 1
+    assert work_queue.page_batches(work_queue.PAGES_PER_REQUEST + 1) == 2
+    assert work_queue.max_in_flight_for_rate_limit(requests_per_minute=50, seconds_per_request=30) == 25